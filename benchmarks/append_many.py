@@ -0,0 +1,71 @@
+"""
+Description
+-----------
+Benchmark of Odm.append_many against successive calls to
+Odm.append_from, when loading many sensor files.
+
+Every file gives a SiteMeasure table, as the Quebec City sensor files do.
+append_from concatenates and de-duplicates the whole store for every
+file, so its time grows with the square of the number of files.
+append_many does it once, so its time grows linearly.
+
+Usage
+-----
+    python benchmarks/append_many.py [--files 50 100 200] [--rows 2000]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from wbe_odm import odm
+
+
+def make_sensor_file(file_index, n_rows, seed=0):
+    rng = np.random.default_rng(seed + file_index)
+    start = pd.Timestamp("2021-01-01") + pd.Timedelta(days=file_index)
+    site_measure = pd.DataFrame({
+        "siteMeasureID": [f"qc_01_{file_index}_{i}" for i in range(n_rows)],
+        "siteID": "qc_01",
+        "dateTime": pd.date_range(start, periods=n_rows, freq="15s"),
+        "type": rng.choice(["wqturb", "wqtemp", "envrnf"], n_rows),
+        "aggregation": "single",
+        "value": rng.random(n_rows) * 10,
+        "unit": rng.choice(["ntu", "celsius", "mm"], n_rows),
+        "notes": "",
+    })
+    return odm.Odm(site_measure=site_measure)
+
+
+def time_append_from(files):
+    store = odm.Odm()
+    start = time.perf_counter()
+    for mapper in files:
+        store.append_from(mapper)
+    return time.perf_counter() - start, store
+
+
+def time_append_many(files):
+    store = odm.Odm()
+    start = time.perf_counter()
+    store.append_many(files)
+    return time.perf_counter() - start, store
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, nargs="+", default=[50, 100, 200])
+    parser.add_argument("--rows", type=int, default=2000)
+    args = parser.parse_args()
+    print(f"{'files':>6} {'append_from (s)':>16} {'append_many (s)':>16}")
+    for n_files in args.files:
+        files = [make_sensor_file(i, args.rows) for i in range(n_files)]
+        one_by_one_s, one_by_one = time_append_from(files)
+        batched_s, batched = time_append_many(files)
+        assert len(one_by_one.site_measure) == len(batched.site_measure)
+        print(f"{n_files:>6} {one_by_one_s:>16.2f} {batched_s:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Description
+-----------
+Benchmark of the weekly colour classes of the site GeoJSON of
+pipelines.py.
+
+pipelines.get_color_ts_per_site classifies the weekly medians of the
+viral signal of all the sites in one groupby. It is compared to the
+classification site by site that it replaces, kept below. Both must give
+the same classes.
+
+Usage
+-----
+    PYTHONPATH=. python benchmarks/color_classes.py [--sites 300]
+        [--days 700]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import pipelines
+
+
+def legacy_get_n_bins(series, all_colors):
+    max_len = len(all_colors)-1
+    len_not_null = len(series[~series.isna()])
+    if len_not_null == 0:
+        return None
+    elif len_not_null < max_len:
+        return len_not_null
+    return max_len
+
+
+def legacy_get_color_ts(viral, colorscale, dateStart, dateEnd=None):
+    dateStart = pd.to_datetime(dateStart)
+    weekly = None
+    if viral is not None:
+        viral["last_sunday"] = viral.index.map(pipelines.get_last_sunday)
+        weekly = viral.resample("W", on="last_sunday").median()
+
+    date_range_start = pipelines.get_last_sunday(dateStart)
+    if dateEnd is None:
+        dateEnd = pd.to_datetime("now")
+    date_range = pd.date_range(start=date_range_start, end=dateEnd, freq="W")
+    result = pd.DataFrame(date_range)
+    result.columns = ["date"]
+    result.sort_values("date", inplace=True)
+
+    if weekly is None:
+        weekly = pd.DataFrame(date_range)
+        weekly.columns = ["last_sunday"]
+        weekly["norm"] = np.nan
+    weekly.sort_values("last_sunday", inplace=True)
+    result = pd.merge(
+        result, weekly, left_on="date", right_on="last_sunday", how="left")
+
+    n_bins = legacy_get_n_bins(result["norm"], colorscale)
+    if n_bins is None:
+        result["signal_strength"] = 0
+    elif n_bins == 1:
+        result["signal_strength"] = 1
+    else:
+        result["signal_strength"] = pd.cut(
+            result["norm"], n_bins, labels=range(1, n_bins+1))
+    result["signal_strength"] = result["signal_strength"].astype("str")
+    result.loc[result["signal_strength"].isna(), "signal_strength"] = "0"
+    result["date"] = result["date"].dt.strftime("%Y-%m-%d")
+    result.set_index("date", inplace=True)
+    return pd.Series(result["signal_strength"]).to_dict()
+
+
+def make_norms(n_sites, n_days, seed=0):
+    """Daily signals of the sites, with sites without data, flat
+    signals, single weeks, gaps and times of day."""
+    rng = np.random.default_rng(seed)
+    days = pd.date_range("2021-01-01", periods=n_days, freq="D")
+    norms = {}
+    for i in range(n_sites):
+        kind = i % 6
+        values = rng.lognormal(0, 1, n_days)
+        values[rng.random(n_days) < 0.3] = np.nan
+        index = days
+        if kind == 0:
+            norms[f"site_{i}"] = None
+            continue
+        if kind == 1:
+            values[:] = 2.5
+        elif kind == 2:
+            values[:] = np.nan
+            values[rng.integers(0, n_days)] = 1.0
+        elif kind == 3:
+            values[n_days // 3: 2 * n_days // 3] = np.nan
+        elif kind == 4:
+            index = days + pd.to_timedelta(
+                rng.integers(0, 86400, n_days), unit="s")
+        norms[f"site_{i}"] = pd.Series(
+            values, index=pd.DatetimeIndex(index, name="Calculated_timestamp"),
+            name="norm")
+    return norms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=300)
+    parser.add_argument("--days", type=int, default=700)
+    args = parser.parse_args()
+    norms = make_norms(args.sites, args.days)
+    colors = pipelines.COLORS
+    date_start, date_end = "2021-03-01", "2023-01-01"
+
+    start = time.perf_counter()
+    expected = {
+        site: legacy_get_color_ts(
+            None if norm is None else norm.to_frame(), colors, date_start,
+            date_end)
+        for site, norm in norms.items()}
+    legacy_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = pipelines.get_color_ts_per_site(
+        norms, colors, date_start, date_end)
+    grouped_s = time.perf_counter() - start
+
+    assert result == expected
+    print(f"sites: {args.sites}, days: {args.days}")
+    print(f"site by site: {legacy_s:8.3f} s")
+    print(f"all sites:    {grouped_s:8.3f} s")
+    print(f"speedup:      {legacy_s / grouped_s:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
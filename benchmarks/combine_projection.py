@@ -0,0 +1,136 @@
+"""
+Description
+-----------
+Benchmark of Odm.combine_dataset with a projection: only the measures,
+tables and fields used by the website (covN2, nPMMoV and the sensors'
+flows, with the names of the sites and polygons) against a full
+combination.
+
+The store holds daily samples of several sites, each measured for many
+types of measures, as the lab exports are. The time and the peak memory
+traced by tracemalloc are reported for both. The projected columns must
+hold the same values as in the full combination.
+
+Usage
+-----
+    python benchmarks/combine_projection.py [--sites 20] [--days 365]
+        [--types 30]
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from incremental_combine import with_fields
+from wbe_odm import odm
+
+PROJECTION = {
+    "measures": ["covn2", "npmmov", "wwflow"],
+    "tables": ["ww_measure", "site_measure", "site", "polygon"],
+    "columns": {"site": ["name"], "polygon": ["name"], "ww_measure": []},
+}
+
+
+def make_store(n_sites, n_days, n_types, seed=0):
+    rng = np.random.default_rng(seed)
+    sites = [f"site_{i}" for i in range(n_sites)]
+    days = pd.date_range("2021-01-01", periods=n_days, freq="D")
+    sample = pd.DataFrame({
+        "sampleID": [f"{s}_{d:%Y%m%d}" for s in sites for d in days],
+        "siteID": np.repeat(sites, n_days),
+        "dateTime": np.tile(days, n_sites),
+        "collection": "grb",
+        "type": "pstgrit",
+    })
+    types = ["covn2", "npmmov"] + [f"wq{i}" for i in range(n_types - 2)]
+    n_measures = len(sample) * len(types)
+    ww_measure = pd.DataFrame({
+        "wwMeasureID": np.arange(n_measures).astype(str),
+        "sampleID": np.repeat(sample["sampleID"].to_numpy(), len(types)),
+        "labID": "lab_1",
+        "assayMethodID": np.tile(types, len(sample)),
+        "type": np.tile(types, len(sample)),
+        "unit": "gcml",
+        "aggregation": "single",
+        "value": rng.random(n_measures) * 100,
+        "analysisDate": np.repeat(sample["dateTime"].to_numpy(), len(types)),
+        "notes": "analysed twice",
+    })
+    site_types = ["wwflow", "envrnf", "wwtemp", "wwph"]
+    site_measure = pd.DataFrame({
+        "siteMeasureID": [
+            f"{s}_{d:%Y%m%d}_{t}"
+            for s in sites for d in days for t in site_types],
+        "siteID": np.repeat(sites, n_days * len(site_types)),
+        "dateTime": np.repeat(np.tile(days, n_sites), len(site_types)),
+        "type": np.tile(site_types, n_sites * n_days),
+        "aggregation": "single",
+        "value": rng.random(n_sites * n_days * len(site_types)),
+        "unit": "m3d",
+    })
+    site = pd.DataFrame({
+        "siteID": sites,
+        "name": sites,
+        "type": "wwtpmus",
+        "geoLat": 46.8 + rng.random(n_sites) / 10,
+        "geoLong": -71.2 + rng.random(n_sites) / 10,
+        "polygonID": "sewershed",
+    })
+    polygon = pd.DataFrame({
+        "polygonID": ["sewershed"],
+        "name": ["Sewershed"],
+        "type": ["swrCat"],
+        "wkt": ["POLYGON ((-71.3 46.7, -71 46.7, -71 47, -71.3 47, "
+                "-71.3 46.7))"],
+    })
+    return odm.Odm(
+        sample=with_fields("Sample", sample),
+        ww_measure=with_fields("WWMeasure", ww_measure),
+        site=with_fields("Site", site),
+        site_measure=with_fields("SiteMeasure", site_measure),
+        polygon=with_fields("Polygon", polygon))
+
+
+def measure(store, **projection):
+    tracemalloc.start()
+    start = time.perf_counter()
+    combined = store.combine_dataset(**projection)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return combined, seconds, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=20)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument(
+        "--types", type=int, default=30,
+        help="number of types of measures done on every sample")
+    args = parser.parse_args()
+    store = make_store(args.sites, args.days, args.types)
+    full, full_s, full_mb = measure(store)
+    projected, projected_s, projected_mb = measure(store, **PROJECTION)
+
+    is_sample = full["Sample_sampleID"].notna().to_numpy()
+    pd.testing.assert_frame_equal(
+        projected.loc[projected["Sample_sampleID"].notna()]
+        .reset_index(drop=True),
+        full.loc[is_sample, projected.columns].reset_index(drop=True),
+        check_dtype=False)
+    print(f"samples: {len(store.sample)}, "
+          f"measures: {len(store.ww_measure)}")
+    print(f"{'':>10} {'rows':>8} {'columns':>8} {'time (s)':>9} "
+          f"{'peak (MB)':>10}")
+    print(f"{'full':>10} {len(full):>8} {len(full.columns):>8} "
+          f"{full_s:>9.2f} {full_mb:>10.0f}")
+    print(f"{'projected':>10} {len(projected):>8} "
+          f"{len(projected.columns):>8} {projected_s:>9.2f} "
+          f"{projected_mb:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
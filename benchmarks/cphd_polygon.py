@@ -0,0 +1,100 @@
+"""
+Description
+-----------
+Benchmark of utilities.get_polygon_for_cphd, which picks for each row of
+the combined dataset the smallest polygon of its polygon list that has
+public health data (Calculated_polygonIDForCPHD).
+
+The rows reuse a limited number of polygon lists, like the rows of the
+samples of a same site do. The vectorized selection is compared to a
+row-by-row search on a subset of the rows. Both must pick the same
+polygons. The row-by-row search looks areas up in a dict; the code it
+stands for scanned the whole polygon table for every ID, so the real
+gain is larger.
+
+Usage
+-----
+    python benchmarks/cphd_polygon.py [--rows 2000000] [--polygons 500]
+        [--lists 5000]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from wbe_odm import utilities
+
+
+def make_polygons(n_polygons, seed=0):
+    rng = np.random.default_rng(seed)
+    sizes = rng.uniform(0.1, 2.0, n_polygons)
+    wkts = [
+        f"POLYGON ((0 0, {s} 0, {s} {s}, 0 {s}, 0 0))" for s in sizes]
+    return pd.DataFrame({
+        "Polygon_polygonID": [f"hr_{i}" for i in range(n_polygons)],
+        "Polygon_wkt": wkts,
+    })
+
+
+def make_rows(n_rows, polygons, n_lists, seed=1):
+    rng = np.random.default_rng(seed)
+    ids = polygons["Polygon_polygonID"].to_numpy()
+    lists = [
+        ";".join(rng.choice(ids, size=rng.integers(0, 5), replace=False))
+        for _ in range(n_lists)]
+    return pd.DataFrame({
+        "Calculated_polygonList": np.array(lists, dtype=object)[
+            rng.integers(0, n_lists, n_rows)],
+    })
+
+
+def row_by_row(merged, polygons, cphd_polys):
+    areas = dict(zip(
+        polygons["Polygon_polygonID"],
+        polygons["Polygon_wkt"].apply(
+            lambda x: utilities.convert_wkt(x).area)))
+    cphd_polys = set(cphd_polys)
+
+    def pick(polygon_list):
+        ids = [i for i in polygon_list.split(";") if i in cphd_polys]
+        if not ids:
+            return None
+        return min(ids, key=lambda i: areas[i])
+    return merged["Calculated_polygonList"].apply(pick).to_numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--polygons", type=int, default=500)
+    parser.add_argument("--lists", type=int, default=5_000)
+    parser.add_argument(
+        "--legacy-rows", type=int, default=100_000,
+        help="number of rows given to the row-by-row search")
+    args = parser.parse_args()
+    polygons = make_polygons(args.polygons)
+    merged = make_rows(args.rows, polygons, args.lists)
+    cphd = pd.DataFrame({
+        "CPHD_polygonID": polygons["Polygon_polygonID"].iloc[::2]})
+
+    subset = merged.iloc[:args.legacy_rows]
+    start = time.perf_counter()
+    legacy = row_by_row(subset, polygons, cphd["CPHD_polygonID"])
+    legacy_s = (time.perf_counter() - start) * len(merged) / len(subset)
+
+    start = time.perf_counter()
+    picked = utilities.get_polygon_for_cphd(merged, polygons, cphd)
+    picked_s = time.perf_counter() - start
+
+    assert (picked["Calculated_polygonIDForCPHD"].to_numpy()[
+        :args.legacy_rows] == legacy).all()
+    print(f"rows: {args.rows}, polygons: {args.polygons}, "
+          f"distinct lists: {args.lists}")
+    print(f"row by row (extrapolated): {legacy_s:8.2f} s")
+    print(f"vectorized:                {picked_s:8.2f} s")
+    print(f"speedup:                   {legacy_s / picked_s:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
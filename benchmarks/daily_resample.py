@@ -0,0 +1,72 @@
+"""
+Description
+-----------
+Benchmark of utilities.resample_per_day on the datasets of many sites,
+as the website and ML dataset builds of pipelines.py use it.
+
+The datasets of all the sites are resampled in a single pass (by=) and
+compared to resampling them one site at a time, with the groupby pass
+and with the pairwise fold of reduce_by_type. The pairwise fold is
+timed on a subset of the sites. All must give the same daily datasets.
+
+Usage
+-----
+    python benchmarks/daily_resample.py [--rows 100000] [--sites 1000]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from site_datasets import make_combined
+from wbe_odm import utilities
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--sites", type=int, default=1000)
+    parser.add_argument(
+        "--pairwise-sites", type=int, default=5,
+        help="number of sites given to the pairwise fold")
+    args = parser.parse_args()
+    combined = make_combined(args.rows, args.sites)
+    combined["Sample_collection"] = np.random.default_rng(1).choice(
+        ["grb", "cptp24h", "unknown", None], len(combined))
+    site_index = utilities.SiteIndex(combined)
+    sites = pd.unique(combined["Site_siteID"].dropna())
+    datasets = [
+        utilities.build_site_specific_dataset(combined, site, site_index)
+        for site in sites]
+
+    start = time.perf_counter()
+    for dataset in datasets[:args.pairwise_sites]:
+        utilities.resample_per_day(dataset, pairwise=True)
+    pairwise_s = (time.perf_counter() - start) * len(sites) \
+        / args.pairwise_sites
+
+    start = time.perf_counter()
+    per_site = [utilities.resample_per_day(dataset) for dataset in datasets]
+    per_site_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    everything = pd.concat(datasets, keys=sites, names=["siteID"])\
+        .reset_index("siteID")
+    daily = utilities.resample_per_day(everything, by="siteID")
+    one_pass_s = time.perf_counter() - start
+
+    for site, expected in zip(sites, per_site):
+        pd.testing.assert_frame_equal(
+            daily.loc[site], expected, check_freq=False)
+    print(f"rows: {args.rows}, sites: {len(sites)}, "
+          f"site rows: {len(everything)}")
+    print(f"pairwise, per site (extrapolated): {pairwise_s:8.2f} s")
+    print(f"groupby, per site:                 {per_site_s:8.2f} s")
+    print(f"groupby, all sites in one pass:    {one_pass_s:8.2f} s")
+    print(f"speedup over per site groupby:     "
+          f"{per_site_s / one_pass_s:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
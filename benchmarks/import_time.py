@@ -0,0 +1,72 @@
+"""
+Description
+-----------
+Import-time budget for the wbe_odm package.
+
+Each module is imported in a fresh interpreter with `python -X importtime`.
+The time spent in wbe_odm's own modules (excluding pandas, numpy, shapely
+and other dependencies) must stay under the budget: importing the package
+should not read files, reach the network or build DataFrames.
+
+Usage
+-----
+    python benchmarks/import_time.py [--budget-ms 50]
+"""
+import argparse
+import subprocess
+import sys
+
+MODULES = [
+    "wbe_odm.odm",
+    "wbe_odm.odm_mappers.base_mapper",
+    "wbe_odm.odm_mappers.csv_folder_mapper",
+    "wbe_odm.odm_mappers.excel_template_mapper",
+    "wbe_odm.odm_mappers.serialized_mapper",
+    "wbe_odm.odm_mappers.sqlite3_mapper",
+    "wbe_odm.odm_mappers.mcgill_mapper",
+    "wbe_odm.odm_mappers.vdq_mapper",
+]
+
+
+def parse_importtime(stderr):
+    """Gets {module: (self_us, cumulative_us)} from -X importtime output."""
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def measure(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True)
+    timings = parse_importtime(result.stderr)
+    own_us = sum(
+        self_us for name, (self_us, _) in timings.items()
+        if name.split(".")[0] == "wbe_odm")
+    total_us = sum(self_us for self_us, _ in timings.values())
+    return own_us / 1000, total_us / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget-ms", type=float, default=50.)
+    args = parser.parse_args()
+    over_budget = []
+    print(f"{'module':45} {'wbe_odm [ms]':>12} {'total [ms]':>12}")
+    for module in MODULES:
+        own_ms, total_ms = measure(module)
+        print(f"{module:45} {own_ms:12.1f} {total_ms:12.1f}")
+        if own_ms > args.budget_ms:
+            over_budget.append(module)
+    if over_budget:
+        print(f"Over the {args.budget_ms} ms budget: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""
+Description
+-----------
+Benchmark of Odm.combine_dataset with incremental=True, when the store
+gets a few new samples and a correction between two combinations, as it
+does between two runs of the pipeline.
+
+The store holds daily samples of several sites, their measures and the
+sensor data of the sites. A full combination redoes every sample; the
+incremental one fingerprints the tables and only recombines the new and
+corrected samples. Both must give the same table.
+
+Usage
+-----
+    python benchmarks/incremental_combine.py [--sites 10] [--days 365]
+        [--new-days 1]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from wbe_odm import odm, odm_schema
+from wbe_odm.odm_mappers import base_mapper
+
+
+def with_fields(table_name, df):
+    fields = odm_schema.get_schema().table_fields(table_name)
+    return base_mapper.get_cast_plan(table_name).cast(
+        df.reindex(columns=fields))
+
+
+def make_store(n_sites, n_days, seed=0):
+    rng = np.random.default_rng(seed)
+    sites = [f"site_{i}" for i in range(n_sites)]
+    days = pd.date_range("2021-01-01", periods=n_days, freq="D")
+    sample = pd.DataFrame({
+        "sampleID": [f"{s}_{d:%Y%m%d}" for s in sites for d in days],
+        "siteID": np.repeat(sites, n_days),
+        "dateTime": np.tile(days, n_sites),
+        "collection": "grb",
+        "type": "pstgrit",
+        "fieldSampleTempC": rng.random(n_sites * n_days) * 20,
+    })
+    ww_measure = pd.DataFrame({
+        "wwMeasureID": [f"{i}_{t}" for i in sample["sampleID"]
+                        for t in ["covn1", "npmmov"]],
+        "sampleID": np.repeat(sample["sampleID"].to_numpy(), 2),
+        "type": np.tile(["covn1", "npmmov"], len(sample)),
+        "unit": "gcml",
+        "aggregation": "single",
+        "index": 1,
+        "value": rng.random(len(sample) * 2) * 100,
+        "analysisDate": np.repeat(sample["dateTime"].to_numpy(), 2),
+    })
+    site = pd.DataFrame({
+        "siteID": sites,
+        "name": sites,
+        "type": "wwtpmus",
+        "geoLat": 46.8 + rng.random(n_sites) / 10,
+        "geoLong": -71.2 + rng.random(n_sites) / 10,
+    })
+    site_measure = pd.DataFrame({
+        "siteMeasureID": [f"{s}_{d:%Y%m%d}_rf" for s in sites for d in days],
+        "siteID": np.repeat(sites, n_days),
+        "dateTime": np.tile(days, n_sites),
+        "type": "envrnf",
+        "aggregation": "single",
+        "value": rng.random(n_sites * n_days) * 10,
+        "unit": "mm",
+    })
+    return odm.Odm(
+        sample=with_fields("Sample", sample),
+        ww_measure=with_fields("WWMeasure", ww_measure),
+        site=with_fields("Site", site),
+        site_measure=with_fields("SiteMeasure", site_measure))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=10)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument(
+        "--new-days", type=int, default=1,
+        help="number of days of samples added before the second run")
+    args = parser.parse_args()
+    everything = make_store(args.sites, args.days + args.new_days)
+    is_new = everything.sample["dateTime"] \
+        >= everything.sample["dateTime"].max() \
+        - pd.Timedelta(days=args.new_days - 1)
+    new_samples = everything.sample.loc[is_new, "sampleID"]
+    store = odm.Odm(**{
+        attr: df.loc[~df["sampleID"].isin(new_samples)]
+        if "sampleID" in df.columns else df
+        for attr, df in everything.tables().items()
+    })
+
+    start = time.perf_counter()
+    store.combine_dataset(incremental=True)
+    first_s = time.perf_counter() - start
+
+    # New samples arrive and an older value is corrected
+    store.sample = everything.sample
+    store.ww_measure = everything.ww_measure.copy()
+    store.ww_measure.loc[store.ww_measure.index[0], "value"] = 0.0
+
+    start = time.perf_counter()
+    incremental = store.combine_dataset(incremental=True)
+    incremental_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    full = store.combine_dataset()
+    full_s = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(
+        incremental[full.columns], full.reset_index(drop=True),
+        check_dtype=False)
+    print(f"samples: {len(store.sample)}, "
+          f"new samples: {len(new_samples)}, rows: {len(full)}")
+    print(f"first incremental run: {first_s:8.2f} s")
+    print(f"full combination:      {full_s:8.2f} s")
+    print(f"incremental:           {incremental_s:8.2f} s")
+    print(f"speedup:               {full_s / incremental_s:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Description
+-----------
+Benchmark of the long layout of Odm.combine_dataset against the wide
+layout, in time, peak memory traced by tracemalloc, and memory held by
+the result.
+
+The store is the one of combine_projection.py: daily samples of several
+sites, each measured for many types of measures, and the sensor data of
+the sites. The wide table has a column per type of measure and mostly
+empty cells; the long table has a row per measure.
+
+Usage
+-----
+    python benchmarks/long_layout.py [--sites 20] [--days 365] [--types 30]
+"""
+import argparse
+import time
+import tracemalloc
+
+from combine_projection import make_store
+
+
+def measure(combine):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = combine()
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=20)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument(
+        "--types", type=int, default=30,
+        help="number of types of measures done on every sample")
+    args = parser.parse_args()
+    store = make_store(args.sites, args.days, args.types)
+    wide, wide_s, wide_peak = measure(store.combine_dataset)
+    long, long_s, long_peak = measure(
+        lambda: store.combine_dataset(layout="long"))
+    measures = long.measures
+    assert len(measures) == len(store.ww_measure) + len(store.site_measure)
+
+    print(f"samples: {len(store.sample)}, "
+          f"measures: {len(measures)}")
+    print(f"{'':>6} {'rows':>8} {'columns':>8} {'time (s)':>9} "
+          f"{'peak (MB)':>10} {'result (MB)':>12}")
+    for name, df, seconds, peak in [
+            ("wide", wide, wide_s, wide_peak),
+            ("long", measures, long_s, long_peak)]:
+        size = df.memory_usage(deep=True).sum() / 2**20
+        print(f"{name:>6} {len(df):>8} {len(df.columns):>8} "
+              f"{seconds:>9.2f} {peak:>10.0f} {size:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
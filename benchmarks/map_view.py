@@ -0,0 +1,110 @@
+"""
+Description
+-----------
+Benchmark of the map center and zoom level lookups done by the Dash app
+on every redraw of the map (visualization_helpers.get_map_center and
+get_zoom_level).
+
+The previous lookups walked every coordinate of the GeoJSON, re-read
+mapbox_zoom.csv and interpolated it row by row. They now read the view
+embedded by Odm.get_polygon_geoJSON. Both must give the same zoom
+level.
+
+Usage
+-----
+    python benchmarks/map_view.py [--polygons 200] [--vertices 512]
+        [--redraws 50]
+"""
+import argparse
+import json
+import math
+import time
+
+import geojson
+import numpy as np
+import pandas as pd
+from pyproj import Geod
+from shapely.geometry import LineString, Point, shape
+
+from polygon_geojson import make_polygons
+from wbe_odm import odm, utilities
+from wbe_odm.wbe_tools import visualization_helpers
+
+
+def legacy_points_to_meters(point_1, point_2):
+    line_string = LineString([point_1, point_2])
+    geod = Geod(ellps="WGS84")
+    return geod.geometry_length(line_string)
+
+
+def legacy_interpolate(x1, x2, y1, y2, x):
+    return y1 + (x - x1) * (y2 - y1)/(x2 - x1)
+
+
+def legacy_map_center(geo_json):
+    x_s, y_s = [], []
+    for feat in geo_json["features"]:
+        geom = shape(feat["geometry"])
+        x_s.append(geom.centroid.x)
+        y_s.append(geom.centroid.y)
+    return {"lat": sum(y_s) / len(y_s), "lon": sum(x_s) / len(x_s)}
+
+
+def legacy_zoom_level(geo_json, map_height_px):
+    coords = np.array(list(geojson.utils.coords(geo_json)))
+    bounding_box = coords[:, 0].min(), coords[:, 0].max(),\
+        coords[:, 1].min(), coords[:, 1].max()
+    center_lon = (bounding_box[0] + bounding_box[1]) / 2
+    center_lat = (bounding_box[2] + bounding_box[3]) / 2
+    distance = legacy_points_to_meters(
+        Point(center_lon, bounding_box[2]),
+        Point(center_lon, bounding_box[3]))
+    density = distance / map_height_px * 2
+    low = math.floor(abs(center_lat) / 20) * 20
+    high = min(math.ceil(abs(center_lat) / 20) * 20, 80)
+    zoom = pd.read_csv(utilities.MAPBOX_ZOOM_FILE, index_col="Zoom level")
+    zoom["calc"] = zoom.apply(
+        lambda row: legacy_interpolate(
+            low, high, row[f"Latitude {low}"], row[f"Latitude {high}"],
+            center_lat),
+        axis=1)
+    lower = zoom[zoom["calc"] < density]["calc"].idxmax()
+    upper = zoom[zoom["calc"] > density]["calc"].idxmin()
+    return legacy_interpolate(
+        zoom["calc"].iloc[upper], zoom["calc"].iloc[lower],
+        upper, lower, density)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--polygons", type=int, default=200)
+    parser.add_argument("--vertices", type=int, default=512)
+    parser.add_argument("--redraws", type=int, default=50)
+    args = parser.parse_args()
+    store = odm.Odm()
+    store.polygon = make_polygons(args.polygons, args.vertices)
+    # The app gets the GeoJSON back from a dcc.Store, as plain JSON.
+    geo = json.loads(json.dumps(store.get_polygon_geoJSON()))
+
+    start = time.perf_counter()
+    for _ in range(args.redraws):
+        legacy_center = legacy_map_center(geo)
+        legacy_zoom = legacy_zoom_level(geo, 800)
+    legacy_s = (time.perf_counter() - start) / args.redraws
+
+    start = time.perf_counter()
+    for _ in range(args.redraws):
+        center = visualization_helpers.get_map_center(geo)
+        zoom = visualization_helpers.get_zoom_level(geo, 800)
+    embedded_s = (time.perf_counter() - start) / args.redraws
+
+    assert abs(zoom - legacy_zoom) < 1e-6
+    assert abs(center["lat"] - legacy_center["lat"]) < 1e-9
+    print(f"polygons: {args.polygons}, vertices: {args.vertices}, "
+          f"zoom: {zoom:.3f}")
+    print(f"recomputed per redraw: {legacy_s * 1e3:9.3f} ms")
+    print(f"embedded view:         {embedded_s * 1e3:9.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Description
+-----------
+Benchmark of the GeoJSON export of the polygon table, as done by
+pipelines.build_polygon_geoJSON for the website.
+
+Health regions are simulated by buffered points with many vertices.
+Half of them are exported. The previous export built every feature row
+by row, removed the unwanted ones from the list and wrote the whole
+collection with indent=4. Odm.to_polygon_geoJSON filters first and
+streams compact features. Both must describe the same features.
+
+The export simplified for an overview map (--zoom) is timed twice: the
+second time, the simplified outlines come from the geometry cache.
+
+Usage
+-----
+    python benchmarks/polygon_geojson.py [--polygons 2000] [--vertices 512]
+        [--zoom 8]
+"""
+import argparse
+import io
+import json
+import time
+
+import geomet.wkt
+import numpy as np
+import pandas as pd
+import shapely
+from geojson_rewind import rewind
+
+from wbe_odm import odm, utilities
+
+
+def make_polygons(n_polygons, n_vertices, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = shapely.points(
+        rng.uniform(-80, -60, n_polygons), rng.uniform(44, 52, n_polygons))
+    shapes = shapely.buffer(
+        centers, rng.uniform(0.1, 1.5, n_polygons),
+        quad_segs=n_vertices // 4)
+    return pd.DataFrame({
+        "polygonID": [f"hr_{i}" for i in range(n_polygons)],
+        "name": [f"Region {i}" for i in range(n_polygons)],
+        "pop": rng.integers(1_000, 1_000_000, n_polygons),
+        "type": "hlthReg",
+        "wkt": shapely.to_wkt(shapes, rounding_precision=6),
+        "file": None,
+        "link": None,
+    })
+
+
+def legacy_export(store, poly_list, types=None):
+    geo = {"type": "FeatureCollection", "features": []}
+    polygon_df = store.polygon.sort_values('polygonID')
+    polygon_df['z'] = utilities.rank_polygons_by_desc_area(polygon_df)
+    if types is not None:
+        types = [types] if isinstance(types, str) else types
+        types = [type_.lower() for type_ in types]
+        polygon_df = polygon_df.loc[
+            polygon_df["type"].str.lower().isin(types)].copy()
+    for col in polygon_df.columns:
+        polygon_df[col] = polygon_df[col].fillna("null")
+    for i, row in polygon_df.iterrows():
+        if row["wkt"] != "":
+            geometry = json.loads(json.dumps(geomet.wkt.loads(row["wkt"])))
+            geo["features"].append({
+                "type": "Feature",
+                "geometry": rewind(geometry, rfc7946=False),
+                "properties": {
+                    col: row[col] for col in polygon_df.columns
+                    if "wkt" not in col},
+                "id": i,
+            })
+    features = geo["features"]
+    for feature in features.copy():
+        if feature["properties"]["polygonID"] not in poly_list:
+            features.remove(feature)
+    buf = io.StringIO()
+    buf.write(json.dumps(geo, indent=4))
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--polygons", type=int, default=2_000)
+    parser.add_argument("--vertices", type=int, default=512)
+    parser.add_argument("--zoom", type=float, default=8)
+    args = parser.parse_args()
+    store = odm.Odm()
+    store.polygon = make_polygons(args.polygons, args.vertices)
+    poly_list = store.polygon["polygonID"].iloc[::2].to_list()
+
+    start = time.perf_counter()
+    legacy = legacy_export(store, poly_list, "hlthReg")
+    legacy_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    buf = io.StringIO()
+    store.to_polygon_geoJSON(buf, types="hlthReg", polygon_ids=poly_list)
+    streamed = buf.getvalue()
+    streamed_s = time.perf_counter() - start
+
+    assert json.loads(legacy)["features"] == \
+        json.loads(streamed)["features"]
+
+    simplified_s = []
+    for _ in range(2):
+        start = time.perf_counter()
+        buf = io.StringIO()
+        store.to_polygon_geoJSON(
+            buf, types="hlthReg", polygon_ids=poly_list, zoom=args.zoom)
+        simplified = buf.getvalue()
+        simplified_s.append(time.perf_counter() - start)
+    print(f"polygons: {args.polygons}, vertices: {args.vertices}, "
+          f"exported: {len(poly_list)}")
+    print(f"previous export: {legacy_s:6.2f} s, "
+          f"{len(legacy) / 1e6:7.1f} MB")
+    print(f"streamed:        {streamed_s:6.2f} s, "
+          f"{len(streamed) / 1e6:7.1f} MB")
+    print(f"simplified:      {simplified_s[0]:6.2f} s, "
+          f"{len(simplified) / 1e6:7.1f} MB (zoom {args.zoom:g})")
+    print(f"simplified again:{simplified_s[1]:6.2f} s")
+    print(f"speedup:         {legacy_s / streamed_s:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Description
+-----------
+Benchmark of TableCombiner.get_polygon_list, which finds the polygons
+containing each site of the combined dataset.
+
+Health regions are simulated by buffered points of various sizes, so
+that polygons overlap and sites fall in zero, one or several of them.
+The spatial index is compared to the row-by-row search it replaced,
+on a subset of the rows since the latter tests every polygon for every
+row. Both must give the same lists.
+
+Like in the combined dataset, every site appears on several rows.
+Containment is computed once per site, and a second call is served
+from the containment cache without parsing the polygons.
+
+Usage
+-----
+    python benchmarks/polygon_list.py [--sites 10000] [--polygons 2000]
+        [--rows-per-site 20]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import Point
+
+from wbe_odm import odm, utilities
+
+
+def make_polygons(n_polygons, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = shapely.points(
+        rng.uniform(-80, -60, n_polygons), rng.uniform(44, 52, n_polygons))
+    shapes = shapely.buffer(
+        centers, rng.uniform(0.1, 1.5, n_polygons), quad_segs=16)
+    return pd.DataFrame({
+        "Polygon_polygonID": [f"hr_{i}" for i in range(n_polygons)],
+        "Polygon_wkt": shapely.to_wkt(shapes),
+    })
+
+
+def make_sites(n_sites, seed=1):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "Site_siteID": [f"site_{i}" for i in range(n_sites)],
+        "Site_geoLong": rng.uniform(-90, -50, n_sites),
+        "Site_geoLat": rng.uniform(40, 56, n_sites),
+    })
+
+
+def legacy_get_encompassing_polygons(row, poly):
+    poly["contains"] = poly["shape"].apply(
+        lambda x: x.contains(row["temp_point"])
+        if x is not None else False)
+    poly_ids = poly[
+        "Polygon_polygonID"].loc[poly["contains"]].to_list()
+    poly.drop(columns=["contains"], inplace=True)
+    return ";".join(poly_ids)
+
+
+def legacy_get_polygon_list(merged, polygons):
+    merged = merged.copy()
+    polygons = polygons.copy()
+    merged["temp_point"] = merged.apply(
+        lambda row: Point(row["Site_geoLong"], row["Site_geoLat"]), axis=1)
+    polygons["shape"] = polygons["Polygon_wkt"].apply(utilities.convert_wkt)
+    merged["Calculated_polygonList"] = merged.apply(
+        lambda row: legacy_get_encompassing_polygons(row, polygons),
+        axis=1)
+    return merged.drop(columns=["temp_point"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=10_000)
+    parser.add_argument("--polygons", type=int, default=2_000)
+    parser.add_argument(
+        "--legacy-sites", type=int, default=200,
+        help="number of sites given to the row-by-row search")
+    parser.add_argument("--rows-per-site", type=int, default=20)
+    args = parser.parse_args()
+    polygons = make_polygons(args.polygons)
+    sites = make_sites(args.sites)
+    rows = sites.loc[sites.index.repeat(args.rows_per_site)]\
+        .reset_index(drop=True)
+    combiner = odm.TableCombiner(odm.Odm())
+
+    subset = sites.iloc[:args.legacy_sites]
+    start = time.perf_counter()
+    legacy = legacy_get_polygon_list(subset, polygons)
+    legacy_s = (time.perf_counter() - start) * len(rows) / len(subset)
+
+    start = time.perf_counter()
+    indexed = combiner.get_polygon_list(rows.copy(), polygons)
+    indexed_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cached = combiner.get_polygon_list(rows.copy(), polygons)
+    cached_s = time.perf_counter() - start
+
+    first_rows = indexed.drop_duplicates("Site_siteID")
+    pd.testing.assert_series_equal(
+        legacy["Calculated_polygonList"],
+        first_rows["Calculated_polygonList"].iloc[:args.legacy_sites],
+        check_index=False)
+    pd.testing.assert_series_equal(
+        indexed["Calculated_polygonList"], cached["Calculated_polygonList"])
+    n_found = first_rows["Calculated_polygonList"].str.len().gt(0).sum()
+    print(f"sites: {args.sites}, rows: {len(rows)}, "
+          f"polygons: {args.polygons}, sites in a polygon: {n_found}")
+    print(f"row by row (extrapolated): {legacy_s:8.2f} s")
+    print(f"once per site:             {indexed_s:8.2f} s")
+    print(f"cached:                    {cached_s:8.2f} s")
+    print(f"speedup:                   {legacy_s / indexed_s:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
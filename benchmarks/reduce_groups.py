@@ -0,0 +1,57 @@
+"""
+Description
+-----------
+Benchmark of utilities.reduce_groups, which reduces the WWMeasure table
+to one row per sample in TableCombiner.agg_ww_measure_per_sample.
+
+The single groupby pass is compared to the pairwise fold of
+reduce_by_type (pairwise=True), which it replaced.
+
+Usage
+-----
+    python benchmarks/reduce_groups.py [--rows 50000]
+"""
+import argparse
+import time
+
+from type_cast import make_ww_measure
+
+from wbe_odm import odm
+from wbe_odm.odm_mappers import base_mapper
+
+
+def make_wide_ww_measure(n_rows):
+    df = make_ww_measure(n_rows)
+    df = df.rename(columns={"uWwMeasureID": "wwMeasureID"})
+    df = base_mapper.get_cast_plan("WWMeasure").cast(df)
+    combiner = odm.TableCombiner(odm.Odm())
+    return combiner.parse_ww_measure(df)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50_000)
+    args = parser.parse_args()
+    wide = make_wide_ww_measure(args.rows)
+    combiner = odm.TableCombiner(odm.Odm())
+
+    start = time.perf_counter()
+    combiner.pairwise_reduction = True
+    pairwise = combiner.agg_ww_measure_per_sample(wide)
+    pairwise_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    combiner.pairwise_reduction = False
+    grouped = combiner.agg_ww_measure_per_sample(wide)
+    grouped_s = time.perf_counter() - start
+
+    assert grouped.index.equals(pairwise.index)
+    print(f"rows: {args.rows}, columns: {wide.shape[1]}, "
+          f"samples: {len(grouped)}")
+    print(f"pairwise fold: {pairwise_s:8.2f} s")
+    print(f"groupby pass:  {grouped_s:8.2f} s")
+    print(f"speedup:       {pairwise_s / grouped_s:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
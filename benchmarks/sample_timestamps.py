@@ -0,0 +1,135 @@
+"""
+Description
+-----------
+Benchmark of the computation of the sample intervals and timestamps
+done by combine_dataset: utilities.clean_grab_datetime,
+utilities.clean_composite_data_intervals and
+TableCombiner.get_samples_timestamp.
+
+They are compared to the row-by-row versions they replace, which are
+kept below. Both must give the same table, dtypes included.
+
+Usage
+-----
+    python benchmarks/sample_timestamps.py [--rows 200000]
+"""
+import argparse
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from wbe_odm import utilities
+from wbe_odm.odm import TableCombiner
+
+COLLECTIONS = ["grb", "cptp24h", "cpfp12h", "ps48h", "cptp72h", "mooreSw"]
+
+
+def make_samples(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2021-01-01")
+
+    def dates(missing):
+        seconds = rng.integers(0, 400 * 86400, n_rows)
+        dates = pd.Series(start + pd.to_timedelta(seconds, unit="s"))
+        return dates.where(rng.random(n_rows) > missing)
+    return pd.DataFrame({
+        "Sample_sampleID": np.arange(n_rows).astype(str),
+        "Sample_collection": rng.choice(COLLECTIONS, n_rows),
+        "Sample_dateTime": dates(0.2),
+        "Sample_dateTimeStart": dates(0.4),
+        "Sample_dateTimeEnd": dates(0.3),
+    })
+
+
+def legacy_clean_grab_datetime(df):
+    one_day = pd.to_timedelta("24 hours")
+    df["Calculated_dateTimeStart"] = pd.to_datetime(None)
+    df["Calculated_dateTimeEnd"] = pd.to_datetime(None)
+    filt = ~df["Sample_dateTime"].isna() \
+        & df["Sample_collection"].str.contains("grb")
+    df2 = df.loc[filt, df.columns.to_list()]
+    df2["Calculated_dateTimeStart"] = df2["Sample_dateTime"].dt.normalize()
+    df2["Calculated_dateTimeEnd"] = \
+        df2["Calculated_dateTimeStart"] + one_day
+    df.loc[filt] = df2
+    return df
+
+
+def legacy_calc_start_date(end_date, type_):
+    if pd.isna(end_date) or pd.isna(type_):
+        return pd.NaT
+    hours = None
+    if re.match(r"cp[tf]p[0-9]+h", type_):
+        hours = int(type_[4:-1])
+    elif re.match(r"ps[0-9]+h", type_):
+        hours = int(type_[2:-1])
+    if hours is not None:
+        return end_date - pd.to_timedelta(f"{hours}h")
+    return pd.NaT
+
+
+def legacy_clean_composite_data_intervals(df):
+    one_day = pd.to_timedelta("23 hours 59 minutes")
+    df["Calculated_dateTimeEnd"] = pd.to_datetime(
+        df["Sample_dateTimeEnd"] + one_day).dt.date
+    df["Calculated_dateTimeStart"] = df.apply(
+        lambda row: legacy_calc_start_date(
+            row["Calculated_dateTimeEnd"], row["Sample_collection"]),
+        axis=1)
+    return df
+
+
+def legacy_get_samples_timestamp(df):
+    df["Calculated_timestamp"] = pd.NaT
+    grb_filt = df["Sample_collection"].str.contains("grb")
+    s_filt = ~df["Sample_dateTimeStart"].isna()
+    e_filt = ~df["Sample_dateTimeEnd"].isna()
+    for col in ["Calculated_timestamp", "Sample_dateTimeStart",
+                "Sample_dateTimeEnd"]:
+        df.loc[grb_filt, col] = df.loc[grb_filt, "Sample_dateTime"]
+    df.loc[s_filt & e_filt, "Calculated_timestamp"] = df.apply(
+        lambda row: utilities.get_midpoint_time(
+            row["Sample_dateTimeStart"], row["Sample_dateTimeEnd"]),
+        axis=1)
+    df.loc[e_filt & ~s_filt, "Calculated_timestamp"] = \
+        df.loc[e_filt & ~s_filt, "Sample_dateTimeEnd"]
+    return df
+
+
+def legacy(df):
+    df = legacy_clean_grab_datetime(df)
+    df = legacy_clean_composite_data_intervals(df)
+    return legacy_get_samples_timestamp(df)
+
+
+def vectorized(df):
+    df = utilities.clean_grab_datetime(df)
+    df = utilities.clean_composite_data_intervals(df)
+    return TableCombiner.get_samples_timestamp(df)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    args = parser.parse_args()
+    samples = make_samples(args.rows)
+
+    start = time.perf_counter()
+    expected = legacy(samples.copy())
+    legacy_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = vectorized(samples.copy())
+    vectorized_s = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(result, expected)
+    print(f"rows: {args.rows}")
+    print(f"row by row: {legacy_s:8.2f} s")
+    print(f"vectorized: {vectorized_s:8.2f} s")
+    print(f"speedup:    {legacy_s / vectorized_s:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Description
+-----------
+Benchmark of utilities.build_site_specific_dataset when the datasets of
+all the sites are taken out of a combined dataset, as the website and
+ML dataset builds of pipelines.py do.
+
+The index (utilities.SiteIndex) groups the rows by site and public
+health polygon once, then takes out each site with a slice. It is
+compared to the scan of the whole table for every site that it
+replaces, kept below and timed on a subset of the sites. Both must
+give the same datasets.
+
+Usage
+-----
+    python benchmarks/site_datasets.py [--rows 1000000] [--sites 300]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from wbe_odm import utilities
+
+
+def make_combined(n_rows, n_sites, seed=0):
+    rng = np.random.default_rng(seed)
+    sites = np.array([f"site_{i}" for i in range(n_sites)], dtype=object)
+    polygons = np.array(
+        [f"hr_{i}" for i in range(n_sites // 10)], dtype=object)
+    polygon_of_site = dict(zip(sites, rng.choice(polygons, n_sites)))
+    # Samples, site measures and public health rows
+    kind = rng.integers(0, 3, n_rows)
+    site = rng.choice(sites, n_rows)
+    return pd.DataFrame({
+        "Site_siteID": np.where(kind == 0, site, None),
+        "SiteMeasure_siteID": np.where(kind == 1, site, None),
+        "CPHD_polygonID": np.where(
+            kind == 2, rng.choice(polygons, n_rows), None),
+        "Calculated_polygonIDForCPHD": np.where(
+            kind == 0, pd.Series(site).map(polygon_of_site), None),
+        "Calculated_timestamp": pd.Timestamp("2021-01-01")
+        + pd.to_timedelta(rng.integers(0, 700, n_rows), unit="D"),
+        "WWMeasure_covn2_gcl_single-to-mean_value": rng.random(n_rows),
+        "SiteMeasure_wwflow_m3d_single-to-mean_value": rng.random(n_rows),
+        "CPHD_conf_report_value": rng.random(n_rows),
+    })
+
+
+def legacy_build_site_specific_dataset(df, site_id):
+    idx_col = "Calculated_timestamp"
+    filt_site1 = df["Site_siteID"] == site_id
+    filt_site = filt_site1 | (df["SiteMeasure_siteID"] == site_id)
+    df1 = df[filt_site].set_index(idx_col)
+    filt_cphd_df = df.loc[filt_site1, "Calculated_polygonIDForCPHD"]
+    if filt_cphd_df.empty:
+        dataset = df1
+    else:
+        cphd_poly_id = str(filt_cphd_df.iloc[0]).lower()
+        poly_filt = df["CPHD_polygonID"]\
+            .fillna("").str.lower().str.match(cphd_poly_id)
+        df2 = df[poly_filt].set_index(idx_col)
+        dataset = pd.concat([df1, df2], axis=0)
+    return dataset.reindex(sorted(dataset.columns), axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--sites", type=int, default=300)
+    parser.add_argument(
+        "--legacy-sites", type=int, default=10,
+        help="number of sites given to the full scans")
+    args = parser.parse_args()
+    combined = make_combined(args.rows, args.sites)
+    sites = pd.unique(combined["Site_siteID"].dropna())
+
+    start = time.perf_counter()
+    expected = {
+        site: legacy_build_site_specific_dataset(combined, site)
+        for site in sites[:args.legacy_sites]}
+    legacy_s = (time.perf_counter() - start) * len(sites) \
+        / args.legacy_sites
+
+    start = time.perf_counter()
+    site_index = utilities.SiteIndex(combined)
+    datasets = {
+        site: utilities.build_site_specific_dataset(
+            combined, site, site_index)
+        for site in sites}
+    indexed_s = time.perf_counter() - start
+
+    for site, dataset in expected.items():
+        pd.testing.assert_frame_equal(datasets[site], dataset)
+    print(f"rows: {args.rows}, sites: {len(sites)}")
+    print(f"full scans (extrapolated): {legacy_s:8.2f} s")
+    print(f"index:                     {indexed_s:8.2f} s")
+    print(f"speedup:                   {legacy_s / indexed_s:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Description
+-----------
+Benchmark of the website build of pipelines.py: the site GeoJSON and the
+plot of every site.
+
+The per-site jobs (pipelines.build_site_website) compute the dataset,
+samples, viral series, colour series and plot of a site once, and run
+over a pool of --jobs processes. They are compared to the sequential
+build they replace, kept below: the passes of get_site_geoJSON over all
+the sites, then the plots redone site by site. Both must write the same
+GeoJSON and the same plots.
+
+Usage
+-----
+    PYTHONPATH=. python benchmarks/site_website.py [--sites 20] [--days 365]
+        [--jobs 4]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import pipelines
+from color_classes import legacy_get_color_ts
+from wbe_odm import utilities
+
+
+def make_website_data(n_sites, n_days, seed=0):
+    rng = np.random.default_rng(seed)
+    names = list(pipelines.sitename_lang_map)
+    polygons = list(pipelines.poly_names)
+    site_ids = [f"qc_{i:02d}" for i in range(n_sites)]
+    sites = pd.DataFrame({
+        "siteID": site_ids,
+        "name": rng.choice(names, n_sites),
+        "description": "",
+        "type": "wwtpmus",
+        "polygonID": [f"{s}_swrcat" for s in site_ids],
+        "geoLat": 46.8 + rng.random(n_sites) / 10,
+        "geoLong": -71.2 + rng.random(n_sites) / 10,
+    })
+    site_polygon = dict(zip(site_ids, rng.choice(polygons, n_sites)))
+    site_name = dict(zip(sites["siteID"], sites["name"]))
+    days = pd.date_range(
+        pd.Timestamp("now").normalize() - pd.Timedelta(days=n_days - 1),
+        periods=n_days, freq="D")
+    n_samples = n_sites * n_days
+    site = np.repeat(site_ids, n_days)
+    prefix = "WWMeasure_{}_gcml_single-to-mean_{}"
+    samples = pd.DataFrame({
+        "Calculated_timestamp": np.tile(days, n_sites),
+        "Site_siteID": site,
+        "Site_name": pd.Series(site).map(site_name),
+        "Sample_collection": "grb",
+        "Calculated_polygonIDForCPHD": pd.Series(site).map(site_polygon),
+        "CPHD-Polygon_polygonID": pd.Series(site).map(site_polygon),
+        prefix.format("covn2", "value"): rng.random(n_samples) * 50,
+        prefix.format("covn2", "qualityFlag"): "False",
+        prefix.format("npmmov", "value"): rng.random(n_samples) * 1e3,
+        prefix.format("npmmov", "qualityFlag"): "False",
+    })
+    used = sorted(set(site_polygon.values()))
+    cases = pd.DataFrame({
+        "Calculated_timestamp": np.tile(days, len(used)),
+        "CPHD_polygonID": np.repeat(used, n_days),
+        "CPHD_conf_report_value": rng.integers(0, 100, len(used) * n_days),
+    })
+    combined = pd.concat([samples, cases], ignore_index=True)
+    return sites, combined
+
+
+def legacy_website(sites, combined, output_dir, site_name, colorscale,
+                   dateStart):
+    site_index = utilities.SiteIndex(combined)
+    sites["dataset"] = sites.apply(
+        lambda row: utilities.build_site_specific_dataset(
+            combined, row["siteID"], site_index),
+        axis=1)
+    sites["dataset"] = sites.apply(
+        lambda row: utilities.resample_per_day(row['dataset']),
+        axis=1)
+    sites['samples'] = sites.apply(
+        lambda row: pipelines.get_samples_to_plot(row['dataset'], dateStart),
+        axis=1)
+    sites["viral"] = sites.apply(
+        lambda row: pipelines.get_viral_timeseries(row['samples']),
+        axis=1)
+    sites["date_color"] = sites.apply(
+        lambda row: legacy_get_color_ts(row["viral"], colorscale, dateStart),
+        axis=1)
+    sites['collection_method'] = sites.apply(
+        lambda row: pipelines.website_collection_method(
+            pipelines.get_cm_to_plot(row['samples'], thresh_n=7)),
+        axis=1)
+    sites["clean_type"] = pipelines.get_website_type(sites["type"])
+    sites["municipality"] = sites['siteID'].apply(pipelines.get_municipality)
+    sites["name"] = sites['name'].apply(pipelines.get_website_name)
+    cols_to_keep = [
+        "siteID", "name", "description", "clean_type", "polygonID",
+        "municipality", "collection_method", "date_color"]
+    sites.fillna("", inplace=True)
+    js = {
+        "type": "FeatureCollection",
+        "features": list(sites.apply(
+            lambda row: pipelines.make_point_feature(row, cols_to_keep),
+            axis=1)),
+        "colorKey": colorscale
+    }
+    with open(os.path.join(output_dir, site_name), "w") as f:
+        f.write(json.dumps(js, indent=4))
+    for site_id in sites['siteID'].to_list():
+        plot_data, metadata = pipelines.centreau_website_data(
+            combined, site_id, dateStart, site_index=site_index)
+        if plot_data is not None and not plot_data.empty:
+            pipelines.plot_web(
+                plot_data, metadata, dateStart=dateStart, langs=['french'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=20)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    sites, combined = make_website_data(args.sites, args.days)
+    date_start = pd.Timestamp("now").normalize() \
+        - pd.Timedelta(days=args.days // 2)
+    colors = pipelines.COLORS
+    with tempfile.TemporaryDirectory() as tmp:
+        pipelines.LOGO_PATH = os.path.join(tmp, "logo.png")
+        with open(pipelines.LOGO_PATH, "wb") as f:
+            f.write(b"logo")
+        outputs = {}
+        for name, jobs in [("sequential", None), ("jobs", args.jobs)]:
+            pipelines.SITE_OUTPUT_DIR = os.path.join(tmp, name)
+            os.makedirs(pipelines.SITE_OUTPUT_DIR)
+            start = time.perf_counter()
+            if jobs is None:
+                legacy_website(
+                    sites.copy(), combined, pipelines.SITE_OUTPUT_DIR,
+                    "sites.geojson", colors, date_start)
+            else:
+                pipelines.get_site_geoJSON(
+                    sites.copy(), combined, pipelines.SITE_OUTPUT_DIR,
+                    "sites.geojson", colors, date_start, jobs=jobs,
+                    plot=True)
+            seconds = time.perf_counter() - start
+            with open(os.path.join(
+                    pipelines.SITE_OUTPUT_DIR, "sites.geojson")) as f:
+                outputs[name] = (
+                    json.load(f), sorted(os.listdir(pipelines.SITE_OUTPUT_DIR)),
+                    seconds)
+    sequential, jobs = outputs["sequential"], outputs["jobs"]
+    assert sequential[:2] == jobs[:2]
+    print(f"sites: {args.sites}, days: {args.days}, "
+          f"plots: {len(jobs[1]) - 1}")
+    print(f"sequential:         {sequential[2]:8.2f} s")
+    print(f"{args.jobs:>2} jobs:            {jobs[2]:8.2f} s")
+    print(f"speedup:            {sequential[2] / jobs[2]:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
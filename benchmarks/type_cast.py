@@ -0,0 +1,116 @@
+"""
+Description
+-----------
+Benchmark of BaseMapper.type_cast_table on a large WWMeasure table.
+
+The cast plan is compared to the column-by-column implementation it
+replaced, which converted every cell with a regular expression. Both
+must give the same table.
+
+Usage
+-----
+    python benchmarks/type_cast.py [--rows 1000000]
+"""
+import argparse
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from wbe_odm import utilities
+from wbe_odm.odm_mappers import base_mapper
+
+
+def legacy_replace_unknown_by_default(string, default):
+    if re.fullmatch(utilities.UNKNOWN_REGEX, string):
+        return default
+    return string
+
+
+def legacy_parse_types(table_name, series):
+    variable_name = series.name.lower()
+    lookup_table = utilities.get_data_types().get(table_name, {})
+    lookup_type = lookup_table.get(variable_name, dict())
+    desired_type = lookup_type.get("variableType", "string")
+    if desired_type == "bool":
+        series = series.astype(str)
+        default_bool = "false" if "qualityFlag" in variable_name else "true"
+        series = series.str.strip().str.lower()
+        series = series.apply(
+            lambda x: legacy_replace_unknown_by_default(x, default_bool))
+        series = series.str.replace("oui", "true", regex=False)
+        series = series.str.replace("yes", "true", regex=False)
+        series = series.str.startswith("true")
+        series = series.astype("bool")
+    elif desired_type in ["string", "category"]:
+        series = series.astype(str)
+        series = series.str.strip()
+        series = series.apply(
+            lambda x: legacy_replace_unknown_by_default(x, ""))
+        if variable_name != "wkt":
+            series = series.str.lower()
+    elif desired_type == "datetime64[ns]":
+        series = series.astype(str)
+        series = series.apply(
+            lambda x: legacy_replace_unknown_by_default(x, ""))
+        series = pd.to_datetime(series, errors="coerce")
+    elif desired_type in ["int64", "float64"]:
+        series = pd.to_numeric(series, errors="coerce")
+    return series
+
+
+def legacy_type_cast_table(odm_name, df):
+    return df.apply(lambda x: legacy_parse_types(odm_name, x), axis=0)
+
+
+def make_ww_measure(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    n_samples = max(n_rows // 20, 1)
+    sample_ids = np.array([f"QC_{i % 12}_cpTP24h_{i}" for i in range(n_samples)])
+    dates = pd.date_range("2020-06-01", periods=400).strftime("%Y-%m-%d")
+    yes_no = np.array(["YES", "NO", "yes", "", "n/a", "Oui"])
+    return pd.DataFrame({
+        "uWwMeasureID": [f"m{i}" for i in range(n_rows)],
+        "sampleID": rng.choice(sample_ids, n_rows),
+        "labID": rng.choice(["frigon_lab", "dorner_lab", "modeleau_lab"], n_rows),
+        "reporterID": rng.choice(["MaryamTohidi", "NielsNicolai", "unknown"], n_rows),
+        "analysisDate": rng.choice(dates, n_rows),
+        "reportDate": rng.choice(np.append(dates, "nd"), n_rows),
+        "fractionAnalyzed": rng.choice(["liquid", "solid", "mixed", "NA"], n_rows),
+        "type": rng.choice(["covN1", "covN2", "nPMMoV", "wqTSS", "wqPh"], n_rows),
+        "unit": rng.choice(["gc/ml", "mg/L", "ph", "Ct"], n_rows),
+        "aggregation": rng.choice(["single", "mean", "sd"], n_rows),
+        "index": rng.integers(1, 4, n_rows),
+        "value": rng.random(n_rows) * 100,
+        "qualityFlag": rng.choice(yes_no, n_rows),
+        "accessToPublic": rng.choice(yes_no, n_rows),
+        "accessToAllOrg": rng.choice(yes_no, n_rows),
+        "accessToPHAC": rng.choice(yes_no, n_rows),
+        "notes": rng.choice(["", "retest", "none", np.nan], n_rows),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+    df = make_ww_measure(args.rows)
+
+    start = time.perf_counter()
+    legacy = legacy_type_cast_table("WWMeasure", df)
+    legacy_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plan = base_mapper.get_cast_plan("WWMeasure").cast(df)
+    plan_s = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(legacy, plan)
+    print(f"rows: {args.rows}")
+    print(f"per-cell cast: {legacy_s:8.2f} s")
+    print(f"cast plan:     {plan_s:8.2f} s")
+    print(f"speedup:       {legacy_s / plan_s:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
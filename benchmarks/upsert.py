@@ -0,0 +1,55 @@
+"""
+Description
+-----------
+Benchmark of odm.upsert_table, used by Odm.append_from to add
+the rows of a mapper to the tables of an Odm object.
+
+Half of the appended WWMeasure rows update existing rows. The time per
+row should stay about the same as the tables grow.
+
+Usage
+-----
+    python benchmarks/upsert.py [--rows 100000 200000 400000]
+"""
+import argparse
+import time
+
+from type_cast import make_ww_measure
+
+from wbe_odm import odm
+from wbe_odm.odm_mappers import base_mapper
+
+
+def make_tables(n_rows):
+    df = make_ww_measure(n_rows + n_rows // 2)
+    df = df.rename(columns={"uWwMeasureID": "wwMeasureID"})
+    df = base_mapper.get_cast_plan("WWMeasure").cast(df)
+    old = df.iloc[:n_rows]
+    new = df.iloc[n_rows // 2:].copy()
+    new["value"] = new["value"] + 1
+    return old, new
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[100_000, 200_000, 400_000])
+    args = parser.parse_args()
+    print(f"{'rows':>8} {'policy':>9} {'time (s)':>9} {'us/row':>7}")
+    for n_rows in args.rows:
+        old, new = make_tables(n_rows)
+        for policy in odm.CONFLICT_POLICIES:
+            if policy == "warn":
+                continue
+            start = time.perf_counter()
+            combined, conflicts = odm.upsert_table(
+                old, new, "wwMeasureID", policy)
+            elapsed = time.perf_counter() - start
+            assert len(combined) == n_rows + n_rows // 2
+            assert len(conflicts) == n_rows // 2
+            per_row = elapsed / (len(old) + len(new)) * 1e6
+            print(f"{n_rows:>8} {policy:>9} {elapsed:>9.2f} {per_row:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
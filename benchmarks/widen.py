@@ -0,0 +1,75 @@
+"""
+Description
+-----------
+Benchmark of TableWidener.widen on a large WWMeasure table.
+
+The pivot is compared to the loop it replaced, which built one column
+and one mask per qualifier combination and feature. Both must give
+the same table.
+
+Usage
+-----
+    python benchmarks/widen.py [--rows 200000]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from type_cast import make_ww_measure
+
+from wbe_odm.odm import TableWidener
+from wbe_odm.odm_mappers import base_mapper
+
+FEATURES = ["value", "qualityFlag"]
+QUALIFIERS = ["type", "unit", "aggregation"]
+
+
+def legacy_widen(df, features, qualifiers, agg="mean"):
+    df = df.copy()
+    for qualifier in qualifiers:
+        filt1 = df[qualifier].isna()
+        filt2 = df[qualifier] == ""
+        df.loc[filt1 | filt2, qualifier] = f"unknown-{qualifier}"
+        df[qualifier] = df[qualifier].str.replace("/", "", regex=False)\
+            .str.lower()
+        df[qualifier] = df[qualifier].astype(str)
+        df[qualifier] = df[qualifier].str.replace(
+            "single", f"single-to-{agg}", regex=False)
+    df["col_qualifiers"] = df[qualifiers].agg("_".join, axis=1)
+    for col_qualifier in df["col_qualifiers"].unique():
+        for feature in features:
+            col_name = "_".join([col_qualifier, feature])
+            df[col_name] = np.nan
+            filt = df["col_qualifiers"] == col_qualifier
+            df.loc[filt, col_name] = df.loc[filt, feature]
+    df.drop(columns=features+qualifiers, inplace=True)
+    df.drop(columns=["col_qualifiers"], inplace=True)
+    return df.copy()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    args = parser.parse_args()
+    df = make_ww_measure(args.rows)
+    df = base_mapper.get_cast_plan("WWMeasure").cast(df)
+
+    start = time.perf_counter()
+    legacy = legacy_widen(df, FEATURES, QUALIFIERS)
+    legacy_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    wide = TableWidener(df, FEATURES, QUALIFIERS).widen()
+    pivot_s = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(legacy, wide)
+    print(f"rows: {args.rows}, wide columns: {wide.shape[1]}")
+    print(f"mask per column: {legacy_s:8.2f} s")
+    print(f"pivot:           {pivot_s:8.2f} s")
+    print(f"speedup:         {legacy_s / pivot_s:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
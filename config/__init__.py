@@ -83,6 +83,8 @@ LVL_QUALITY_SHEET_NAME = "LVL_Compil_ALL (int)"
 POLYGON_OUTPUT_DIR = "/Users/jeandavidt/OneDrive - Université Laval/COVID/Website geo"  # noqa
 POLY_NAME = "polygons.geojson"
 POLYS_TO_EXTRACT = ["swrCat"]
+# Zoom level the published polygons are simplified for (None: full detail)
+POLY_ZOOM = 12
 
 SITE_OUTPUT_DIR = "/Users/jeandavidt/OneDrive - Université Laval/COVID/Website geo"  # noqa
 SITE_NAME = "sites.geojson"
@@ -1,5 +1,7 @@
 import argparse
 import base64
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import json
 import logging
 import os
@@ -23,6 +25,10 @@ from wbe_odm.odm_mappers import (
     vdq_mapper
 )
 
+# Polygons containing each site, saved next to the ODM tables. The name is
+# not an ODM table name, so the csv folder mapper ignores the file.
+SITE_POLYGONS_FILE = "SitePolygons.csv"
+
 
 def str2bool(arg):
     value = arg.lower()
@@ -175,66 +181,92 @@ def get_viral_timeseries(samples):
     return viral
 
 
-def build_empty_color_ts(date_range):
-    df = pd.DataFrame(date_range)
-    df.columns = ["last_sunday"]
-    df["norm"] = np.nan
-    return df
-
-
-def get_n_bins(series, all_colors):
-    max_len = len(all_colors)-1
-    len_not_null = len(series[~series.isna()])
-    if len_not_null == 0:
-        return None
-    elif len_not_null < max_len:
-        return len_not_null
-    return max_len
+def get_signal_classes(weekly, n_bins):
+    """Splits the weekly medians of each site (the rows of weekly) into
+    n_bins classes of equal width between its smallest and largest
+    medians, as pd.cut does. Weeks without a median give "nan"."""
+    lowest = np.nanmin(weekly, axis=1)
+    highest = np.nanmax(weekly, axis=1)
+    flat = lowest == highest
+    lowest = np.where(
+        flat, lowest - np.where(lowest != 0, 0.001 * np.abs(lowest), 0.001),
+        lowest)
+    highest = np.where(
+        flat, highest + np.where(highest != 0, 0.001 * np.abs(highest), 0.001),
+        highest)
+    bins = np.linspace(lowest, highest, n_bins + 1, axis=1)
+    bins[~flat, 0] -= (highest - lowest)[~flat] * 0.001
+    # The class is the number of edges below the median
+    ids = (bins[:, np.newaxis, :] < weekly[:, :, np.newaxis]).sum(axis=2)
+    names = np.array(
+        ["nan"] + [str(i) for i in range(1, n_bins + 1)] + ["nan"],
+        dtype=object)
+    return names[ids]
+
+
+def get_color_ts_per_site(norms,
+                          colorscale,
+                          dateStart=DEFAULT_START_DATE,
+                          dateEnd=None):
+    """Classifies the weekly viral signal of several sites at once.
+
+    norms maps each siteID to its normalized viral signal (the "norm" of
+    get_viral_timeseries), or to None. The signal is reduced to weekly
+    medians, labelled by the Sunday starting each week, from the last
+    Sunday before dateStart to dateEnd (now by default). The medians of a
+    site are split into up to len(colorscale) - 1 classes of equal width,
+    "1" being the weakest, and weeks without data are "nan". A site
+    without data gets "0" every week, and a site with a single week of
+    data gets "1" every week.
+
+    Returns a dict of the {date: class} dict of each siteID."""
+    site_ids = list(norms)
+    if dateEnd is None:
+        dateEnd = pd.to_datetime("now")
+    weeks = pd.date_range(
+        start=get_last_sunday(pd.to_datetime(dateStart)),
+        end=dateEnd,
+        freq="W")
+    weekly = np.full((len(site_ids), len(weeks)), np.nan)
+
+    signals = [
+        (i, norm) for i, norm in enumerate(norms.values())
+        if norm is not None]
+    if signals:
+        codes = np.repeat(
+            [i for i, _ in signals], [len(norm) for _, norm in signals])
+        signal = pd.concat([norm for _, norm in signals])
+        times = signal.index.fillna(pd.Timestamp("2020-01-01"))
+        last_sunday = times - pd.to_timedelta(
+            (times.weekday + 1) % 7, unit="D")
+        medians = pd.Series(signal.to_numpy(dtype=float))\
+            .groupby([codes, last_sunday.normalize()]).median()
+        positions = weeks.get_indexer(medians.index.get_level_values(1))
+        in_range = positions >= 0
+        weekly[
+            medians.index.get_level_values(0)[in_range],
+            positions[in_range]] = medians.to_numpy()[in_range]
+
+    n_bins = np.minimum(
+        np.sum(~np.isnan(weekly), axis=1), len(colorscale) - 1)
+    classes = np.full(weekly.shape, "nan", dtype=object)
+    classes[n_bins == 0] = "0"
+    classes[n_bins == 1] = "1"
+    for n in np.unique(n_bins[n_bins > 1]):
+        classes[n_bins == n] = get_signal_classes(weekly[n_bins == n], n)
+    dates = weeks.strftime("%Y-%m-%d")
+    return {
+        site_id: dict(zip(dates, site_classes))
+        for site_id, site_classes in zip(site_ids, classes)}
 
 
 def get_color_ts(viral,
                  colorscale,
                  dateStart=DEFAULT_START_DATE,
                  dateEnd=None):
-    dateStart = pd.to_datetime(dateStart)
-    weekly = None
-    if viral is not None:
-        viral["last_sunday"] = viral.index.map(get_last_sunday)
-        weekly = viral.resample("W", on="last_sunday").median()
-
-    date_range_start = get_last_sunday(dateStart)
-    if dateEnd is None:
-        dateEnd = pd.to_datetime("now")
-    date_range = pd.date_range(start=date_range_start, end=dateEnd, freq="W")
-    result = pd.DataFrame(date_range)
-    result.columns = ["date"]
-    result.sort_values("date", inplace=True)
-
-    if weekly is None:
-        weekly = build_empty_color_ts(date_range)
-    weekly.sort_values("last_sunday", inplace=True)
-    result = pd.merge(
-        result,
-        weekly,
-        left_on="date",
-        right_on="last_sunday",
-        how="left")
-
-    n_bins = get_n_bins(result["norm"], colorscale)
-    if n_bins is None:
-        result["signal_strength"] = 0
-    elif n_bins == 1:
-        result["signal_strength"] = 1
-    else:
-        result["signal_strength"] = pd.cut(
-            result["norm"],
-            n_bins,
-            labels=range(1, n_bins+1))
-    result["signal_strength"] = result["signal_strength"].astype("str")
-    result.loc[result["signal_strength"].isna(), "signal_strength"] = "0"
-    result["date"] = result["date"].dt.strftime("%Y-%m-%d")
-    result.set_index("date", inplace=True)
-    return pd.Series(result["signal_strength"]).to_dict()
+    norm = None if viral is None else viral["norm"]
+    return get_color_ts_per_site(
+        {0: norm}, colorscale, dateStart, dateEnd)[0]
 
 
 def get_website_type(types):
@@ -557,6 +589,97 @@ def get_samples_to_plot(site_dataset, dateStart=None, dateEnd=None):
     return samples_to_plot
     
 
+def get_daily_site_datasets(combined, site_ids, site_index=None):
+    """Takes the datasets of the sites out of the combined dataset (see
+    utilities.build_site_specific_dataset) and resamples them per day,
+    all the sites in one pass. The datasets are in the order of
+    site_ids."""
+    if site_index is None:
+        site_index = utilities.SiteIndex(combined)
+    datasets = [
+        utilities.build_site_specific_dataset(combined, site_id, site_index)
+        for site_id in site_ids]
+    filled = [i for i, dataset in enumerate(datasets) if not dataset.empty]
+    if not filled:
+        return datasets
+    key = "siteID"
+    daily = utilities.resample_per_day(
+        pd.concat([datasets[i] for i in filled], keys=filled, names=[key])
+        .reset_index(key),
+        by=key)
+    positions = daily.index.get_level_values(key)
+    starts = np.searchsorted(positions, filled, side="left")
+    ends = np.searchsorted(positions, filled, side="right")
+    for i, start, end in zip(filled, starts, ends):
+        datasets[i] = daily.iloc[start:end].droplevel(key)
+    return datasets
+
+
+def build_site_website(
+        site_id,
+        daily_dataset,
+        dateStart=None,
+        dateEnd=None,
+        plot=False):
+    """Builds the website data of one site, from its daily dataset (see
+    get_daily_site_datasets). Runs in the worker processes of
+    build_sites_website.
+
+    With plot=True, the plot of the site is also written (see plot_web).
+
+    Returns a dict with the normalized viral signal ("norm", see
+    get_color_ts_per_site) and the "collection_method" of the site."""
+    samples = get_samples_to_plot(daily_dataset, dateStart, dateEnd)
+    viral = get_viral_timeseries(samples)
+    if plot:
+        plot_data, metadata = get_website_plot_data(
+            site_id, daily_dataset, samples, viral, dateStart)
+        if plot_data is not None and not plot_data.empty:
+            plot_web(
+                plot_data, metadata, dateStart=dateStart, langs=['french'])
+    return {
+        "norm": None if viral is None else viral["norm"],
+        "collection_method": website_collection_method(
+            get_cm_to_plot(samples, thresh_n=7)),
+    }
+
+
+def build_sites_website(
+        site_ids,
+        combined,
+        colorscale,
+        dateStart=None,
+        dateEnd=None,
+        site_index=None,
+        jobs=1,
+        plot=False):
+    """Runs build_site_website for several sites, over a pool of jobs
+    processes when jobs > 1. Only the daily rows of each site are sent to
+    the processes. The weekly colours of all the sites are then computed
+    together.
+
+    Returns the "date_color" and "collection_method" of each site, in
+    the order of site_ids."""
+    site_ids = list(site_ids)
+    datasets = get_daily_site_datasets(combined, site_ids, site_index)
+    args = [
+        site_ids, datasets, repeat(dateStart), repeat(dateEnd), repeat(plot)]
+    if jobs <= 1:
+        results = list(map(build_site_website, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(build_site_website, *args))
+    date_colors = get_color_ts_per_site(
+        {i: result["norm"] for i, result in enumerate(results)},
+        colorscale, dateStart, dateEnd)
+    return [
+        {
+            "date_color": date_colors[i],
+            "collection_method": result["collection_method"],
+        }
+        for i, result in enumerate(results)]
+
+
 def get_site_geoJSON(
         sites,
         combined,
@@ -564,30 +687,21 @@ def get_site_geoJSON(
         site_name,
         colorscale,
         dateStart=None,
-        dateEnd=None):
-
-    sites["dataset"] = sites.apply(
-        lambda row: utilities.build_site_specific_dataset(combined, row["siteID"]),
-        axis=1)
-    sites["dataset"] = sites.apply(
-        lambda row: utilities.resample_per_day(row['dataset']),
-        axis=1)
-    sites['samples'] = sites.apply(
-        lambda row: get_samples_to_plot(row['dataset'], dateStart, dateEnd),
-        axis=1)
-    sites["viral"] = sites.apply(
-        lambda row: get_viral_timeseries(row['samples']),
-        axis=1)
-    sites["date_color"] = sites.apply(
-        lambda row: get_color_ts(
-            row["viral"], colorscale, dateStart, dateEnd),
-        axis=1)
+        dateEnd=None,
+        site_index=None,
+        jobs=1,
+        plot=False):
+
+    results = build_sites_website(
+        sites["siteID"], combined, colorscale, dateStart, dateEnd,
+        site_index=site_index, jobs=jobs, plot=plot)
+    sites["date_color"] = [result["date_color"] for result in results]
+    sites["collection_method"] = [
+        result["collection_method"] for result in results]
 
     sites["clean_type"] = get_website_type(sites["type"])
     sites["municipality"] = sites['siteID'].apply(lambda x: get_municipality(x))
     sites["name"] = sites['name'].apply(lambda x: get_website_name(x))
-    sites['collection_method'] = sites.apply( lambda row: get_cm_to_plot(row['samples'], thresh_n=7), axis=1)
-    sites["collection_method"] = sites["collection_method"].apply(lambda x: website_collection_method(x))
     cols_to_keep = [
         "siteID",
         "name",
@@ -612,18 +726,11 @@ def get_site_geoJSON(
     return
 
 
-def build_polygon_geoJSON(store, poly_list, output_dir, name, types=None):
-    polys = store.get_polygon_geoJSON(types=types)
-    features = polys["features"]
-    for feature in features.copy():
-        props = feature["properties"]
-        poly_id = props["polygonID"]
-        if poly_id not in poly_list:
-            features.remove(feature)
-    polys["feature"] = features
+def build_polygon_geoJSON(
+        store, poly_list, output_dir, name, types=None, zoom=None):
     path = os.path.join(output_dir, name)
-    with open(path, "w") as f:
-        f.write(json.dumps(polys, indent=4))
+    store.to_polygon_geoJSON(
+        path, types=types, polygon_ids=poly_list, zoom=zoom)
 
 
 def load_files_from_folder(folder, extension):
@@ -651,11 +758,18 @@ def get_info_from_col(col, df):
     return None
 
 
-def centreau_website_data(combined, site_id, dateStart, dateEnd=None):
-    site_dataset = utilities.build_site_specific_dataset(combined, site_id)
+def centreau_website_data(
+        combined, site_id, dateStart, dateEnd=None, site_index=None):
+    site_dataset = utilities.build_site_specific_dataset(
+        combined, site_id, site_index)
     site_dataset = utilities.resample_per_day(site_dataset)
     samples = get_samples_to_plot(site_dataset, dateStart, dateEnd)
     viral = get_viral_timeseries(samples)
+    return get_website_plot_data(
+        site_id, site_dataset, samples, viral, dateStart)
+
+
+def get_website_plot_data(site_id, site_dataset, samples, viral, dateStart):
     if isinstance(viral, pd.DataFrame):
         if viral.empty:
             return None, None
@@ -826,6 +940,8 @@ if __name__ == "__main__":
     parser.add_argument('-dcty', '--datacities', type=str2list, default="qc-mtl-lvl-bsl", help='Cities for which to generate datasets for machine learning (default=qc)')  # noqa
     parser.add_argument('-web', '--website', type=str2bool, default=False, help="Build website files.")  # noqa
     parser.add_argument('-wcty', '--webcities', type=str2list, default="qc-mtl-lvl-bsl", help='Cities to display on the website')  # noqa
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes building the website files of the sites (default=1)')  # noqa
+    parser.add_argument('-mem', '--memory', type=str2bool, default=False, help='Log the memory used after each data import and each step of the combined dataset (default=False)')  # noqa
     args = parser.parse_args()
 
 
@@ -839,12 +955,16 @@ if __name__ == "__main__":
     dataset_cities = args.datacities
     web_cities = args.webcities
     short = args.short
+    memory_hook = None
+    if args.memory:
+        logging.basicConfig(level=logging.INFO)
+        memory_hook = odm.log_memory
 
     if not os.path.exists(CSV_FOLDER):
         raise ValueError(
             "CSV folder does not exist. Please modify config file.")
 
-    store = odm.Odm()
+    store = odm.Odm(memory_hook=memory_hook)
     print(source_cities)
     
     
@@ -867,19 +987,21 @@ if __name__ == "__main__":
             subfolder = os.path.join(
                 os.path.join(DATA_FOLDER, QC_CITY_SENSOR_FOLDER))
             files = load_files_from_folder(subfolder, "xls")
-            for file in files:
-                vdq_sensors = vdq_mapper.VdQSensorsMapper()
-                print("Parsing file " + file + "...")
-                vdq_sensors.read(os.path.join(subfolder, file))
-                store.append_from(vdq_sensors)
+            with store.bulk_load():
+                for file in files:
+                    vdq_sensors = vdq_mapper.VdQSensorsMapper()
+                    print("Parsing file " + file + "...")
+                    vdq_sensors.read(os.path.join(subfolder, file))
+                    store.append_from(vdq_sensors)
             print("Importing Quebec city lab data...")
             subfolder = os.path.join(DATA_FOLDER, QC_CITY_PLANT_FOLDER)
             files = load_files_from_folder(subfolder, "xls")
-            for file in files:
-                vdq_plant = vdq_mapper.VdQPlantMapper()
-                print("Parsing file " + file + "...")
-                vdq_plant.read(os.path.join(subfolder, file))
-                store.append_from(vdq_plant)
+            with store.bulk_load():
+                for file in files:
+                    vdq_plant = vdq_mapper.VdQPlantMapper()
+                    print("Parsing file " + file + "...")
+                    vdq_plant.read(os.path.join(subfolder, file))
+                    store.append_from(vdq_plant)
 
         if "mtl" in source_cities:
             print("Importing data from Montreal...")
@@ -892,8 +1014,7 @@ if __name__ == "__main__":
             print("Adding Quality Checks for mtl...")
             mtl_quality_checker = mcgill_mapper.QcChecker()
             
-            store.append_from(mcgill_lab)
-            store.append_from(poly_lab)
+            store.append_many([mcgill_lab, poly_lab])
             store = mtl_quality_checker.read_validation(store, MTL_LAB_DATA, MTL_QUALITY_SHEET_NAME)
 
 
@@ -924,6 +1045,12 @@ if __name__ == "__main__":
             public_health.read(INSPQ_DATA)
             store.append_from(public_health)
 
+        # The sites rarely move: keep the polygons found for each of them
+        # from the previous run, so that only new sites are located.
+        polygons_cache_path = os.path.join(CSV_FOLDER, SITE_POLYGONS_FILE)
+        if os.path.exists(polygons_cache_path):
+            utilities.load_containment_cache(polygons_cache_path)
+
         print("Removing older dataset...")
         for root, dirs, files in os.walk(CSV_FOLDER):
             for f in files:
@@ -941,6 +1068,7 @@ if __name__ == "__main__":
         print("Saving combined dataset...")
 
         combined = store.combine_dataset()
+        utilities.get_containment_cache().to_csv(polygons_cache_path)
         combined = utilities.typecast_wide_table(combined)
         combined_path = os.path.join(CSV_FOLDER, prefix+"_"+"combined.csv")
         combined.to_csv(combined_path, sep=",", index=False)
@@ -948,7 +1076,7 @@ if __name__ == "__main__":
 
     if not reload:
         print("Reading data back from csv...")
-        store = odm.Odm()
+        store = odm.Odm(memory_hook=memory_hook)
         from_csv = csv_folder_mapper.CsvFolderMapper()
         from_csv.read(CSV_FOLDER)
         store.append_from(from_csv)
@@ -980,28 +1108,24 @@ if __name__ == "__main__":
 
         city_filt = sites["siteID"].str.contains('|'.join(web_cities))
         sites = sites.loc[city_filt]
-        print("building site geojson...")
+        # The datasets of the sites are taken out of a single index
+        site_index = utilities.SiteIndex(combined)
+        print(f"building site geojson and plots with {args.jobs} job(s)...")
         get_site_geoJSON(
             sites,
             combined,
             SITE_OUTPUT_DIR,
             SITE_NAME,
             COLORS,
-            dateStart=DEFAULT_START_DATE)
+            dateStart=DEFAULT_START_DATE,
+            site_index=site_index,
+            jobs=args.jobs,
+            plot=True)
         print("building polygon geojson...")
         poly_list = sites["polygonID"].to_list()
         build_polygon_geoJSON(
-            store, poly_list, POLYGON_OUTPUT_DIR, POLY_NAME, POLYS_TO_EXTRACT)
-
-        for site_id in sites['siteID'].to_list():
-            print("building website plots for ", site_id, "...")
-            plot_data, metadata = centreau_website_data(combined, site_id, DEFAULT_START_DATE)
-            if isinstance(plot_data, pd.DataFrame):
-                if plot_data.empty:
-                    continue
-            elif not plot_data:
-                continue
-            plot_web(plot_data, metadata, dateStart=DEFAULT_START_DATE, langs=['french'])
+            store, poly_list, POLYGON_OUTPUT_DIR, POLY_NAME, POLYS_TO_EXTRACT,
+            zoom=POLY_ZOOM)
 
     if generate:
         date = datetime.now().strftime("%Y-%m-%d")
@@ -1011,13 +1135,14 @@ if __name__ == "__main__":
             dataset_cities.remove("bsl")
             dataset_cities.extend(BSL_CITIES)
         sites = store.site
+        site_index = utilities.SiteIndex(combined)
         for city in dataset_cities:
             filt_city = sites["siteID"].str.contains(city)
             site_type_filt = sites["type"].str.contains('|'.join(sitetypes))
             city_sites = sites.loc[filt_city & site_type_filt, "siteID"].dropna().unique()
-            for city_site in city_sites:
+            datasets = get_daily_site_datasets(
+                combined, city_sites, site_index)
+            for city_site, dataset in zip(city_sites, datasets):
                 print(f"Generating dataset for {city_site}")
-                dataset = utilities.build_site_specific_dataset(combined, city_site)
-                dataset = utilities.resample_per_day(dataset)
                 # dataset = dataset["2021-01-01":]
                 dataset.to_csv(os.path.join(CITY_OUTPUT_DIR, f"{city_site}.csv"))
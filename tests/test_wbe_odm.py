@@ -1,5 +1,24 @@
-from wbe_odm.odm import Odm
+import datetime
+import io
+import json
+import subprocess
+import sys
+
+import geomet.wkt
+from geojson_rewind import rewind
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import pipelines
+from wbe_odm import odm, odm_schema, utilities
+from wbe_odm.odm import (
+    Odm, OdmEncoder, TableCombiner, TableWidener, collapse_duplicate_keys,
+    upsert_table)
 from wbe_odm.odm_mappers.excel_template_mapper import ExcelTemplateMapper
+from wbe_odm.odm_mappers.serialized_mapper import SerializedMapper
+from wbe_odm.wbe_tools import visualization_helpers
 
 
 TEST_EXCEL_FILE = "tests/test_inputs/Ville de Quebec - All data - v1.1.xlsx"
@@ -7,6 +26,41 @@ TEST_EXCEL_FILE = "tests/test_inputs/Ville de Quebec - All data - v1.1.xlsx"
 TEST_DB = "tests/test_data/test_wbe.db"
 
 
+@pytest.fixture(scope="module")
+def excel_store():
+    """The store read from TEST_EXCEL_FILE, shared by the tests of the
+    module. Tests that change its tables work on copy_store()."""
+    mapper = ExcelTemplateMapper()
+    mapper.read(TEST_EXCEL_FILE)
+    store = Odm()
+    store.append_from(mapper)
+    return store
+
+
+def copy_store(store):
+    return Odm(**{attr: df.copy() for attr, df in store.tables().items()})
+
+
+def odm_table(table_name, **fields):
+    """A table with the fields of the schema, cast as by the mappers."""
+    df = pd.DataFrame(fields)\
+        .reindex(columns=utilities.get_table_fields(table_name))
+    return ExcelTemplateMapper().type_cast_table(table_name, df)
+
+
+def assert_incremental_matches_full(store):
+    combined = store.combine_dataset(incremental=True)
+    expected = Odm(**store.tables()).combine_dataset()\
+        .reset_index(drop=True)
+    assert list(combined.index) == list(range(len(combined)))
+    assert set(expected.columns) <= set(combined.columns)
+    extra = combined.columns.difference(expected.columns)
+    assert combined[extra].isna().all().all()
+    pd.testing.assert_frame_equal(
+        combined[expected.columns], expected, check_dtype=False)
+    return combined
+
+
 def test_samples_from_excel():
     # run with example excel data
     filename = TEST_EXCEL_FILE
@@ -17,3 +71,896 @@ def test_samples_from_excel():
     geo = odm_instance.get_polygon_geoJSON()
     samples = odm_instance.combine_dataset()
     return geo, samples, odm_instance
+
+
+def test_schema_is_loaded_once_from_snapshot():
+    schema = odm_schema.get_schema()
+    assert odm_schema.get_schema() is schema
+    assert schema.version == odm_schema.BUNDLED_SCHEMA_VERSION
+    assert "sampleID" in utilities.get_table_fields("Sample")
+    assert utilities.get_table_fields("CPHD") == \
+        utilities.get_table_fields("CovidPublicHealthData")
+    assert utilities.get_primary_key("WWMeasure") == "wwMeasureID"
+    assert utilities.get_primary_key()["SiteMeasure"] == "siteMeasureID"
+    types = utilities.get_data_types()
+    assert types["Sample"]["datetimestart"]["variableType"] == \
+        "datetime64[ns]"
+    assert types["Polygon"]["wkt"]["variableType"] == "string"
+
+
+def test_schema_can_be_refreshed_from_local_file(tmp_path):
+    path = tmp_path / "Variables.csv"
+    path.write_text(
+        "tableName,variableName,key,variableType\n"
+        "Sample,uSampleID,Primary Key,string\n"
+        "Sample,newField,,float\n")
+    try:
+        odm_schema.load_schema(str(path))
+        assert utilities.get_table_fields("Sample") == \
+            ["uSampleID", "newField"]
+        assert utilities.get_primary_key("Sample") == "sampleID"
+    finally:
+        odm_schema.load_schema()
+    assert "siteID" in utilities.get_table_fields("Sample")
+
+
+def test_import_has_no_side_effects():
+    code = (
+        "import wbe_odm.odm, wbe_odm.odm_mappers.excel_template_mapper\n"
+        "from wbe_odm import odm_schema\n"
+        "assert odm_schema._SCHEMA is None\n")
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_empty_tables_are_not_shared():
+    store1 = Odm()
+    store2 = Odm()
+    assert store1.sample is not store2.sample
+    assert "sampleID" in store1.sample.columns
+    mapper = ExcelTemplateMapper()
+    assert mapper.ww_measure.empty
+    assert "wwMeasureID" in mapper.ww_measure.columns
+    mapper.ww_measure = store1.ww_measure
+    assert mapper.ww_measure is store1.ww_measure
+
+
+def test_type_cast_table_uses_schema_types():
+    df = pd.DataFrame({
+        "sampleID": [" QC_01 ", "n/a", None, "QC_01"],
+        "dateTime": ["2021-02-01 10:00", "nd", "unknown", None],
+        "sizeL": ["1.5", "-", 2, None],
+        "shippedOnIce": ["Oui", "NO", "", "yes"],
+        "qualityFlag": ["YES", "n/a", "no", None],
+        "notAnOdmField": ["ABC", "none", "Unk", "x"],
+    })
+    cast = ExcelTemplateMapper().type_cast_table("Sample", df)
+    assert cast["sampleID"].to_list() == ["qc_01", "", "", "qc_01"]
+    assert cast["dateTime"].iloc[0] == pd.Timestamp("2021-02-01 10:00")
+    assert cast["dateTime"].iloc[1:].isna().all()
+    assert cast["sizeL"].iloc[0] == 1.5 and cast["sizeL"].iloc[2] == 2
+    assert cast["shippedOnIce"].to_list() == [True, False, True, True]
+    # Unknown quality flags are read as true, so the measures are left out
+    assert cast["qualityFlag"].to_list() == [True, True, False, True]
+    assert cast["notAnOdmField"].to_list() == ["abc", "", "", "x"]
+    assert list(cast.index) == list(df.index)
+
+
+def test_empty_tables_are_kept_by_the_mapper():
+    mapper = ExcelTemplateMapper()
+    assert mapper.sample is mapper.sample
+    mapper.sample.loc[0, "sampleID"] = "x"
+    assert mapper.sample["sampleID"].to_list() == ["x"]
+    assert ExcelTemplateMapper().sample.empty
+
+
+def test_compact_odm_keeps_combining_and_exporting(tmp_path, excel_store):
+    plain = excel_store
+    compact = Odm(compact=True)
+    compact.append_from(copy_store(plain))
+    compact.append_from(plain)
+
+    assert compact.ww_measure["type"].dtype.name == "category"
+    assert compact.ww_measure["value"].dtype == plain.ww_measure["value"].dtype
+    report = compact.compact_tables()
+    assert set(report.index) == set(plain.tables())
+    assert plain.ww_measure.memory_usage(deep=True).sum() \
+        > compact.ww_measure.memory_usage(deep=True).sum()
+
+    combined = compact.combine_dataset()
+    expected = plain.combine_dataset()
+    assert combined.shape == expected.shape
+
+    compact.to_csv(str(tmp_path), "compact")
+    assert (tmp_path / "compact_WWMeasure.csv").exists()
+    serialized = json.dumps(compact, cls=OdmEncoder)
+    decoded = SerializedMapper()
+    decoded.read(serialized)
+    assert len(decoded.ww_measure) == len(compact.ww_measure)
+
+
+def test_memory_usage_and_hook(excel_store):
+    stages = []
+    store = Odm(memory_hook=lambda stage, odm, df: stages.append(stage))
+    store.append_from(copy_store(excel_store))
+
+    usage = store.memory_usage()
+    assert usage.loc["ww_measure", "rows"] == len(store.ww_measure)
+    assert usage.loc["ww_measure", "bytes"] > 0
+    by_column = store.memory_usage(by_column=True)
+    assert by_column.loc["ww_measure"]["bytes"].sum() \
+        <= usage.loc["ww_measure", "bytes"]
+
+    combined = store.combine_dataset()
+    assert stages[0] == "append_from"
+    assert stages[-1] == "combine_cphd"
+    assert "agg_ww_measure_per_sample" in stages
+
+    combiner = TableCombiner(store)
+    combiner.combine_per_sample()
+    assert combiner.memory_usage().loc["combined", "rows"] == len(combined)
+
+
+def test_append_resolves_primary_key_conflicts():
+    old = pd.DataFrame({
+        "sampleID": ["a", "b", "c", ""],
+        "sizeL": [1.0, 2.0, np.nan, 9.0],
+        "notes": ["x", "kept", "z", ""],
+    })
+    new = pd.DataFrame({
+        "sampleID": ["b", "c", "d", "d"],
+        "sizeL": [5.0, 3.0, 4.0, 6.0],
+        "notes": ["", "w", "q", "q"],
+    })
+
+    # The two "d" rows of the new table conflict with each other too,
+    # the later one being the newer
+    combined, conflicts = upsert_table(old, new, "sampleID", "keep_new")
+    assert conflicts == ["d", "b", "c"]
+    assert combined["sampleID"].to_list() == ["a", "b", "c", "d", ""]
+    assert combined["sizeL"].to_list()[:4] == [1.0, 5.0, 3.0, 6.0]
+
+    combined, conflicts = upsert_table(old, new, "sampleID", "keep_old")
+    assert conflicts == ["d", "b", "c"]
+    kept = combined.set_index("sampleID")
+    assert kept.loc["b", "sizeL"] == 2.0
+    assert kept.loc["d", "sizeL"] == 4.0
+
+    combined, _ = upsert_table(old, new, "sampleID", "coalesce")
+    coalesced = combined.set_index("sampleID")
+    assert coalesced.loc["b", "sizeL"] == 5.0
+    assert coalesced.loc["b", "notes"] == "kept"
+    assert coalesced.loc["c", "notes"] == "w"
+    assert coalesced.loc["d", "sizeL"] == 6.0
+
+    with pytest.warns(UserWarning):
+        combined, _ = upsert_table(old, new, "sampleID", "warn")
+    assert combined.set_index("sampleID").loc["d", "sizeL"] == 6.0
+
+    store = Odm(sample=old, conflict_policy="keep_old")
+    store.combine_table_instances("Sample", store.sample, new)
+    assert store.conflicts["Sample"] == ["d", "b", "c"]
+
+    many = pd.DataFrame({"sampleID": list("abcdefgh"), "sizeL": 1.0})
+    with pytest.warns(UserWarning, match="^8 rows") as record:
+        upsert_table(many, many.assign(sizeL=2.0), "sampleID", "warn")
+    message = next(
+        str(w.message) for w in record if "8 rows" in str(w.message))
+    assert "a, b, c, d, e, ..." in message and "e, f" not in message
+
+    # Updated rows stay in place
+    old = pd.DataFrame({"sampleID": ["a", "b", "c"], "sizeL": [1.0, 2.0, 3.0]})
+    new = pd.DataFrame({"sampleID": ["a", "z"], "sizeL": [7.0, 8.0]})
+    for policy in ["keep_new", "keep_old", "coalesce"]:
+        combined, _ = upsert_table(old, new, "sampleID", policy)
+        assert combined["sampleID"].to_list() == ["a", "b", "c", "z"]
+    assert combined["sizeL"].to_list() == [7.0, 2.0, 3.0, 8.0]
+    repeated = pd.DataFrame({
+        "sampleID": ["a", "b", "a"], "sizeL": [1.0, 2.0, np.nan]})
+    for policy in ["keep_new", "coalesce"]:
+        collapsed, _ = collapse_duplicate_keys(repeated, "sampleID", policy)
+        assert collapsed["sampleID"].to_list() == ["a", "b"]
+    assert collapsed["sizeL"].to_list() == [1.0, 2.0]
+
+
+def test_append_many_matches_append_from():
+    parts = [
+        Odm(sample=pd.DataFrame({
+            "sampleID": [f"s{i}", f"s{i + 1}"],
+            "notes": [f"file {i}", f"file {i}"],
+        }))
+        for i in range(4)
+    ]
+    one_by_one = Odm()
+    for part in parts:
+        one_by_one.append_from(part)
+    batched = Odm()
+    batched.append_many(parts)
+    pd.testing.assert_frame_equal(
+        one_by_one.sample.sort_values("sampleID", ignore_index=True),
+        batched.sample.sort_values("sampleID", ignore_index=True))
+    assert batched.sample.set_index("sampleID").loc["s1", "notes"] == "file 1"
+    assert batched.conflicts["Sample"] == ["s1", "s2", "s3"]
+
+    bulk = Odm()
+    with bulk.bulk_load():
+        for part in parts:
+            bulk.append_from(part)
+        assert bulk.sample.empty
+    assert len(bulk.sample) == 5
+
+
+def test_failed_append_leaves_the_store_unchanged(monkeypatch):
+    store = Odm(
+        sample=pd.DataFrame({"sampleID": ["s1"], "notes": ["old"]}),
+        site=pd.DataFrame({"siteID": ["site_1"], "name": ["old"]}))
+    sample, site = store.sample, store.site
+    part = Odm(
+        sample=pd.DataFrame({"sampleID": ["s1", "s2"], "notes": ["new"] * 2}),
+        site=pd.DataFrame({"siteID": ["site_1"], "name": ["new"]}))
+    combine = Odm.combine_table_instances
+
+    def fail_on_sites(self, table_name, df1, df2, policy=None):
+        if table_name == "Site":
+            raise ValueError("cannot combine")
+        return combine(self, table_name, df1, df2, policy)
+    monkeypatch.setattr(Odm, "combine_table_instances", fail_on_sites)
+    with pytest.raises(ValueError):
+        store.append_many([part])
+    with pytest.raises(ValueError):
+        with store.bulk_load():
+            store.append_from(part)
+    assert store.sample is sample
+    assert store.site is site
+    assert store.conflicts == {}
+
+
+def test_reduce_groups_semantics():
+    df = pd.DataFrame({
+        "key": ["a", "a", "a", "b", "b", "c"],
+        "date": pd.to_datetime(
+            [None, "2021-01-02", "2021-01-03", "2021-01-04", None, None]),
+        "value": [1.0, 2.0, 6.0, np.nan, 4.0, np.nan],
+        "text": ["x", "nan", "x;y", "unknown", "", np.nan],
+        "other": ["y", "y", np.nan, "z", "z", "w"],
+    })
+    reduced = utilities.reduce_groups(df, "key")
+    assert list(reduced.index) == ["a", "b", "c"]
+    assert reduced.loc["a", "date"] == pd.Timestamp("2021-01-02")
+    assert reduced.loc["a", "value"] == 3.0
+    assert reduced.loc["a", "text"] == "x;x;y"
+    assert reduced.loc["b", "text"] == ""
+    assert pd.isna(reduced.loc["c", "text"])
+    assert reduced.loc["a", "other"] == "y"
+
+    pairwise = utilities.reduce_groups(df, "key", pairwise=True)
+    assert pairwise.loc["a", "value"] == 3.75
+
+    daily = utilities.resample_per_day(
+        df.dropna(subset=["date"]).set_index("date"))
+    assert len(daily) == 3
+    assert daily["value"].isna().to_list() == [False, False, True]
+
+
+def test_resample_per_day_handles_all_sites_in_one_pass():
+    df = pd.DataFrame({
+        "site": ["s2", "s1", "s1", "s2", "s1", None],
+        "value": [1.0, 2.0, 4.0, 3.0, np.nan, 9.0],
+        "text": ["a", "x", "y", "b", "x", "z"],
+    }, index=pd.DatetimeIndex(pd.to_datetime([
+        "2021-01-05 10:00", "2021-01-01 08:00", "2021-01-01 20:00",
+        "2021-01-07", "2021-01-03", "2021-01-01"]), name="timestamp"))
+    daily = utilities.resample_per_day(df, by="site")
+    assert daily.index.names == ["site", "timestamp"]
+    assert daily.index.get_level_values("site").tolist() \
+        == ["s1"] * 3 + ["s2"] * 3
+    for site, rows in df.groupby("site"):
+        pd.testing.assert_frame_equal(
+            daily.loc[site],
+            utilities.resample_per_day(rows.drop(columns=["site"])),
+            check_freq=False)
+    assert daily.loc[("s1", pd.Timestamp("2021-01-01")), "text"] == "x;y"
+
+    pairwise = utilities.resample_per_day(df, by="site", pairwise=True)
+    assert pairwise.index.names == ["site", "timestamp"]
+    assert len(pairwise) == 6
+
+
+def test_widen_spreads_features_by_qualifiers():
+    df = pd.DataFrame({
+        "sampleID": ["s1", "s1", "s2", "s2"],
+        "type": ["covN1", "covN1", "covN1", None],
+        "unit": ["gc/ml", "gc/ml", "gc/ml", "gc/ml"],
+        "aggregation": ["single", "single", "mean", "single"],
+        "value": [1.0, 3.0, 5.0, 7.0],
+    })
+    raw = df.copy()
+    wide = TableWidener(
+        df, ["value"], ["type", "unit", "aggregation"]).widen()
+    pd.testing.assert_frame_equal(df, raw)
+    assert list(wide.columns) == [
+        "sampleID",
+        "covn1_gcml_single-to-mean_value",
+        "covn1_gcml_mean_value",
+        "unknown-type_gcml_single-to-mean_value",
+    ]
+    np.testing.assert_array_equal(
+        wide["covn1_gcml_single-to-mean_value"], [1.0, 3.0, np.nan, np.nan])
+
+    aggregated = TableWidener(
+        df, ["value"], ["type", "unit", "aggregation"]
+    ).widen(agg=["max", "count"], index="sampleID")
+    assert aggregated.loc["s1", "covn1_gcml_single-to-max_value"] == 3.0
+    assert aggregated.loc["s1", "covn1_gcml_single-to-count_value"] == 2
+    assert aggregated.loc["s2", "covn1_gcml_mean-to-max_value"] == 5.0
+
+
+def test_parse_sample_repeats_samples_of_several_sites():
+    df = pd.DataFrame({
+        "sampleID": ["s1", "s2", "s3"],
+        "siteID": ["qc_01", "qc_02; qc_03;qc_02", "qc_04"],
+    })
+    parsed = TableCombiner(Odm()).parse_sample(df)
+    assert parsed["Sample_sampleID"].to_list() == ["s1", "s2", "s2", "s3"]
+    assert parsed["Sample_siteID"].to_list() == [
+        "qc_01", "qc_02", "qc_03", "qc_04"]
+    assert parsed["Calculated_explodedSample"].to_list() == [
+        False, False, True, False]
+    assert df["siteID"].iloc[1] == "qc_02; qc_03;qc_02"
+
+
+def test_polygon_list_uses_spatial_index():
+    polygons = pd.DataFrame({
+        "Polygon_polygonID": ["big", "small", "broken", "far"],
+        "Polygon_wkt": [
+            "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))",
+            "POLYGON ((1 1, 2 1, 2 2, 1 2, 1 1))",
+            "",
+            "POLYGON ((20 20, 30 20, 30 30, 20 30, 20 20))",
+        ],
+    })
+    merged = pd.DataFrame({
+        "Site_geoLong": [1.5, 5.0, 50.0, np.nan],
+        "Site_geoLat": [1.5, 5.0, 50.0, np.nan],
+    })
+    merged = TableCombiner(Odm()).get_polygon_list(merged, polygons)
+    assert merged["Calculated_polygonList"].to_list() == [
+        "big;small", "big", "", ""]
+    assert list(polygons.columns) == ["Polygon_polygonID", "Polygon_wkt"]
+
+
+def test_polygon_lists_are_cached_per_site(tmp_path, monkeypatch):
+    ids = ["big", "small"]
+    wkts = [
+        "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))",
+        "POLYGON ((1 1, 2 1, 2 2, 1 2, 1 1))",
+    ]
+    x = [1.5, 5.0, 1.5, np.nan, 5.0]
+    cache = utilities.ContainmentCache()
+    lists = utilities.get_encompassing_polygon_lists(x, x, ids, wkts, cache)
+    assert lists.tolist() == ["big;small", "big", "big;small", "", "big"]
+    assert len(cache.table) == 2
+
+    path = tmp_path / "SitePolygons.csv"
+    cache.to_csv(path)
+    cache = utilities.ContainmentCache.from_csv(path)
+
+    # Known sites are not located again.
+    def fail(wkt):
+        raise AssertionError("polygons should not be parsed")
+    monkeypatch.setattr(utilities, "convert_wkt", fail)
+    again = utilities.get_encompassing_polygon_lists(x, x, ids, wkts, cache)
+    assert again.tolist() == lists.tolist()
+
+    # Changing the polygons invalidates the cache.
+    monkeypatch.undo()
+    lists = utilities.get_encompassing_polygon_lists(
+        [1.5, 20.0], [1.5, 20.0], ids[:1], wkts[:1], cache)
+    assert lists.tolist() == ["big", ""]
+    assert len(cache.table) == 2
+
+
+def test_polygons_are_parsed_once(monkeypatch):
+    parsed = []
+    convert_wkt = utilities.convert_wkt
+
+    def counting_convert_wkt(wkt):
+        parsed.append(wkt)
+        return convert_wkt(wkt)
+    monkeypatch.setattr(utilities, "convert_wkt", counting_convert_wkt)
+    monkeypatch.setattr(
+        utilities, "_GEOMETRY_CACHE", utilities.GeometryCache())
+    polygons = pd.DataFrame({
+        "Polygon_polygonID": ["big", "small"],
+        "Polygon_wkt": [
+            "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))",
+            "POLYGON ((1 1, 2 1, 2 2, 1 2, 1 1))",
+        ],
+    })
+    cphd = pd.DataFrame({"CPHD_polygonID": ["small"]})
+    merged = pd.DataFrame({"Calculated_polygonList": ["big;small", "big"]})
+    merged = utilities.get_polygon_for_cphd(merged, polygons, cphd)
+    assert merged["Calculated_polygonIDForCPHD"].to_list() == ["small", None]
+    assert list(polygons.columns) == ["Polygon_polygonID", "Polygon_wkt"]
+
+    ranks = utilities.rank_polygons_by_desc_area(
+        polygons.rename(columns=lambda c: c.replace("Polygon_", "")))
+    assert ranks.to_list() == [1.0, 2.0]
+    utilities.get_encompassing_polygon_lists(
+        [1.5], [1.5], polygons["Polygon_polygonID"], polygons["Polygon_wkt"],
+        utilities.ContainmentCache())
+    geojson = utilities.convert_wkt_to_geojson(
+        polygons["Polygon_wkt"][1], "small")
+    assert geojson["type"] == "Polygon"
+    assert geojson["coordinates"][0][0] == [1.0, 1.0]
+    assert parsed == polygons["Polygon_wkt"].to_list()
+
+
+def test_geometry_cache_is_bounded():
+    cache = utilities.GeometryCache(maxsize=2)
+    square = "POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))"
+    first = cache.get("a", square)
+    assert cache.get("a", "POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))") is first
+    second = cache.get("b", square)
+    cache.get("a", square)
+    # "b" is the least recently used
+    cache.get("c", square)
+    assert len(cache) == 2
+    assert cache.get("a", square) is first
+    assert cache.get("b", square) is not second
+    assert cache.get("a", "POLYGON ((0 0, 2 0, 2 2, 0 2, 0 0))") is not first
+
+    # A pass over a larger table makes room for all of its polygons
+    ids = ["a", "b", "c", "d"]
+    parsed = cache.geometries(ids, [square] * 4)
+    assert cache.maxsize == 4
+    again = cache.geometries(ids, [square] * 4)
+    assert all(a is b for a, b in zip(again, parsed))
+
+
+def test_cached_geojson_can_be_modified():
+    cache = utilities.GeometryCache()
+    geometry = cache.get("a", "POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))")
+    for get in [
+            lambda: geometry.geojson,
+            lambda: geometry.simplified_geojson(0.1, 3),
+            lambda: utilities.convert_wkt_to_geojson(
+                "POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))", "a")]:
+        expected = get()
+        changed = get()
+        changed["properties"] = {}
+        changed["coordinates"][0][0][0] = 9.0
+        assert get() == expected
+        assert "properties" not in get()
+
+
+def test_cphd_polygon_is_the_smallest_with_data():
+    polygons = pd.DataFrame({
+        "Polygon_polygonID": ["big", "small", "mid", "broken"],
+        "Polygon_wkt": [
+            "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))",
+            "POLYGON ((1 1, 2 1, 2 2, 1 2, 1 1))",
+            "POLYGON ((0 0, 5 0, 5 5, 0 5, 0 0))",
+            "",
+        ],
+    })
+    cphd = pd.DataFrame({"CPHD_polygonID": ["big", "mid", "mid", "broken"]})
+    merged = pd.DataFrame({"Calculated_polygonList": [
+        "big;mid;small", "big", "small", "", np.nan, "broken;big",
+        "broken", "big;mid;small"]})
+    merged = utilities.get_polygon_for_cphd(merged, polygons, cphd)
+    assert merged["Calculated_polygonIDForCPHD"].to_list() == [
+        "mid", "big", None, None, None, "big", "broken", "mid"]
+
+
+def test_polygon_geojson_is_filtered_and_streamed(tmp_path):
+    store = Odm()
+    store.polygon = pd.DataFrame({
+        "polygonID": ["b", "a", "c", "d", "e"],
+        "name": ["B", None, "C", "D", "E"],
+        "type": ["swrCat", "hlthReg", "swrCat", "swrCat", "swrCat"],
+        "wkt": [
+            "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))",
+            "POLYGON ((1 1, 2 1, 2 2, 1 2, 1 1))",
+            "POLYGON ((0 0, 5 0, 5 5, 0 5, 0 0))",
+            "",
+            np.nan,
+        ],
+    })
+    geo = store.get_polygon_geoJSON()
+    assert [f["id"] for f in geo["features"]] == [1, 0, 2]
+    assert geo["features"][0]["properties"] == {
+        "polygonID": "a", "name": "null", "type": "hlthReg", "z": 3.0}
+    assert geo["features"][0]["geometry"]["type"] == "Polygon"
+
+    path = tmp_path / "polygons.geojson"
+    store.to_polygon_geoJSON(
+        str(path), types="swrcat", polygon_ids=["a", "c", "d", "e"])
+    text = path.read_text()
+    assert " " not in text
+    written = json.loads(text)
+    assert written["type"] == "FeatureCollection"
+    assert [f["properties"]["polygonID"] for f in written["features"]] == [
+        "c"]
+
+
+def test_polygon_geojson_winding_matches_rewind():
+    for wkt in [
+        "POLYGON ((0 0, 0 10, 10 10, 10 0, 0 0), (2 2, 4 2, 4 4, 2 4, 2 2))",
+        "MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)), ((5 5, 5 6, 6 6, 5 5)))",
+    ]:
+        expected = rewind(geomet.wkt.loads(wkt), rfc7946=False)
+        assert utilities.convert_wkt_to_geojson(wkt) == expected
+
+
+def test_polygon_geojson_can_be_simplified():
+    store = Odm()
+    circle = shapely.Point(-71.2, 46.8).buffer(0.1, quad_segs=256)
+    store.polygon = pd.DataFrame({
+        "polygonID": ["circle"],
+        "type": ["swrCat"],
+        "wkt": [circle.wkt],
+    })
+    full = store.get_polygon_geoJSON()["features"][0]["geometry"]
+    simple = store.get_polygon_geoJSON(zoom=8)["features"][0]["geometry"]
+    ring = simple["coordinates"][0]
+    assert len(ring) < len(full["coordinates"][0]) / 10
+    assert all(round(x, 4) == x for point in ring for x in point)
+    assert shapely.geometry.shape(simple).is_valid
+    assert shapely.geometry.shape(simple).area == pytest.approx(
+        circle.area, rel=0.05)
+    # Simplified outlines are cached per tolerance, and given as copies.
+    again = store.get_polygon_geoJSON(zoom=8)["features"][0]["geometry"]
+    assert again == simple and again is not simple
+    finer = store.get_polygon_geoJSON(
+        tolerance=1e-4)["features"][0]["geometry"]
+    assert len(finer["coordinates"][0]) > len(ring)
+    with pytest.raises(ValueError):
+        store.get_polygon_geoJSON(tolerance=0.01, zoom=8)
+
+
+def test_polygon_exports_embed_map_view():
+    store = Odm()
+    store.polygon = pd.DataFrame({
+        "polygonID": ["a", "b", "c"],
+        "type": ["swrCat", "swrCat", "swrCat"],
+        "wkt": [
+            "POLYGON ((-71.4 46.7, -71.2 46.7, -71.2 46.9, -71.4 46.9, "
+            "-71.4 46.7))",
+            "POLYGON ((-71.2 46.8, -71.0 46.8, -71.0 47.0, -71.2 47.0, "
+            "-71.2 46.8))",
+            "",
+        ],
+    })
+    geo = store.get_polygon_geoJSON()
+    assert geo["bbox"] == pytest.approx([-71.4, 46.7, -71.0, 47.0])
+    assert geo["view"]["center"] == pytest.approx(
+        {"lat": 46.85, "lon": -71.2})
+    assert geo["view"]["mapHeight"] == utilities.DEFAULT_MAP_HEIGHT_PX
+    assert 9 < geo["view"]["zoom"] < 10
+    assert utilities.get_mapbox_zoom_table() is \
+        utilities.get_mapbox_zoom_table()
+
+    buf = io.StringIO()
+    store.to_polygon_geoJSON(buf, polygon_ids=["a"])
+    written = json.loads(buf.getvalue())
+    assert written["bbox"] == pytest.approx([-71.4, 46.7, -71.2, 46.9])
+    view = store.get_polygon_view(polygon_ids=["a"])
+    assert written["bbox"] == view.pop("bbox")
+    assert written["view"] == view
+
+    assert visualization_helpers.get_map_center(geo) == geo["view"]["center"]
+    assert visualization_helpers.get_zoom_level(geo, 800) == \
+        geo["view"]["zoom"]
+    # Without the metadata, the same view is computed from the features.
+    bare = {"type": "FeatureCollection", "features": geo["features"]}
+    assert visualization_helpers.get_zoom_level(bare, 800) == \
+        pytest.approx(geo["view"]["zoom"])
+    assert visualization_helpers.get_zoom_level(geo, 400) < \
+        geo["view"]["zoom"]
+
+
+def test_incremental_combine_matches_full_rebuild(excel_store):
+    store = copy_store(excel_store)
+    assert_incremental_matches_full(store)
+    calls = []
+    original = store._recombine
+    store._recombine = lambda *args: calls.append(1) or original(*args)
+    # Nothing changed: the kept table is given back
+    assert_incremental_matches_full(store)
+
+    # Values changed in place and a sample removed
+    store.ww_measure.loc[store.ww_measure.index[:3], "value"] = 123.0
+    removed = store.sample["sampleID"].iloc[-1]
+    store.sample = store.sample.loc[store.sample["sampleID"] != removed]
+    store.ww_measure = store.ww_measure.loc[
+        store.ww_measure["sampleID"] != removed]
+    if not store.site_measure.empty:
+        store.site_measure.loc[store.site_measure.index[0], "value"] = 1.0
+    assert_incremental_matches_full(store)
+    assert len(calls) == 2
+
+    # Changing the reduction mode combines everything again
+    combined = store.combine_dataset(incremental=True, pairwise_reduction=True)
+    assert len(calls) == 2
+    assert np.array_equal(
+        combined.columns, store.combine_dataset(pairwise_reduction=True).columns)
+
+
+def test_incremental_combine_follows_sites_polygons_and_cphd():
+    days = pd.date_range("2021-01-01", periods=12, freq="D")
+    samples = [f"s{i}" for i in range(12)]
+    square = "POLYGON (({0} {0}, {1} {0}, {1} {1}, {0} {1}, {0} {0}))"
+    store = Odm(
+        sample=odm_table(
+            "Sample", sampleID=samples,
+            siteID=["qc_01", "qc_02", "qc_03"] * 2 + ["qc_04"] * 6,
+            collection="grb", dateTime=days),
+        ww_measure=odm_table(
+            "WWMeasure", wwMeasureID=[f"m{i}" for i in range(12)],
+            sampleID=samples, type="covN2", unit="gc/ml",
+            aggregation="single", value=np.arange(12.0)),
+        site=odm_table(
+            "Site", siteID=["qc_01", "qc_02", "qc_03", "qc_04"],
+            name=["a", "b", "c", "d"], geoLat=[1.5, 5.0, 25.0, 0.5],
+            geoLong=[1.5, 5.0, 25.0, 0.5],
+            polygonID=["p_small", "p_big", "p_far", "p_big"]),
+        site_measure=odm_table(
+            "SiteMeasure", siteMeasureID=["sm1", "sm2"],
+            siteID=["qc_01", "qc_03"], type="wwFlow", unit="m3/d",
+            aggregation="single", value=[10.0, 20.0], dateTime=days[1:3]),
+        polygon=odm_table(
+            "Polygon", polygonID=["p_big", "p_small", "p_far"],
+            name=["big", "small", "far"], type="swrCat",
+            wkt=[square.format(0, 10), square.format(1, 2),
+                 square.format(20, 30)]),
+        cphd=odm_table(
+            "CPHD", cphdID=["c1", "c2"], polygonID="p_big", type="conf",
+            dateType="report", date=days[:2], value=[3.0, 4.0]),
+    )
+    recombined = []
+    original = store._recombine
+    store._recombine = lambda *args: recombined.append(original(*args)) \
+        or recombined[-1]
+
+    def site_rows(combined, site_id, col):
+        return combined.loc[combined["Site_siteID"] == site_id, col].to_list()
+
+    # The first call combines everything
+    combined = store.combine_dataset(incremental=True)
+    assert site_rows(combined, "qc_02", "Calculated_polygonList") \
+        == ["p_big"] * 2
+    assert site_rows(combined, "qc_03", "Calculated_polygonIDForCPHD") \
+        == [None] * 2
+
+    # A site with samples moved to another place and polygon
+    store.site.loc[store.site["siteID"] == "qc_02", ["geoLat", "geoLong"]] \
+        = 1.5
+    store.site.loc[store.site["siteID"] == "qc_02", "polygonID"] = "p_small"
+    combined = assert_incremental_matches_full(store)
+    assert site_rows(combined, "qc_02", "Calculated_polygonList") \
+        == ["p_big;p_small"] * 2
+    assert site_rows(combined, "qc_02", "Site_polygonID") == ["p_small"] * 2
+
+    # A polygon grown over a site of another polygon
+    store.polygon.loc[store.polygon["polygonID"] == "p_small", "wkt"] = \
+        square.format(1, 30)
+    combined = assert_incremental_matches_full(store)
+    assert site_rows(combined, "qc_03", "Calculated_polygonList") \
+        == ["p_small;p_far"] * 2
+
+    # Public health data added for a polygon that had none
+    store.cphd = pd.concat([store.cphd, odm_table(
+        "CPHD", cphdID=["c3", "c4"], polygonID="p_far", type="conf",
+        dateType="report", date=days[:2], value=[5.0, 6.0])],
+        ignore_index=True)
+    combined = assert_incremental_matches_full(store)
+    assert site_rows(combined, "qc_03", "Calculated_polygonIDForCPHD") \
+        == ["p_far"] * 2
+    assert combined["CPHD_cphdID"].dropna().to_list() \
+        == ["c1", "c2", "c3", "c4"]
+    # Each change was spliced into the kept table
+    assert len(recombined) == 3
+    assert all(df is not None for df in recombined)
+
+
+def test_combine_dataset_projection_matches_full_combination(excel_store):
+    store = excel_store
+    full = store.combine_dataset()
+
+    combined = store.combine_dataset(
+        measures=["WQTURB", "wwflow"],
+        tables=["ww_measure", "site_measure", "site", "polygon"],
+        columns={"site": ["name"], "polygon": ["name"], "ww_measure": []})
+    assert not combined.filter(regex="wqtss|envrnf|CPHD").columns.any()
+    assert "Sewershed-Polygon_wkt" not in combined.columns
+    assert "WWMeasure_notes" not in combined.columns
+    assert "SiteMeasure_wwflow_m3d_single-to-mean_value" in combined.columns
+
+    is_sample = full["Sample_sampleID"].notna()
+    kept = [col for col in combined.columns if col in full.columns]
+    assert len(kept) == len(combined.columns)
+    pd.testing.assert_frame_equal(
+        combined.loc[combined["Sample_sampleID"].notna(), kept]
+        .reset_index(drop=True),
+        full.loc[is_sample, kept].reset_index(drop=True),
+        check_dtype=False)
+    # Only the site measures of the types asked for are left
+    flow = full["SiteMeasure_wwflow_m3d_single-to-mean_value"].notna()
+    assert combined["Sample_sampleID"].isna().sum() == flow.sum()
+
+    with pytest.raises(ValueError):
+        store.combine_dataset(tables=["lab"])
+    with pytest.raises(ValueError):
+        store.combine_dataset(measures={"sample": ["grb"]})
+
+
+def test_sample_intervals_and_timestamps():
+    ts = pd.Timestamp
+    df = pd.DataFrame({
+        "Sample_collection": ["grb", "cptp24h", "ps48h", "cpfp12h", "cptp24h"],
+        "Sample_dateTime": [ts("2021-03-02 10:30"), pd.NaT, pd.NaT,
+                            pd.NaT, pd.NaT],
+        "Sample_dateTimeStart": [pd.NaT, ts("2021-03-01 08:00"),
+                                 ts("2021-03-01"), pd.NaT, pd.NaT],
+        "Sample_dateTimeEnd": [pd.NaT, ts("2021-03-02 08:00"),
+                               ts("2021-03-03"), ts("2021-03-02 00:01"),
+                               pd.NaT],
+    })
+    assert utilities.get_composite_hours(df["Sample_collection"]).tolist()[1:4] \
+        == [24, 48, 12]
+    df = utilities.clean_grab_datetime(df)
+    assert df["Calculated_dateTimeStart"].iloc[0] == ts("2021-03-02")
+    df = utilities.clean_composite_data_intervals(df)
+    # Composites end at the midnight after their end time, and start
+    # whole days before it
+    assert df["Calculated_dateTimeEnd"].tolist()[1:4] == [
+        datetime.date(2021, 3, 3)] * 3
+    assert df["Calculated_dateTimeStart"].tolist()[1:4] == [
+        datetime.date(2021, 3, 2), datetime.date(2021, 3, 1),
+        datetime.date(2021, 3, 3)]
+    assert pd.isna(df["Calculated_dateTimeStart"].iloc[4])
+
+    df = TableCombiner.get_samples_timestamp(df)
+    assert df["Calculated_timestamp"].tolist()[:4] == [
+        ts("2021-03-02 10:30"), ts("2021-03-01 20:00"),
+        ts("2021-03-02"), ts("2021-03-02 00:01")]
+    assert pd.isna(df["Calculated_timestamp"].iloc[4])
+
+
+def test_site_index_takes_out_site_datasets():
+    ts = pd.Timestamp
+    combined = pd.DataFrame({
+        "Site_siteID": ["s1", None, "s2", None, None, None, "s1"],
+        "SiteMeasure_siteID": [None, "s1", None, None, None, None, None],
+        "CPHD_polygonID": [None, None, None, "P1", "p10", "p2", None],
+        "Calculated_polygonIDForCPHD": [
+            "p1", None, "p3", None, None, None, "p2"],
+        "Calculated_timestamp": [ts(f"2021-01-0{i + 1}") for i in range(7)],
+        "b": np.arange(7),
+        "a": list("abcdefg"),
+    })
+    index = utilities.SiteIndex(combined)
+    s1 = utilities.build_site_specific_dataset(combined, "s1", index)
+    # The site's rows, then the public health rows of its first sample's
+    # polygon, matched as earlier versions did ("p1" also matches "p10")
+    assert s1["b"].tolist() == [0, 1, 6, 3, 4]
+    assert list(s1.columns) == sorted(s1.columns)
+    assert s1.index.name == "Calculated_timestamp"
+    assert utilities.build_site_specific_dataset(combined, "s2")["b"]\
+        .tolist() == [2]
+    assert index.site_dataset("unknown").empty
+
+
+def test_long_layout_lists_measures_and_builds_wide_view(excel_store):
+    store = excel_store
+
+    long = store.combine_dataset(layout="long")
+    measures = long.measures
+    assert list(measures.columns) == odm.LONG_COLUMNS
+    assert measures["measure"].dtype.name == "category"
+    assert (measures["table"] == "SiteMeasure").sum() \
+        == len(store.site_measure)
+    known = store.ww_measure["sampleID"].isin(store.sample["sampleID"])
+    assert (measures["table"] == "WWMeasure").sum() == known.sum()
+    assert long._wide is None
+    pd.testing.assert_frame_equal(long.wide, store.combine_dataset())
+    assert long.wide is long.wide
+
+    # Averaging the measures of a sample gives the values of the wide table
+    ww = measures.loc[
+        (measures["table"] == "WWMeasure")
+        & (measures["aggregation"] == "single")].astype({
+            "measure": str, "unit": str, "aggregation": str})
+    means = ww.groupby(
+        ["sampleID", "measure", "unit"], observed=True)["value"].mean()
+    wide = long.wide.drop_duplicates("Sample_sampleID")\
+        .set_index("Sample_sampleID")
+    for (sample_id, measure, unit), value in means.iloc[:50].items():
+        label = f"{measure}_{unit}".lower().replace("/", "")
+        col = f"WWMeasure_{label}_single-to-mean_value"
+        assert wide.loc[sample_id, col] == pytest.approx(value)
+
+    flows = store.combine_dataset(
+        layout="long", tables=["site_measure"], measures=["wwflow"])
+    assert set(flows.measures["measure"]) == {"wwflow"}
+    with pytest.raises(ValueError):
+        store.combine_dataset(layout="long", incremental=True)
+    with pytest.raises(ValueError):
+        store.combine_dataset(layout="tall")
+
+
+def test_site_website_jobs_match_sequential_build(tmp_path):
+    days = pd.date_range("2021-01-01", periods=30, freq="D")
+    value = "WWMeasure_{}_gcml_single-to-mean_value"
+    flag = "WWMeasure_{}_gcml_single-to-mean_qualityFlag"
+    combined = pd.DataFrame({
+        "Calculated_timestamp": np.tile(days, 2),
+        "Site_siteID": np.repeat(["qc_01", "qc_02"], 30),
+        "Sample_collection": np.repeat(["grb", "cptp24h"], 30),
+        value.format("covn2"): np.arange(60.),
+        flag.format("covn2"): "False",
+        value.format("npmmov"): np.arange(60.) + 1,
+        flag.format("npmmov"): "False",
+    })
+    sites = pd.DataFrame({
+        "siteID": ["qc_01", "qc_02", "qc_03"],
+        "name": list(pipelines.sitename_lang_map)[:3],
+        "description": "",
+        "type": "wwtpmus",
+        "polygonID": "",
+        "geoLat": 46.8,
+        "geoLong": -71.2,
+    })
+    colors = pipelines.COLORS
+    sequential = pipelines.build_sites_website(
+        sites["siteID"], combined, colors, "2021-01-10", "2021-02-01")
+    parallel = pipelines.build_sites_website(
+        sites["siteID"], combined, colors, "2021-01-10", "2021-02-01",
+        jobs=2)
+    assert parallel == sequential
+    assert [r["collection_method"] for r in sequential] == [
+        pipelines.collection["grb"], pipelines.collection["cp"], ""]
+    # Weekly medians of covn2 / npmmov: 0.923, 0.95 and 0.96
+    assert sequential[0]["date_color"] == {
+        "2021-01-10": "1", "2021-01-17": "3", "2021-01-24": "3",
+        "2021-01-31": "nan"}
+    assert set(sequential[2]["date_color"].values()) == {"0"}
+
+    pipelines.get_site_geoJSON(
+        sites, combined, tmp_path, "sites.geojson", colors, "2021-01-10",
+        "2021-02-01", jobs=2)
+    with open(tmp_path / "sites.geojson") as f:
+        features = json.load(f)["features"]
+    assert [f["properties"]["date_color"] for f in features] \
+        == [r["date_color"] for r in sequential]
+
+
+def test_color_classes_of_all_sites():
+    days = pd.date_range("2021-01-03", periods=21, freq="D")
+    norms = {
+        "qc_01": pd.Series(np.repeat([1.0, 2.0, 4.0], 7), index=days),
+        "qc_02": None,
+        "qc_03": pd.Series([np.nan, 3.0], index=days[8:10]),
+        "qc_04": pd.Series(np.repeat([5.0, np.nan, 5.0], 7), index=days),
+        # Flat signals: the range is widened by 0.1% on each side
+        "qc_05": pd.Series(2.0, index=days),
+        "qc_06": pd.Series(np.repeat([-3.0, np.nan, -3.0], 7), index=days),
+        "qc_07": pd.Series(0.0, index=days),
+        # Medians on an edge are in the class below it
+        "qc_08": pd.Series(np.repeat([-2.0, 0.0, 4.0], 7), index=days),
+    }
+    colors = pipelines.COLORS
+    classes = pipelines.get_color_ts_per_site(
+        norms, colors, "2021-01-05", "2021-01-24")
+    weeks = ["2021-01-03", "2021-01-10", "2021-01-17", "2021-01-24"]
+    assert classes["qc_01"] == dict(zip(weeks, ["1", "1", "3", "nan"]))
+    assert classes["qc_02"] == dict.fromkeys(weeks, "0")
+    assert classes["qc_03"] == dict.fromkeys(weeks, "1")
+    assert classes["qc_04"] == dict(zip(weeks, ["1", "nan", "1", "nan"]))
+    assert classes["qc_05"] == dict(zip(weeks, ["2", "2", "2", "nan"]))
+    assert classes["qc_06"] == dict(zip(weeks, ["1", "nan", "1", "nan"]))
+    assert classes["qc_07"] == dict(zip(weeks, ["2", "2", "2", "nan"]))
+    assert classes["qc_08"] == dict(zip(weeks, ["1", "1", "3", "nan"]))
+    assert pipelines.get_color_ts(
+        norms["qc_05"].to_frame("norm"), colors, "2021-01-05",
+        "2021-01-24") == dict(zip(weeks, ["2", "2", "2", "nan"]))
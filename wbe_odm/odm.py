@@ -1,19 +1,76 @@
+import contextlib
 import json
+import logging
 import os
 import sqlite3
+import sys
+import warnings
 
 import numpy as np
 import pandas as pd
-import requests
-from shapely.geometry import Point
 
-from wbe_odm import utilities
-from wbe_odm.odm_mappers import base_mapper, csv_folder_mapper, mcgill_mapper
+from wbe_odm import odm_schema, utilities
+from wbe_odm.odm_mappers import base_mapper
 # Set pandas to raise en exception when using chained assignment,
 # as that may lead to values being set on a view of the data
 # instead of on the data itself.
 pd.options.mode.chained_assignment = 'raise'
 
+logger = logging.getLogger(__name__)
+
+# Ways of resolving rows of two tables that have the same primary key
+# (see upsert_table)
+CONFLICT_POLICIES = ["keep_new", "keep_old", "coalesce", "warn"]
+# Number of conflicting keys named in the warnings of upsert_table
+N_CONFLICTS_SHOWN = 5
+
+# Field of each table that tells which rows of the combined dataset
+# its rows feed (see Odm.combine_dataset with incremental=True)
+COMBINE_KEYS = {
+    "sample": "sampleID",
+    "ww_measure": "sampleID",
+    "site": "siteID",
+    "site_measure": "siteMeasureID",
+    "polygon": "polygonID",
+    "cphd": "cphdID",
+}
+# Tables that combine_dataset can combine with the samples
+COMBINED_TABLES = ["ww_measure", "site_measure", "site", "polygon", "cphd"]
+# Tables holding measures, told apart by their type
+MEASURE_TABLES = ["ww_measure", "site_measure", "cphd"]
+# Fields used to combine each table, which column projections always keep
+COMBINE_FIELDS = {
+    "sample": [
+        "sampleID", "siteID", "collection",
+        "dateTime", "dateTimeStart", "dateTimeEnd"],
+    "ww_measure": [
+        "sampleID", "type", "unit", "aggregation", "value", "qualityFlag"],
+    "site_measure": [
+        "siteMeasureID", "siteID", "dateTime",
+        "type", "unit", "aggregation", "value"],
+    "site": ["siteID", "geoLat", "geoLong", "polygonID"],
+    "polygon": ["polygonID", "wkt"],
+    "cphd": ["cphdID", "polygonID", "date", "type", "dateType", "value"],
+}
+# Columns of the long layout of combine_dataset
+LONG_COLUMNS = [
+    "timestamp", "siteID", "sampleID", "polygonID", "table", "measure",
+    "unit", "aggregation", "dateType", "value", "qualityFlag"]
+# Fields of the measure tables that give the long columns
+LONG_FIELDS = {
+    "ww_measure": {
+        "sampleID": "sampleID", "type": "measure", "unit": "unit",
+        "aggregation": "aggregation", "value": "value",
+        "qualityFlag": "qualityFlag"},
+    "site_measure": {
+        "dateTime": "timestamp", "siteID": "siteID", "type": "measure",
+        "unit": "unit", "aggregation": "aggregation", "value": "value",
+        "qualityFlag": "qualityFlag"},
+    "cphd": {
+        "date": "timestamp", "polygonID": "polygonID", "type": "measure",
+        "dateType": "dateType", "value": "value"},
+}
+
 
 class Odm:
     """Data class that holds the contents of the
@@ -21,40 +78,133 @@ class Odm:
     The tables are stored as pandas DataFrames. Utility
     functions are provided to manipulate the data for further analysis.
     """
+    # Mappers gathered by bulk_load
+    _pending_mappers = None
+    # Combined dataset and fingerprints of the tables it was built from,
+    # kept by combine_dataset(incremental=True)
+    _combine_state = None
+
     def __init__(
         self,
-        sample=pd.DataFrame(
-            columns=utilities.get_table_fields("Sample")),
-        ww_measure=pd.DataFrame(
-            columns=utilities.get_table_fields("WWMeasure")),
-        site=pd.DataFrame(
-            columns=utilities.get_table_fields("Site")),
-        site_measure=pd.DataFrame(
-            columns=utilities.get_table_fields("SiteMeasure")),
-        reporter=pd.DataFrame(
-            columns=utilities.get_table_fields("Reporter")),
-        lab=pd.DataFrame(
-            columns=utilities.get_table_fields("Lab")),
-        assay_method=pd.DataFrame(
-            columns=utilities.get_table_fields("AssayMethod")),
-        instrument=pd.DataFrame(
-            columns=utilities.get_table_fields("Instrument")),
-        polygon=pd.DataFrame(
-            columns=utilities.get_table_fields("Polygon")),
-        cphd=pd.DataFrame(
-            columns=utilities.get_table_fields("CPHD")),
+        sample=None,
+        ww_measure=None,
+        site=None,
+        site_measure=None,
+        reporter=None,
+        lab=None,
+        assay_method=None,
+        instrument=None,
+        polygon=None,
+        cphd=None,
+        compact=False,
+        memory_hook=None,
+        conflict_policy="keep_new",
             ) -> None:
+        """Tables that are not given start out empty.
+        Empty tables are only built when an Odm object is created,
+        and each object gets its own copy.
+
+        With compact=True, the categorical fields of the tables are stored
+        as pandas categoricals (see compact_tables) whenever data is
+        loaded into the object.
+
+        memory_hook is called as memory_hook(stage, odm, df) after each
+        call to append_from and after each stage of combine_dataset,
+        where df is the intermediate table of the stage, if any.
+        log_memory can be used to log the memory used at these points.
+
+        conflict_policy decides which values are kept when appended
+        rows have the same primary key as existing rows (see upsert_table).
+        The keys of such rows are kept in the conflicts attribute."""
+        self.sample = self._table_or_empty("Sample", sample)
+        self.ww_measure = self._table_or_empty("WWMeasure", ww_measure)
+        self.site = self._table_or_empty("Site", site)
+        self.site_measure = self._table_or_empty("SiteMeasure", site_measure)
+        self.reporter = self._table_or_empty("Reporter", reporter)
+        self.lab = self._table_or_empty("Lab", lab)
+        self.assay_method = self._table_or_empty("AssayMethod", assay_method)
+        self.instrument = self._table_or_empty("Instrument", instrument)
+        self.polygon = self._table_or_empty("Polygon", polygon)
+        self.cphd = self._table_or_empty("CPHD", cphd)
+        self.compact = compact
+        self.memory_hook = memory_hook
+        if conflict_policy not in CONFLICT_POLICIES:
+            raise ValueError(
+                f"Unknown conflict policy {conflict_policy}. "
+                f"Use one of {CONFLICT_POLICIES}.")
+        self.conflict_policy = conflict_policy
+        # {table_name: list of primary keys with conflicting values}
+        self.conflicts = {}
+        if compact:
+            self.compact_tables()
+
+    @staticmethod
+    def _table_or_empty(table_name, df):
+        if df is None:
+            return odm_schema.empty_table(table_name)
+        return df
+
+    def tables(self):
+        """Gets the tables held by the object.
+
+        Returns
+        -------
+        dict
+            {attribute_name: pd.DataFrame}
+        """
+        return {
+            attr: getattr(self, attr)
+            for attr in base_mapper.CONVERSION_DICT
+            if attr in self.__dict__
+        }
+
+    def memory_usage(self, by_column=False):
+        """Measures the memory used by each table, including the
+        contents of object columns.
+
+        Parameters
+        ----------
+        by_column : bool, optional
+            Whether to give the memory used by every column
+            instead of by every table, by default False
+
+        Returns
+        -------
+        pd.DataFrame
+            By table: the number of rows, columns and bytes,
+            indexed by table attribute name.
+            By column: the data type and number of bytes,
+            indexed by table attribute name and column name.
+        """
+        return table_memory_usage(self.tables(), by_column=by_column)
+
+    def _report_memory(self, stage, df=None):
+        if self.memory_hook is not None:
+            self.memory_hook(stage, self, df)
 
-        self.sample = sample
-        self.ww_measure = ww_measure
-        self.site = site
-        self.site_measure = site_measure
-        self.reporter = reporter
-        self.lab = lab
-        self.assay_method = assay_method
-        self.instrument = instrument
-        self.polygon = polygon
-        self.cphd = cphd
+    def compact_tables(self):
+        """Stores the categorical fields of every table (types, units,
+        aggregations, IDs of other tables...) as pandas categoricals.
+
+        Returns
+        -------
+        pd.DataFrame
+            Memory used by each table before and after, in bytes,
+            indexed by table attribute name.
+        """
+        report = {}
+        for attr, df in self.tables().items():
+            table_name = base_mapper.get_odm_names(attr)
+            compacted = base_mapper.compact_table(table_name, df)
+            setattr(self, attr, compacted)
+            bytes_before = df.memory_usage(deep=True).sum()
+            bytes_after = compacted.memory_usage(deep=True).sum()
+            report[attr] = [
+                bytes_before, bytes_after, bytes_before - bytes_after]
+        return pd.DataFrame.from_dict(
+            report,
+            orient="index",
+            columns=["bytes_before", "bytes_after", "bytes_saved"])
 
     def _default_value_by_dtype(
         self, dtype: str
@@ -80,45 +230,116 @@ class Odm:
         }
         return null_values.get(dtype, np.nan)
 
-    def combine_table_instances(self, table_name, df1, df2):
+    def combine_table_instances(self, table_name, df1, df2, policy=None):
+        """Adds the rows of df2 to df1. Rows with the same primary key
+        are resolved with the given policy, or the conflict policy of
+        the object by default (see upsert_table)."""
+        if policy is None:
+            policy = self.conflict_policy
         primary_key = utilities.get_primary_key(table_name)
-        df = df1.append(df2)
-        # This is way too slow, I'll have to find something else...
-        # df = df.groupby(primary_key).agg(utilities.reduce_with_warnings).reset_index()
-        df = df.drop_duplicates(subset=[primary_key])
+        df, conflicts = upsert_table(df1, df2, primary_key, policy)
+        self.conflicts[table_name] = conflicts
         return df
-    
+
     def append_from(self, mapper) -> None:
         """Concatenates the Odm object's current data with
         that of a mapper.
 
+        Inside a bulk_load block, the mapper is only validated and kept
+        aside: its data is added when the block ends.
+
         Parameters
         ----------
         mapper : odm_mappers.BaseMapper
             A mapper class implementing BaseMapper and adapted to one's
             specific use case
         """
+        self._validate_mapper(mapper)
+        if self._pending_mappers is not None:
+            self._pending_mappers.append(mapper)
+            return
+        self._append_mappers([mapper])
+        self._report_memory("append_from")
+        return
+
+    def append_many(self, mappers) -> None:
+        """Concatenates the Odm object's current data with that of
+        several mappers. Each table is concatenated and de-duplicated
+        once for all the mappers, instead of once per mapper as with
+        successive calls to append_from. Mappers later in the list are
+        considered newer when resolving primary key conflicts.
+
+        Parameters
+        ----------
+        mappers : list
+            Objects of the mapper class (see append_from)
+        """
+        mappers = list(mappers)
+        for mapper in mappers:
+            self._validate_mapper(mapper)
+        self._append_mappers(mappers)
+        self._report_memory("append_many")
+        return
+
+    @contextlib.contextmanager
+    def bulk_load(self):
+        """Context manager in which calls to append_from are gathered,
+        and applied with a single call to append_many when the block ends.
+        Nothing is added if the block raises an exception.
+
+        Examples
+        --------
+        >>> with store.bulk_load():
+        ...     for file in files:
+        ...         mapper = vdq_mapper.VdQSensorsMapper()
+        ...         mapper.read(file)
+        ...         store.append_from(mapper)
+        """
+        if self._pending_mappers is not None:
+            raise RuntimeError("A bulk load is already in progress")
+        self._pending_mappers = []
+        try:
+            yield self
+            mappers = self._pending_mappers
+        finally:
+            self._pending_mappers = None
+        self.append_many(mappers)
+
+    @staticmethod
+    def _validate_mapper(mapper):
         validates = True if isinstance(mapper, Odm) else mapper.validates()
         if not validates:
             raise ValueError("mapper object contains invalid data")
 
-        self_attrs = self.__dict__
-        for attr, current_df in self_attrs.items():
-            new_df = getattr(mapper, attr)
-            if current_df.empty:
-                setattr(self, attr, new_df)
-            elif new_df is None or new_df.empty:
-                continue
-            else:
-                try:
-                    table_name = base_mapper.get_odm_names(attr)
-                    combined = self.combine_table_instances(table_name, current_df, new_df)
-                    setattr(self, attr, combined)
-
-                except Exception as e:
-                    setattr(self, attr, current_df)
-                    raise e
-        return
+    def _append_mappers(self, mappers):
+        # The tables are only replaced once all of them are combined, so
+        # that an error leaves the object as it was
+        combined = {}
+        conflicts = dict(self.conflicts)
+        try:
+            for attr, current_df in self.tables().items():
+                new_dfs = [getattr(mapper, attr) for mapper in mappers]
+                new_dfs = [
+                    df for df in new_dfs if df is not None and not df.empty]
+                if not new_dfs:
+                    continue
+                if current_df.empty and len(new_dfs) == 1:
+                    combined[attr] = new_dfs[0]
+                    continue
+                new_df = pd.concat(new_dfs, ignore_index=True)
+                if current_df.empty:
+                    current_df = new_df.iloc[:0]
+                table_name = base_mapper.get_odm_names(attr)
+                combined[attr] = self.combine_table_instances(
+                    table_name, current_df, new_df)
+        except Exception:
+            self.conflicts = conflicts
+            raise
+        for attr, df in combined.items():
+            setattr(self, attr, df)
+        if self.compact:
+            # Appending tables with different categories gives object columns
+            self.compact_tables()
 
     def load_from(self, mapper: base_mapper.BaseMapper) -> None:
         """Reads an odm mapper object and loads the data into the Odm object.
@@ -131,59 +352,208 @@ class Odm:
 
         """
         if mapper.validates():
-            self_attrs = self.__dict__
             mapper_attrs = mapper.__dict__
-            for key in self_attrs.keys():
+            for key in self.tables():
                 if key not in mapper_attrs:
                     continue
                 new_df = mapper_attrs[key]
-                self_attrs[key] = new_df.drop_duplicates(
-                    keep="first", ignore_index=True)
+                setattr(self, key, new_df.drop_duplicates(
+                    keep="first", ignore_index=True))
+            if self.compact:
+                self.compact_tables()
 
     
-    def get_polygon_geoJSON(self, types=None) -> dict:
-        """[summary]
+    def get_polygon_geoJSON(
+        self,
+        types=None,
+        polygon_ids=None,
+        tolerance=None,
+        zoom=None,
+        precision=None
+    ) -> dict:
+        """Builds a GeoJSON FeatureCollection of the polygons.
 
         Args:
-            types ([type], optional): The types of polygons we want to plot.
-            Defaults to None, which actually takes everything.
+            types (str or list, optional): The types of polygons we want
+            to plot. Defaults to None, which actually takes everything.
+            polygon_ids (list-like, optional): The IDs of the polygons to
+            keep. Defaults to None, which keeps every polygon.
+            tolerance (float, optional): Simplify the outlines, moving
+            them by at most this distance (in degrees).
+            zoom (float, optional): Simplify the outlines for a web map
+            at this zoom level, instead of giving a tolerance.
+            precision (int, optional): Number of decimals kept in the
+            coordinates of simplified outlines. See
+            utilities.get_simplification for the defaults.
 
         Returns:
-            dict: [description]
+            dict: The FeatureCollection. The shapes are parsed once, in
+            the geometry cache (see utilities.GeometryCache), and each
+            call gives new geometries. When some polygons have a shape,
+            it also has a
+            "bbox" and a "view" member with the center and zoom level of
+            a map showing them all (see get_polygon_view).
         """
+        polygon_df = self._select_polygons(types, polygon_ids)
+        simplification = utilities.get_simplification(
+            tolerance, zoom, precision)
         geo = {
             "type": "FeatureCollection",
-            "features": []
+            "features": list(
+                self._polygon_features(polygon_df, simplification))
         }
+        geo.update(self._polygon_view_members(polygon_df))
+        return geo
+
+    def get_polygon_view(
+        self,
+        types=None,
+        polygon_ids=None,
+        map_height_px=utilities.DEFAULT_MAP_HEIGHT_PX
+    ):
+        """Describes how to frame the polygons on a map.
+
+        Args:
+            types (str or list, optional): The types of polygons to frame.
+            polygon_ids (list-like, optional): The IDs of the polygons to
+            frame.
+            map_height_px (int, optional): Height of the map, in pixels.
+
+        Returns:
+            dict: "bbox", "center", "zoom" and "mapHeight" (see
+            utilities.get_map_view), or None without any shape.
+        """
+        return self._polygon_view(
+            self._select_polygons(types, polygon_ids), map_height_px)
+
+    @staticmethod
+    def _polygon_view(
+            polygon_df, map_height_px=utilities.DEFAULT_MAP_HEIGHT_PX):
+        geometries = utilities.get_geometry_cache().geometries(
+            polygon_df["polygonID"], polygon_df["wkt"])
+        return utilities.get_map_view(geometries, map_height_px)
+
+    def _polygon_view_members(self, polygon_df):
+        view = self._polygon_view(polygon_df)
+        if view is None:
+            return {}
+        return {"bbox": view.pop("bbox"), "view": view}
+
+    def iter_polygon_features(
+        self,
+        types=None,
+        polygon_ids=None,
+        tolerance=None,
+        zoom=None,
+        precision=None
+    ):
+        """Generates the GeoJSON features of the polygons, ordered by ID.
+
+        The polygons are filtered by type and ID before their geometries
+        are converted. Polygons without WKT are skipped. The properties
+        of a feature are the columns of the polygon table other than the
+        WKT, plus "z", the rank of the polygon by descending area among
+        all the polygons (so that the smallest are drawn on top).
+
+        Args:
+            types (str or list, optional): The types of polygons to keep.
+            polygon_ids (list-like, optional): The IDs of the polygons
+            to keep.
+            tolerance, zoom, precision: How to simplify the outlines
+            (see get_polygon_geoJSON). Simplified outlines are cached
+            per tolerance and precision.
+
+        Returns:
+            generator: One feature (dict) per polygon, with the index of
+            the polygon in the table as "id".
+        """
+        simplification = utilities.get_simplification(
+            tolerance, zoom, precision)
+        polygon_df = self._select_polygons(types, polygon_ids)
+        return self._polygon_features(polygon_df, simplification)
+
+    def _select_polygons(self, types=None, polygon_ids=None):
         polygon_df = self.polygon.sort_values('polygonID')
-        polygon_df['z'] = utilities.rank_polygons_by_desc_area(polygon_df)
+        polygon_df = polygon_df.assign(
+            z=utilities.rank_polygons_by_desc_area(polygon_df))
+        keep = polygon_df["wkt"].fillna("").astype(str).str.strip()\
+            .ne("").to_numpy()
         if types is not None:
             if isinstance(types, str):
                 types = [types]
             types = [type_.lower() for type_ in types]
-            polygon_df = polygon_df.loc[
-                polygon_df["type"].str.lower().isin(types)
-            ].copy()
-        for col in polygon_df.columns:
-            is_cat = polygon_df[col].dtype.name == "category"
-            polygon_df[col] = polygon_df[col] if is_cat \
-                else polygon_df[col].fillna("null")
-        for i, row in polygon_df.iterrows():
-            if row["wkt"] != "":
-                new_feature = {
-                    "type": "Feature",
-                    "geometry": utilities.convert_wkt_to_geojson(
-                        row["wkt"]
-                    ),
-                    "properties": {
-                        col:
-                        row[col] for col in polygon_df.columns
-                            if "wkt" not in col
-                    },
-                    "id": i
-                }
-                geo["features"].append(new_feature)
-        return geo
+            keep &= polygon_df["type"].astype(str).str.lower().isin(types)\
+                .to_numpy()
+        if polygon_ids is not None:
+            keep &= polygon_df["polygonID"].isin(set(polygon_ids)).to_numpy()
+        return polygon_df.loc[keep]
+
+    @staticmethod
+    def _polygon_features(polygon_df, simplification):
+        properties = polygon_df[[
+            col for col in polygon_df.columns if "wkt" not in col
+        ]].astype(object).fillna("null").to_dict("records")
+        cache = utilities.get_geometry_cache()
+        cache.reserve(len(polygon_df))
+        for i, polygon_id, wkt, props in zip(
+                polygon_df.index,
+                polygon_df["polygonID"],
+                polygon_df["wkt"],
+                properties):
+            geometry = cache.get(polygon_id, wkt)
+            yield {
+                "type": "Feature",
+                "geometry": geometry.geojson if simplification is None
+                else geometry.simplified_geojson(*simplification),
+                "properties": props,
+                "id": i
+            }
+
+    def to_polygon_geoJSON(
+        self,
+        path_or_buf,
+        types=None,
+        polygon_ids=None,
+        compact=True,
+        tolerance=None,
+        zoom=None,
+        precision=None
+    ) -> None:
+        """Writes the polygons to a GeoJSON file, one feature at a time.
+
+        Args:
+            path_or_buf (str or file-like): Where to write.
+            types (str or list, optional): The types of polygons to keep.
+            polygon_ids (list-like, optional): The IDs of the polygons
+            to keep.
+            compact (bool, optional): Leave out all optional whitespace.
+            Defaults to True. Otherwise, features are indented.
+            tolerance, zoom, precision: How to simplify the outlines
+            (see get_polygon_geoJSON).
+
+        The "bbox" and "view" members of get_polygon_geoJSON are written
+        after the features.
+        """
+        dump_kwargs = {"separators": (",", ":")} if compact \
+            else {"indent": 4}
+        polygon_df = self._select_polygons(types, polygon_ids)
+        features = self._polygon_features(
+            polygon_df,
+            utilities.get_simplification(tolerance, zoom, precision))
+        with contextlib.ExitStack() as stack:
+            if isinstance(path_or_buf, (str, os.PathLike)):
+                path_or_buf = stack.enter_context(
+                    open(path_or_buf, "w", encoding="utf-8"))
+            path_or_buf.write('{"type":"FeatureCollection","features":[')
+            for n, feature in enumerate(features):
+                if n:
+                    path_or_buf.write(",")
+                path_or_buf.write(json.dumps(feature, **dump_kwargs))
+            path_or_buf.write("]")
+            for key, value in self._polygon_view_members(polygon_df).items():
+                path_or_buf.write(
+                    f',"{key}":{json.dumps(value, **dump_kwargs)}')
+            path_or_buf.write("}")
 
     def to_sqlite3(
         self,
@@ -191,7 +561,7 @@ class Odm:
         attrs_to_save: list = None,
             ) -> None:
         if attrs_to_save is None:
-            attrs = self.__dict__
+            attrs = self.tables()
             attrs_to_save = [
                 name for name, value in attrs.items()
                 if not value.empty
@@ -230,7 +600,7 @@ class Odm:
     ) -> None:
         if attrs_to_save is None:
             attrs_to_save = []
-            attrs = self.__dict__
+            attrs = self.tables()
             for name, df in attrs.items():
                 if df is None or df.empty:
                     continue
@@ -250,7 +620,7 @@ class Odm:
         return
 
     def append_odm(self, other_odm):
-        for attribute in self.__dict__:
+        for attribute in self.tables():
             other_value = getattr(other_odm, attribute)
             self.add_to_attr(attribute, other_value)
         return
@@ -258,8 +628,262 @@ class Odm:
     def add_to_attr(self, attribute, other_value):
         raise NotImplementedError()
 
-    def combine_dataset(self):
-        return TableCombiner(self).combine_per_sample()
+    def combine_dataset(
+            self, pairwise_reduction=False, incremental=False,
+            measures=None, tables=None, columns=None, layout="wide"):
+        """Combines the tables into a single wide table, with one row
+        per sample and site (see TableCombiner.combine_per_sample).
+
+        Parameters
+        ----------
+        pairwise_reduction : bool, optional
+            Reduce the measures of a sample pairwise, as in earlier
+            versions (see utilities.reduce_groups), by default False.
+        incremental : bool, optional
+            Keep the combined table and fingerprints of the rows it was
+            built from, by default False. The next incremental call
+            compares the tables to these fingerprints, whatever way they
+            were modified, and only recombines the samples, site measures
+            and public health rows that changed or depend on rows that
+            changed (their sites, polygons, or the polygons with public
+            health data). These are spliced into the kept table.
+        measures : list or dict, optional
+            Types of the measures to combine (ex. ["covn2", "npmmov"]),
+            whatever their case. A list applies to the WWMeasure,
+            SiteMeasure and CPHD tables, a dict to the tables it has
+            as keys ({"cphd": ["conf"]}). Other measures are left out
+            before the tables are widened. By default None, which
+            combines every measure.
+        tables : list, optional
+            Attributes of the tables to combine with the samples, among
+            COMBINED_TABLES. Without "cphd", no public health data nor
+            polygon is matched to the rows. By default None, which
+            combines every table.
+        columns : dict, optional
+            {table attribute: fields}, the fields of the tables to keep,
+            on top of those needed to combine them (see COMBINE_FIELDS).
+            For polygons, only the ID and these fields are merged with
+            the rows. By default None, which keeps every field.
+        layout : str, optional
+            "wide" (the default) or "long". The long layout gives a
+            LongDataset: one row per measure instead of one column per
+            type of measure, and the wide table built when it is first
+            used. It can't be incremental.
+
+        Returns
+        -------
+        pd.DataFrame or LongDataset
+            The combined table. Incremental calls give the same rows as
+            a full combination, in the same order but with a new index.
+            Their columns are those of the kept table, followed by new
+            ones: columns of measure types that disappear stay empty.
+        """
+        projection = combine_projection(measures, tables, columns)
+        if layout not in ["wide", "long"]:
+            raise ValueError(
+                f"Unknown layout {layout}. Use \"wide\" or \"long\".")
+        if layout == "long":
+            if incremental:
+                raise ValueError(
+                    "Incremental combinations use the wide layout.")
+            return self._combine_long(pairwise_reduction, projection)
+        if not incremental:
+            return TableCombiner(
+                self, pairwise_reduction=pairwise_reduction, **projection
+            ).combine_per_sample()
+        digests = {
+            attr: table_digests(getattr(self, attr), key)
+            for attr, key in COMBINE_KEYS.items()
+        }
+        cphd = project_table(
+            "cphd", self.cphd, projection["measures"], projection["columns"])
+        cphd_polygons = set(cphd["polygonID"].dropna()) \
+            if "polygonID" in cphd.columns \
+            and "cphd" in projection["tables"] else set()
+        combined = None
+        if self._can_recombine(digests, pairwise_reduction, projection):
+            combined = self._recombine(digests, cphd_polygons)
+        if combined is None:
+            combined = TableCombiner(
+                self, pairwise_reduction=pairwise_reduction, **projection
+            ).combine_per_sample()
+        self._combine_state = {
+            "combined": combined,
+            "digests": digests,
+            "cphd_polygons": cphd_polygons,
+            "pairwise_reduction": pairwise_reduction,
+            "projection": projection,
+        }
+        return combined.copy()
+
+    def _combine_long(self, pairwise_reduction, projection):
+        """Lists the measures of the tables that are combined, keyed by
+        time, site, sample and public health polygon (see LONG_COLUMNS).
+        The measures of samples are repeated for each of their sites, and
+        timed as in the wide layout."""
+        # The wide table is built from these tables when it's used
+        source = Odm(**self.tables(), memory_hook=self.memory_hook)
+        pieces = []
+        for attr, table_name in [
+                ("ww_measure", "WWMeasure"),
+                ("site_measure", "SiteMeasure"),
+                ("cphd", "CPHD")]:
+            if attr not in projection["tables"]:
+                continue
+            df = project_table(
+                attr, getattr(self, attr), projection["measures"], {})
+            fields = LONG_FIELDS[attr]
+            df = df[[field for field in fields if field in df.columns]]\
+                .rename(columns=fields)
+            if attr == "ww_measure":
+                df = pd.merge(
+                    df, get_sample_timestamps(self.sample), on="sampleID")
+            df["table"] = table_name
+            pieces.append(df)
+        if pieces:
+            measures = pd.concat(pieces, ignore_index=True)
+        else:
+            measures = pd.DataFrame()
+        measures = measures.reindex(columns=LONG_COLUMNS)
+        for col in LONG_COLUMNS:
+            if col not in ["timestamp", "value", "qualityFlag"]:
+                measures[col] = measures[col].astype("category")
+        measures["value"] = pd.to_numeric(measures["value"], errors="coerce")
+        self._report_memory("combine_long", measures)
+        return LongDataset(
+            measures,
+            lambda: TableCombiner(
+                source, pairwise_reduction=pairwise_reduction, **projection
+            ).combine_per_sample())
+
+    def _can_recombine(self, digests, pairwise_reduction, projection):
+        state = self._combine_state
+        if state is None or state["pairwise_reduction"] != pairwise_reduction:
+            return False
+        if state["projection"] != projection:
+            return False
+        if self.sample.empty:
+            return False
+        for attr, digest in digests.items():
+            # Empty tables change how the other ones are combined
+            if digest.empty != state["digests"][attr].empty:
+                return False
+            # Rows without an ID can't be told apart in the combined table
+            if digest.index.hasnans:
+                return False
+        return True
+
+    def _recombine(self, digests, cphd_polygons):
+        """Recombines the rows affected by changes to the tables, and
+        splices them into the kept combined table. Gives None when most
+        samples are affected, as combining everything is then faster."""
+        state = self._combine_state
+        previous = state["combined"]
+        dirty = {
+            attr: changed_keys(state["digests"][attr], digest)
+            for attr, digest in digests.items()
+        }
+        samples = set(dirty["sample"]) | set(dirty["ww_measure"])
+        sites = set(dirty["site"])
+        polygons = set(dirty["polygon"]) \
+            | (cphd_polygons ^ state["cphd_polygons"])
+        if dirty["polygon"] and not self.site.empty:
+            sites |= self._sites_with_new_polygons(previous)
+        sample_rows = previous["Sample_sampleID"].notna()
+        affected = previous["Sample_siteID"].isin(sites) \
+            if "Sample_siteID" in previous.columns \
+            else pd.Series(False, index=previous.index)
+        if polygons:
+            for col in ["Calculated_polygonList", "Site_polygonID"]:
+                if col not in previous.columns:
+                    continue
+                ids = previous[col].astype(str).str.split(";").explode()
+                affected |= ids.isin(polygons).groupby(level=0).any()
+        samples |= set(previous.loc[sample_rows & affected, "Sample_sampleID"])
+        site_measures = set(dirty["site_measure"])
+        cphd_rows = set(dirty["cphd"])
+        if not (samples or site_measures or cphd_rows):
+            return previous
+        if len(samples) > len(digests["sample"]) / 2:
+            return None
+
+        partial_samples = samples
+        if not samples:
+            # Combining works from the samples: one is added, then left out
+            partial_samples = {self.sample["sampleID"].iloc[0]}
+        partial = Odm(
+            sample=self.sample.loc[
+                self.sample["sampleID"].isin(partial_samples)],
+            ww_measure=self.ww_measure.loc[
+                self.ww_measure["sampleID"].isin(partial_samples)],
+            site=self.site,
+            polygon=self.polygon,
+            site_measure=self.site_measure.loc[
+                self.site_measure["siteMeasureID"].isin(site_measures)]
+            if site_measures else None,
+            cphd=self.cphd.loc[self.cphd["cphdID"].isin(cphd_rows)]
+            if cphd_rows else None,
+            memory_hook=self.memory_hook)
+        recombined = TableCombiner(
+            partial,
+            pairwise_reduction=state["pairwise_reduction"],
+            cphd_polygons=list(cphd_polygons),
+            **state["projection"]).combine_per_sample()
+
+        def rows_to_replace(df):
+            rows = df["Sample_sampleID"].isin(samples)
+            if "SiteMeasure_siteMeasureID" in df.columns:
+                rows |= df["SiteMeasure_siteMeasureID"].isin(site_measures)
+            if "CPHD_cphdID" in df.columns:
+                rows |= df["CPHD_cphdID"].isin(cphd_rows)
+            return rows
+        combined = pd.concat([
+            previous.loc[~rows_to_replace(previous)],
+            recombined.loc[rows_to_replace(recombined)],
+        ], ignore_index=True)
+        return self._order_combined_rows(combined)
+
+    def _sites_with_new_polygons(self, previous):
+        """Finds the sites whose list of polygons changes with
+        the current polygons."""
+        if self.polygon.empty or "Calculated_polygonList" not in previous:
+            return set()
+        site = self.site.drop_duplicates("siteID")
+        lists = pd.Series(
+            utilities.get_encompassing_polygon_lists(
+                pd.to_numeric(site["geoLong"], errors="coerce"),
+                pd.to_numeric(site["geoLat"], errors="coerce"),
+                self.polygon["polygonID"],
+                self.polygon["wkt"]),
+            index=site["siteID"].to_numpy())
+        old_lists = previous.dropna(subset=["Site_siteID"])\
+            .drop_duplicates("Site_siteID")\
+            .set_index("Site_siteID")["Calculated_polygonList"]
+        old_lists = old_lists.reindex(lists.index)
+        return set(lists.index[lists.ne(old_lists).to_numpy()])
+
+    def _order_combined_rows(self, combined):
+        """Puts the rows of a spliced combined table in the order of a
+        full combination: samples, site measures then public health
+        data, each in the order of its table."""
+        kinds = [
+            ("Sample_sampleID", self.sample["sampleID"]),
+            ("SiteMeasure_siteMeasureID", self.site_measure["siteMeasureID"]
+             if "siteMeasureID" in self.site_measure.columns else None),
+            ("CPHD_cphdID", self.cphd["cphdID"]
+             if "cphdID" in self.cphd.columns else None),
+        ]
+        kind = np.full(len(combined), len(kinds))
+        position = np.zeros(len(combined), dtype=int)
+        for i, (col, keys) in reversed(list(enumerate(kinds))):
+            if keys is None or col not in combined.columns:
+                continue
+            rows = combined[col].notna().to_numpy()
+            kind[rows] = i
+            position[rows] = pd.Index(keys.drop_duplicates())\
+                .get_indexer(combined.loc[rows, col])
+        order = np.lexsort((position, kind))
+        return combined.iloc[order].reset_index(drop=True)
 
 
 class TableWidener:
@@ -272,64 +896,192 @@ class TableWidener:
         self.wide = None
 
     def clean_qualifier_columns(self):
+        """Gets a copy of the table where missing qualifiers are replaced
+        by "unknown-<qualifier>", and qualifiers are lowercase
+        and without "/"."""
         qualifiers = self.qualifiers
         df = self.raw_df
         if df.empty:
             return df
+        df = df.copy()
         for qualifier in qualifiers:
-            filt1 = df[qualifier].isna()
-            filt2 = df[qualifier] == ""
-            df.loc[filt1 | filt2, qualifier] = f"unknown-{qualifier}"
-            df[qualifier] = df[qualifier].str.replace("/", "").str.lower()
-            if qualifier == "qualityFlag":
-                df[qualifier] = df[qualifier].str\
-                    .replace("True", "quality-issue")\
-                    .replace("False", "no-quality-issue")
+            # Qualifiers have few distinct values, which are cleaned once
+            df[qualifier] = base_mapper.map_unique_values(
+                df[qualifier].fillna(""),
+                lambda x, q=qualifier: self._clean_qualifier(x, q))
         return df
 
-    def widen(self, agg="mean"):
+    @staticmethod
+    def _clean_qualifier(uniques, qualifier):
+        uniques = uniques.where(uniques != "", f"unknown-{qualifier}")
+        uniques = uniques.str.replace("/", "", regex=False).str.lower()
+        if qualifier == "qualityFlag":
+            uniques = uniques.str\
+                .replace("True", "quality-issue")\
+                .replace("False", "no-quality-issue")
+        return uniques
+
+    def _column_qualifiers(self, df, agg):
+        """Gets the qualifier combination of each row.
+
+        Returns
+        -------
+        tuple(np.ndarray, list)
+            The code of the combination of each row, and the labels of
+            the combinations, in order of appearance. Labels join the
+            qualifiers with "_", single values being labelled as
+            aggregated with agg.
+        """
+        combos = df.groupby(self.qualifiers, sort=False).ngroup().to_numpy()
+        firsts = df[self.qualifiers].drop_duplicates().astype(str)
+        labels = firsts[self.qualifiers[0]].str.cat(
+            [firsts[qualifier] for qualifier in self.qualifiers[1:]],
+            sep="_")
+        labels = labels.str.replace("single", f"single-to-{agg}", regex=False)
+        # Distinct qualifiers can give the same label once converted
+        label_codes, labels = pd.factorize(labels)
+        return label_codes[combos], list(labels)
+
+    def widen(self, agg="mean", index=None):
         """Takes important characteristics inside a table (features) and
         creates new columns to store them based on the value of other columns
         (qualifiers).
 
+        The new columns are named <qualifier_1>_..._<qualifier_n>_<feature>,
+        ex. "covn1_gcml_single-to-mean_value". They are built with a
+        single pivot of every feature, rather than one mask per column.
+
+        Parameters
+        ----------
+        agg : str or list, optional
+            The aggregation used for single values, by default "mean".
+            "single" qualifiers are renamed "single-to-<agg>".
+            A list of aggregations (ex. ["mean", "max", "count", "std"])
+            is only accepted when index is given.
+        index : str, optional
+            A column to aggregate the features by, with every aggregation
+            of agg. By default None, which keeps one row per row of the
+            original table, with its value in the column matching its
+            qualifiers and NaN elsewhere. When several aggregations are
+            given, columns of qualifiers other than "single" are
+            renamed "<qualifiers>-to-<agg>_<feature>".
+
         Returns
         -------
         pd.DataFrame
             DataFrame with the original feature and qualifier columns removed
             and the features spread out over new columns named after the values
-            of the qualifier columns.
+            of the qualifier columns. When index is given, only the
+            new columns are kept, with one row per value of index.
         """
-        df = self.raw_df.copy()
-        if df.empty:
+        if self.raw_df.empty:
             return
         df = self.clean_qualifier_columns()
-        for qualifier in self.qualifiers:
-            df[qualifier] = df[qualifier].astype(str)
-            df[qualifier] = df[qualifier].str.replace("single", f"single-to-{agg}")
-        df["col_qualifiers"] = df[self.qualifiers].agg("_".join, axis=1)
-        unique_col_qualifiers = df["col_qualifiers"].unique()
-        for col_qualifier in unique_col_qualifiers:
-            for feature in self.features:
-                col_name = "_".join([col_qualifier, feature])
-                df[col_name] = np.nan
-                filt = df["col_qualifiers"] == col_qualifier
-                df.loc[filt, col_name] = df.loc[filt, feature]
-        df.drop(columns=self.features+self.qualifiers, inplace=True)
-        df.drop(columns=["col_qualifiers"], inplace=True)
-        self.wide = df.copy()
+        if index is not None:
+            self.wide = self._aggregate(df, agg, index)
+            return self.wide
+        if not isinstance(agg, str):
+            raise ValueError(
+                "Several aggregations can only be used with an index")
+
+        combos, labels = self._column_qualifiers(df, agg)
+        rows = np.arange(len(df))
+        pivots = []
+        for feature in self.features:
+            values = df[feature].to_numpy()
+            dtype = float if pd.api.types.is_numeric_dtype(df[feature]) \
+                and not pd.api.types.is_bool_dtype(df[feature]) else object
+            pivot = np.full((len(df), len(labels)), np.nan, dtype=dtype)
+            pivot[rows, combos] = values
+            pivots.append(pd.DataFrame(
+                pivot,
+                index=df.index,
+                columns=["_".join([label, feature]) for label in labels]))
+        wide_columns = [
+            "_".join([label, feature])
+            for label in labels
+            for feature in self.features
+        ]
+        df = df.drop(columns=self.features+self.qualifiers)
+        self.wide = pd.concat([df] + pivots, axis=1)[
+            list(df.columns) + wide_columns]
         return self.wide
 
+    def _aggregate(self, df, agg, index):
+        aggs = [agg] if isinstance(agg, str) else list(agg)
+        features = df[self.features].apply(
+            lambda x: x.astype(float) if pd.api.types.is_bool_dtype(x) else x)
+        aggregated = []
+        for func in aggs:
+            combos, labels = self._column_qualifiers(df, func)
+            labels = pd.Series(np.array(labels, dtype=object)[combos],
+                               index=df.index)
+            if len(aggs) > 1:
+                is_single = labels.str.contains(
+                    f"single-to-{func}", regex=False)
+                labels = labels.where(is_single, labels + f"-to-{func}")
+            wide = features.groupby([df[index], labels], sort=False)\
+                .agg(func)\
+                .unstack()
+            wide.columns = [
+                "_".join([label, feature]) for feature, label in wide.columns]
+            aggregated.append(wide)
+        wide = pd.concat(aggregated, axis=1)
+        return wide.reindex(sorted(wide.columns), axis=1)
+
 
 class TableCombiner(Odm):
     combined = None
+    memory_hook = None
+    pairwise_reduction = False
 
-    def __init__(self, source_odm):
-        self.ww_measure = self.parse_ww_measure(source_odm.ww_measure)
-        self.site_measure = self.parse_site_measure(source_odm.site_measure)
-        self.sample = self.parse_sample(source_odm.sample)
-        self.cphd = self.parse_cphd(source_odm.cphd)
-        self.polygon = self.parse_polygon(source_odm.polygon)
-        self.site = self.parse_site(source_odm.site)
+    def __init__(
+            self, source_odm, pairwise_reduction=False, cphd_polygons=None,
+            measures=None, tables=None, columns=None):
+        """With pairwise_reduction=True, measures of the same sample are
+        reduced pairwise, as in earlier versions (see
+        utilities.reduce_groups).
+
+        cphd_polygons are the IDs of the polygons that have public health
+        data. By default, those of the CPHD table that is combined.
+
+        measures, tables and columns restrict the measures, tables and
+        fields that are combined (see Odm.combine_dataset). They are
+        applied before the tables are parsed."""
+        self.memory_hook = getattr(source_odm, "memory_hook", None)
+        self.pairwise_reduction = pairwise_reduction
+        projection = combine_projection(measures, tables, columns)
+        self.measures = projection["measures"]
+        self.combined_tables = projection["tables"]
+        self.columns = projection["columns"]
+
+        def source(attr):
+            df = getattr(source_odm, attr)
+            if attr != "sample" and attr not in self.combined_tables:
+                df = df.iloc[:0]
+            # The parsers assign new values to the categorical
+            # columns of compact tables, so those are expanded first.
+            return base_mapper.expand_table(
+                project_table(attr, df, self.measures, self.columns))
+        self.ww_measure = self.parse_ww_measure(source("ww_measure"))
+        self.site_measure = self.parse_site_measure(source("site_measure"))
+        self.sample = self.parse_sample(source("sample"))
+        self.cphd = self.parse_cphd(source("cphd"))
+        self.polygon = self.parse_polygon(source("polygon"))
+        self.site = self.parse_site(source("site"))
+        if cphd_polygons is None:
+            cphd_polygons = self.cphd["CPHD_polygonID"].dropna().unique() \
+                if "CPHD_polygonID" in self.cphd.columns else []
+        self.cphd_polygons = cphd_polygons
+        self._report_memory("parse_tables")
+
+    def memory_usage(self, by_column=False):
+        """Measures the memory used by each parsed table and by the
+        combined table, once it is built. See Odm.memory_usage."""
+        tables = self.tables()
+        if self.combined is not None:
+            tables["combined"] = self.combined
+        return table_memory_usage(tables, by_column=by_column)
 
     def remove_access(self, df: pd.DataFrame) -> pd.DataFrame:
         """removes all columns that set access rights
@@ -374,7 +1126,7 @@ class TableCombiner(Odm):
                 "aggregation",
             ]
         wide = TableWidener(df, features, qualifiers).widen()
-        wide.drop(columns=["index"], inplace=True)
+        wide.drop(columns=["index"], inplace=True, errors="ignore")
         wide = wide.add_prefix("WWMeasure_")
         return wide
 
@@ -394,30 +1146,25 @@ class TableCombiner(Odm):
         return wide
 
     def parse_sample(self, df) -> pd.DataFrame:
+        """Prepares the Sample table for merging.
+
+        A sample can be relevant to several sites, in which case its
+        siteID field holds a ";"-separated list of site IDs. Such samples
+        are repeated once per distinct site, right after each other and
+        in the order of the list, so that every row has a single siteID.
+        The "Calculated_explodedSample" column is True for the rows added
+        that way.
+
+        Returns
+        -------
+        pd.DataFrame
+            The Sample table with its columns prefixed by "Sample_".
+        """
         if df.empty:
             return df
-        df_copy = df.copy(deep=True)
-
-        # we want the sample to show up in any site where it is relevant.
-        # Here, we gather all the siteIDs present in the siteID column for a
-        # given sample, and we spread them over additional new rows so that in
-        # the end, each row of the sample table has only one siteID
-        for i, row in df_copy.iterrows():
-            # Get the value of the siteID field
-            sites = row["siteID"]
-            # Check whether there are saveral ids in the field
-            if ";" in sites:
-                # Get all the site ids in the list
-                site_ids = {x.strip() for x in sites.split(";")}
-                # Assign one id to the original row
-                df["siteID"].iloc[i] = site_ids.pop()
-                # Create new rows for each additional siteID and assign them
-                # each a siteID
-                for site_id in site_ids:
-                    new_row = df.iloc[i].copy()
-                    new_row["siteID"] = site_id
-                    df = df.append(new_row, ignore_index=True)
+        df, exploded = explode_sample_sites(df)
         df = df.add_prefix("Sample_")
+        df["Calculated_explodedSample"] = exploded
         return df
 
     def parse_site(self, df) -> pd.DataFrame:
@@ -462,8 +1209,8 @@ class TableCombiner(Odm):
         """
         if ww.empty:
             return ww
-        return ww.groupby("WWMeasure_sampleID")\
-            .agg(utilities.reduce_by_type)
+        return utilities.reduce_groups(
+            ww, "WWMeasure_sampleID", pairwise=self.pairwise_reduction)
 
     def combine_ww_measure_and_sample(
         self,
@@ -514,22 +1261,40 @@ class TableCombiner(Odm):
 
     def get_polygon_list(self, merged, polygons):
         """
-            Adds a column called 'polygonIDs' containing a list
-            of polygons that pertain to a site
+            Adds a column called 'Calculated_polygonList' containing the
+            IDs of the polygons that contain each site, joined with ";".
+            Containment is computed once per distinct site location and
+            cached (see utilities.get_encompassing_polygon_lists).
         """
-        merged["temp_point"] = merged.apply(
-            lambda row: Point(
-                row["Site_geoLong"], row["Site_geoLat"]
-            ), axis=1)
-        polygons["shape"] = polygons["Polygon_wkt"].apply(
-            lambda x: utilities.convert_wkt(x))
-        merged["Calculated_polygonList"] = merged.apply(
-            lambda row: utilities.get_encompassing_polygons(
-                row, polygons), axis=1)
-        merged.drop(["temp_point"], axis=1, inplace=True)
-        polygons.drop(["shape"], axis=1, inplace=True)
+        if merged.empty:
+            return merged
+        if polygons.empty or "Site_geoLong" not in merged.columns:
+            merged["Calculated_polygonList"] = ""
+            return merged
+        merged["Calculated_polygonList"] = \
+            utilities.get_encompassing_polygon_lists(
+                pd.to_numeric(merged["Site_geoLong"], errors="coerce"),
+                pd.to_numeric(merged["Site_geoLat"], errors="coerce"),
+                polygons["Polygon_polygonID"],
+                polygons["Polygon_wkt"])
         return merged
 
+    def get_polygon_for_cphd(self, merged, polygons):
+        """Adds a column called 'Calculated_polygonIDForCPHD' with the
+        smallest polygon of each row's polygon list that has public
+        health data (see utilities.get_polygon_for_cphd)."""
+        cphd = pd.DataFrame({"CPHD_polygonID": self.cphd_polygons})
+        return utilities.get_polygon_for_cphd(merged, polygons, cphd)
+
+    def get_merged_polygon_fields(self, polygon):
+        """Gets the fields of the polygons to merge with the rows: all of
+        them, or their ID and the fields asked for in columns."""
+        if polygon.empty or "polygon" not in self.columns:
+            return polygon
+        fields = ["Polygon_polygonID"] + [
+            f"Polygon_{field}" for field in self.columns["polygon"]]
+        return polygon[[col for col in polygon.columns if col in fields]]
+
     def combine_cphd_polygon_sample(self,
                                     df: pd.DataFrame,
                                     polygon: pd.DataFrame) -> pd.DataFrame:
@@ -564,12 +1329,13 @@ class TableCombiner(Odm):
             "SiteMeasure_dateTime"]
         return site_measure
 
-    def get_samples_timestamp(self, df):
+    @staticmethod
+    def get_samples_timestamp(df):
         # grb -> "dateTime"
         # ps and cp -> if start and end are present: midpoint
         # ps and cp -> if only end is present: end
         df["Calculated_timestamp"] = pd.NaT
-        grb_filt = df["Sample_collection"].str.contains("grb")
+        grb_filt = utilities.is_grab_sample(df["Sample_collection"])
         s_filt = ~df["Sample_dateTimeStart"].isna()
         e_filt = ~df["Sample_dateTimeEnd"].isna()
 
@@ -580,18 +1346,18 @@ class TableCombiner(Odm):
         df.loc[grb_filt, "Sample_dateTimeEnd"] =\
             df.loc[grb_filt, "Sample_dateTime"]
 
-        df.loc[s_filt & e_filt, "Calculated_timestamp"] = df.apply(
-            lambda row: utilities.get_midpoint_time(
-                row["Sample_dateTimeStart"], row["Sample_dateTimeEnd"]
-            ),
-            axis=1
-        )
+        s_e_filt = s_filt & e_filt
+        df.loc[s_e_filt, "Calculated_timestamp"] = utilities.get_midpoint_times(
+            df.loc[s_e_filt, "Sample_dateTimeStart"],
+            df.loc[s_e_filt, "Sample_dateTimeEnd"])
         df.loc[
             e_filt & ~s_filt, "Calculated_timestamp"] = df.loc[
                 e_filt & ~s_filt, "Sample_dateTimeEnd"]
         return df
 
     def get_cphd_ts(self, df):
+        if df.empty:
+            return df
         df["Calculated_timestamp"] = df["CPHD_date"]
         return df
 
@@ -613,44 +1379,496 @@ class TableCombiner(Odm):
             DataFrame with each row representing a sample
         """
         agg_ww_measure = self.agg_ww_measure_per_sample(self.ww_measure)
+        self._report_memory("agg_ww_measure_per_sample", agg_ww_measure)
 
         samples = self.combine_ww_measure_and_sample(
             agg_ww_measure, self.sample)
+        self._report_memory("combine_ww_measure_and_sample", samples)
 
         # clean grab dates
         samples = utilities.clean_grab_datetime(samples)
         # clean composite dates
         samples = utilities.clean_composite_data_intervals(samples)
         samples = self.combine_site_sample(samples, self.site)
+        self._report_memory("combine_site_sample", samples)
         samples_ts = self.get_samples_timestamp(samples)
         if self.site_measure.empty:
             merged_s_sm = samples_ts
         else:
             site_measure_ts = self.get_site_measure_ts(self.site_measure)
             merged_s_sm = self.combine_site_measure(samples_ts, site_measure_ts)
+        self._report_memory("combine_site_measure", merged_s_sm)
 
         merged_s_sm = self.get_polygon_list(merged_s_sm, self.polygon)
-        merged_s_sm = utilities.get_polygon_for_cphd(
-            merged_s_sm, self.polygon, self.cphd)
-        merged_s_sm_p = self.combine_cphd_polygon_sample(
-            merged_s_sm, self.polygon)
+        merged_polygons = self.get_merged_polygon_fields(self.polygon)
+        if "cphd" in self.combined_tables:
+            merged_s_sm = self.get_polygon_for_cphd(merged_s_sm, self.polygon)
+            merged_s_sm = self.combine_cphd_polygon_sample(
+                merged_s_sm, merged_polygons)
         merged_s_sm_pp = self.combine_sewershed_polygon_sample(
-            merged_s_sm_p, self.polygon)
+            merged_s_sm, merged_polygons)
+        self._report_memory("combine_polygons", merged_s_sm_pp)
 
         cphd_ts = self.get_cphd_ts(self.cphd)
         merged_s_sm_pp_cphd = self.combine_cphd(merged_s_sm_pp, cphd_ts)
 
         merged_s_sm_pp_cphd.drop_duplicates(keep="first", inplace=True)
         self.combined = merged_s_sm_pp_cphd
+        self._report_memory("combine_cphd", merged_s_sm_pp_cphd)
         return merged_s_sm_pp_cphd
 
 
+def table_memory_usage(tables, by_column=False):
+    """Measures the memory used by tables, including the
+    contents of object columns.
+
+    Parameters
+    ----------
+    tables : dict
+        {table_name: pd.DataFrame}
+    by_column : bool, optional
+        Whether to give the memory used by every column
+        instead of by every table, by default False
+
+    Returns
+    -------
+    pd.DataFrame
+        By table: the number of rows, columns and bytes,
+        indexed by table name.
+        By column: the data type and number of bytes,
+        indexed by table name and column name.
+    """
+    if by_column:
+        usage = [
+            pd.DataFrame({
+                "table": name,
+                "column": df.columns,
+                "dtype": df.dtypes.astype(str).to_numpy(),
+                "bytes": df.memory_usage(index=False, deep=True).to_numpy(),
+            })
+            for name, df in tables.items()
+        ]
+        if not usage:
+            return pd.DataFrame(
+                columns=["table", "column", "dtype", "bytes"])\
+                .set_index(["table", "column"])
+        return pd.concat(usage).set_index(["table", "column"])
+    usage = {
+        name: [len(df), len(df.columns), df.memory_usage(deep=True).sum()]
+        for name, df in tables.items()
+    }
+    return pd.DataFrame.from_dict(
+        usage, orient="index", columns=["rows", "columns", "bytes"])
+
+
+class LongDataset:
+    """Combined dataset in a long layout, with one row per measure (see
+    Odm.combine_dataset).
+
+    The wide table of the same combination is only built when it is
+    first used. It is built from the tables as they were when the
+    dataset was combined, unless they were modified in place since.
+
+    Parameters
+    ----------
+    measures : pd.DataFrame
+        The measures, with the LONG_COLUMNS. Keys are categoricals.
+    build_wide : Callable[[], pd.DataFrame]
+        Builds the wide table.
+    """
+    def __init__(self, measures, build_wide):
+        self.measures = measures
+        self._build_wide = build_wide
+        self._wide = None
+
+    @property
+    def wide(self):
+        """The combined dataset in the wide layout, with one row per
+        sample and site (see TableCombiner.combine_per_sample)."""
+        if self._wide is None:
+            self._wide = self._build_wide()
+            self._build_wide = None
+        return self._wide
+
+
+def explode_sample_sites(df):
+    """Repeats the samples relevant to several sites once per site.
+
+    The siteID field of such samples holds a ";"-separated list of site
+    IDs. They are repeated once per distinct site, right after each
+    other and in the order of the list, so that every row has a single
+    siteID. Missing site IDs become "".
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The Sample table. It is not modified.
+
+    Returns
+    -------
+    tuple(pd.DataFrame, np.ndarray)
+        The samples, with a new index, and whether each row
+        was added to repeat a sample.
+    """
+    positions = np.arange(len(df))
+    site_ids = df["siteID"].fillna("").astype(str)
+    has_many = site_ids.str.contains(";", regex=False).to_numpy()
+
+    single = pd.Series(
+        site_ids.to_numpy()[~has_many], index=positions[~has_many])
+    many = pd.Series(
+        site_ids.to_numpy()[has_many], index=positions[has_many])\
+        .str.split(";")\
+        .explode()\
+        .str.strip()
+    many = many.loc[many != ""]
+    repeated = pd.MultiIndex.from_arrays([many.index, many]).duplicated()
+    many = many.loc[~repeated]
+    # Lists without any site ID keep a single row
+    siteless = np.setdiff1d(positions[has_many], many.index)
+    siteless = pd.Series("", index=siteless, dtype=object)
+
+    sites = pd.concat([single, many, siteless]).sort_index(kind="stable")
+    df = df.iloc[sites.index].reset_index(drop=True)
+    df["siteID"] = sites.to_numpy()
+    return df, sites.index.duplicated()
+
+
+def get_sample_timestamps(sample):
+    """Gets the site and timestamp of the samples, as in the wide layout
+    of combine_dataset.
+
+    Parameters
+    ----------
+    sample : pd.DataFrame
+        The Sample table. It is not modified.
+
+    Returns
+    -------
+    pd.DataFrame
+        The "sampleID", "siteID" and "timestamp" of each sample, repeated
+        for each of its sites. Samples without a site have a NaN siteID.
+    """
+    fields = [field for field in COMBINE_FIELDS["sample"]
+              if field in sample.columns]
+    df, _ = explode_sample_sites(base_mapper.expand_table(sample[fields]))
+    df = df.reindex(columns=COMBINE_FIELDS["sample"]).add_prefix("Sample_")
+    df = TableCombiner.get_samples_timestamp(df)
+    return pd.DataFrame({
+        "sampleID": df["Sample_sampleID"],
+        "siteID": df["Sample_siteID"].replace("", np.nan),
+        "timestamp": df["Calculated_timestamp"],
+    })
+
+
+def combine_projection(measures=None, tables=None, columns=None):
+    """Checks the measures, tables and columns given to combine_dataset,
+    and puts them in a form that can be compared.
+
+    Returns
+    -------
+    dict
+        {"measures": {table attribute: sorted lowercase types},
+        "tables": list of table attributes,
+        "columns": {table attribute: sorted fields}}
+    """
+    if measures is None:
+        measures = {}
+    elif not isinstance(measures, dict):
+        measures = {attr: measures for attr in MEASURE_TABLES}
+    tables = COMBINED_TABLES if tables is None else tables
+    columns = {} if columns is None else columns
+    for name, given, known in [
+            ("measure table", measures, MEASURE_TABLES),
+            ("table", tables, COMBINED_TABLES),
+            ("table", columns, list(COMBINE_FIELDS))]:
+        unknown = [attr for attr in given if attr not in known]
+        if unknown:
+            raise ValueError(
+                f"Unknown {name} {unknown}. Use some of {known}.")
+    return {
+        "measures": {
+            attr: sorted({str(type_).lower() for type_ in types})
+            for attr, types in measures.items()},
+        "tables": [attr for attr in COMBINED_TABLES if attr in tables],
+        "columns": {
+            attr: sorted(set(fields)) for attr, fields in columns.items()},
+    }
+
+
+def project_table(attr, df, measures, columns):
+    """Keeps the rows and fields of a table that a combination uses.
+
+    Parameters
+    ----------
+    attr : str
+        The attribute of the table (ex. "ww_measure").
+    df : pd.DataFrame
+        The table. It is not modified.
+    measures : dict
+        {table attribute: lowercase types of the measures to keep}.
+        Tables that aren't keys keep every row.
+    columns : dict
+        {table attribute: fields to keep on top of COMBINE_FIELDS}.
+        Tables that aren't keys keep every field.
+
+    Returns
+    -------
+    pd.DataFrame
+        The selected rows and fields, in the order of the table.
+    """
+    if attr in measures and "type" in df.columns:
+        wanted = set(measures[attr])
+        is_wanted = base_mapper.map_unique_values(
+            df["type"].astype(object).fillna(""),
+            lambda uniques: uniques.astype(str).str.lower().isin(wanted))
+        df = df.loc[is_wanted.to_numpy(dtype=bool)]
+    if attr in columns:
+        fields = set(COMBINE_FIELDS[attr]) | set(columns[attr])
+        df = df[[col for col in df.columns if col in fields]]
+    return df
+
+
+def table_digests(df, key):
+    """Fingerprints the rows of a table, grouped by a field.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The table.
+    key : str
+        The field to group the rows by.
+
+    Returns
+    -------
+    pd.Series
+        For each value of key, a hash of its rows that doesn't depend on
+        their order. Empty if the table doesn't have the field.
+    """
+    if df.empty or key not in df.columns:
+        return pd.Series(dtype="uint64")
+    hashes = pd.util.hash_pandas_object(
+        base_mapper.expand_table(df), index=False).to_numpy()
+    codes, keys = pd.factorize(df[key], sort=False)
+    if (codes < 0).any():
+        keys = keys.insert(len(keys), np.nan)
+        codes = np.where(codes < 0, len(keys) - 1, codes)
+    order = np.argsort(codes, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+    # Sums wrap around, which keeps them exact
+    digests = np.add.reduceat(hashes[order], starts)
+    counts = np.diff(np.r_[starts, len(order)]).astype("uint64")
+    return pd.Series(
+        digests ^ (counts * np.uint64(0x9E3779B97F4A7C15)),
+        index=keys[codes[order][starts]])
+
+
+def changed_keys(old, new):
+    """Lists the keys whose digests (see table_digests) were added,
+    removed or changed."""
+    both = old.index.intersection(new.index)
+    changed = both[old.loc[both].to_numpy() != new.loc[both].to_numpy()]
+    return old.index.difference(new.index)\
+        .union(new.index.difference(old.index))\
+        .union(changed)\
+        .to_list()
+
+
+def _missing_values(df):
+    """Finds null values, and empty strings in object columns."""
+    missing = df.isna()
+    for col in df.columns:
+        if df[col].dtype == object:
+            missing[col] = missing[col] | df[col].eq("")
+    return missing
+
+
+def _split_by_key(df, primary_key):
+    """Separates the rows that have a primary key from those that do not."""
+    has_key = ~_missing_values(df[[primary_key]])[primary_key]
+    return df.loc[has_key], df.loc[~has_key]
+
+
+def _replace_rows(df, rows, primary_key):
+    """Puts rows in place of the rows of a table that have the same
+    keys, keeping the order of the table. Keys are unique in both."""
+    positions = pd.Series(
+        np.arange(len(df)), index=df[primary_key].to_numpy())
+    is_replaced = df[primary_key].isin(rows[primary_key]).to_numpy()
+    kept = df.loc[~is_replaced].set_axis(np.flatnonzero(~is_replaced))
+    rows = rows.set_axis(positions.loc[rows[primary_key]].to_numpy())
+    return pd.concat([kept, rows]).sort_index(kind="stable")\
+        .reset_index(drop=True)
+
+
+def collapse_duplicate_keys(df, primary_key, policy="keep_new"):
+    """Keeps a single row per primary key in a table, resolving rows with
+    the same key with a policy. Later rows are considered newer.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        A table whose rows all have a primary key.
+    primary_key : str
+        The column identifying the rows.
+    policy : str, optional
+        One of CONFLICT_POLICIES (see upsert_table), by default "keep_new"
+
+    Returns
+    -------
+    tuple(pd.DataFrame, list)
+        The table without duplicate keys and the keys of rows that
+        have different values (ignoring missing values). The row kept
+        for a key takes the place of the first row with that key.
+    """
+    is_duplicate = df[primary_key].duplicated(keep=False)
+    if not is_duplicate.any():
+        return df, []
+    duplicates = base_mapper.expand_table(df.loc[is_duplicate])
+    duplicates = duplicates.mask(_missing_values(duplicates))
+    duplicates[primary_key] = df.loc[is_duplicate, primary_key]
+    n_values = duplicates.groupby(primary_key, sort=False).nunique()
+    conflicts = n_values.index[(n_values > 1).any(axis=1)].to_list()
+
+    firsts = df.drop_duplicates(subset=[primary_key], keep="first")
+    if policy == "keep_old":
+        return firsts, conflicts
+    elif policy == "coalesce":
+        # last() takes the last non-null value of each column
+        rows = duplicates.groupby(primary_key, sort=False)\
+            .last()\
+            .reset_index()[df.columns]
+    else:
+        rows = df.loc[is_duplicate]\
+            .drop_duplicates(subset=[primary_key], keep="last")
+    return _replace_rows(firsts, rows, primary_key), conflicts
+
+
+def upsert_table(old, new, primary_key, policy="keep_new"):
+    """Adds the rows of a table to another table of the same kind.
+    New keys are appended and existing keys are resolved with a policy.
+
+    Parameters
+    ----------
+    old : pd.DataFrame
+        The current table.
+    new : pd.DataFrame
+        The rows to add to it.
+    primary_key : str
+        The column identifying the rows.
+    policy : str, optional
+        What to do with rows whose key is in both tables,
+        by default "keep_new":
+        - "keep_new": the new row replaces the old one.
+        - "keep_old": the old row is kept.
+        - "coalesce": values of the new row replace those of the old row,
+          except where they are missing (null or empty string).
+        - "warn": same as "keep_new", but a warning lists the keys
+          whose values conflict.
+
+    Returns
+    -------
+    tuple(pd.DataFrame, list)
+        The combined table and the keys of rows that have different
+        values (ignoring missing values). Keys repeated within a table
+        are resolved the same way, later rows being newer.
+        Existing keys keep their place in the table, and new keys are
+        appended. Rows without a primary key are kept, without
+        duplicates.
+    """
+    if policy not in CONFLICT_POLICIES:
+        raise ValueError(
+            f"Unknown conflict policy {policy}. "
+            f"Use one of {CONFLICT_POLICIES}.")
+    if primary_key not in old.columns or primary_key not in new.columns:
+        combined = pd.concat([old, new], ignore_index=True)
+        return combined.drop_duplicates(ignore_index=True), []
+
+    old, old_keyless = _split_by_key(old, primary_key)
+    new, new_keyless = _split_by_key(new, primary_key)
+    keyless = pd.concat([old_keyless, new_keyless]).drop_duplicates()
+    old, old_conflicts = collapse_duplicate_keys(old, primary_key, policy)
+    new, new_conflicts = collapse_duplicate_keys(new, primary_key, policy)
+
+    old_is_updated = old[primary_key].isin(new[primary_key])
+    new_is_update = new[primary_key].isin(old[primary_key])
+    old_rows = base_mapper.expand_table(
+        old.loc[old_is_updated].set_index(primary_key))
+    new_rows = base_mapper.expand_table(
+        new.loc[new_is_update].set_index(primary_key))
+    new_rows = new_rows.reindex(old_rows.index)
+
+    shared = old_rows.columns.intersection(new_rows.columns)
+    old_values = old_rows[shared]
+    new_values = new_rows[shared]
+    differs = (old_values != new_values) \
+        & ~_missing_values(old_values) \
+        & ~_missing_values(new_values)
+    conflicts = old_rows.index[differs.any(axis=1)].to_list()
+    # Keys are listed once, in the order they are found
+    conflicts = list(dict.fromkeys(old_conflicts + new_conflicts + conflicts))
+
+    if policy == "keep_old":
+        updated = old.iloc[:0]
+    elif policy == "coalesce":
+        updated = new_rows.mask(_missing_values(new_rows))\
+            .combine_first(old_rows)\
+            .reset_index()
+        columns = new.columns.append(old.columns.difference(new.columns))
+        updated = updated[columns]
+    else:
+        updated = new.loc[new_is_update]
+        if policy == "warn" and conflicts:
+            shown = ", ".join(
+                str(key) for key in conflicts[:N_CONFLICTS_SHOWN])
+            more = ", ..." if len(conflicts) > N_CONFLICTS_SHOWN else ""
+            warnings.warn(
+                f"{len(conflicts)} rows with the same {primary_key} have "
+                f"different values. Keeping the new values for: "
+                f"{shown}{more} (see Odm.conflicts for the full list)")
+
+    combined = pd.concat([
+        _replace_rows(old, updated, primary_key),
+        new.loc[~new_is_update],
+        keyless,
+    ], ignore_index=True)
+    return combined, conflicts
+
+
+def get_peak_memory():
+    """Gets the peak resident memory of the current process, in bytes.
+    Returns None on platforms that do not provide it (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def log_memory(stage, odm, df=None):
+    """Memory hook of Odm objects that logs the peak memory of the
+    process, the memory used by the tables of the object and the
+    memory used by the intermediate table of the stage.
+    """
+    peak = get_peak_memory()
+    peak = "unknown" if peak is None else f"{peak / 2**20:.1f} MiB"
+    tables = odm.memory_usage()["bytes"].sum()
+    message = f"{stage}: peak memory {peak}, tables {tables / 2**20:.1f} MiB"
+    if df is not None:
+        df_bytes = df.memory_usage(deep=True).sum()
+        rows, cols = df.shape
+        message += f", {rows}x{cols} frame {df_bytes / 2**20:.1f} MiB"
+    logger.info(message)
+
+
 class OdmEncoder(json.JSONEncoder):
     def default(self, o):
         if (isinstance(o, Odm)):
             return {
                 '__{}__'.format(o.__class__.__name__):
-                o.__dict__
+                o.tables()
             }
         elif isinstance(o, pd.Timestamp):
             return {'__Timestamp__': str(o)}
@@ -664,6 +1882,8 @@ class OdmEncoder(json.JSONEncoder):
 
 
 def create_db(filepath=None):
+    # requests is slow to import and only needed here
+    import requests
     url = "https://raw.githubusercontent.com/Big-Life-Lab/covid-19-wastewater/dev/src/wbe_create_table_SQLITE_en.sql"  # noqa
     sql = requests.get(url).text
     conn = None
@@ -686,6 +1906,7 @@ def destroy_db(filepath):
 
 
 if __name__ == "__main__":
+    from wbe_odm.odm_mappers import mcgill_mapper
     mapper = mcgill_mapper.McGillMapper()
     lab_data = "/Users/jeandavidt/OneDrive - Université Laval/COVID/Latest Data/Input/CentrEau-COVID_Resultats_Quebec_final.xlsx" # noqa
     static_data = "/Users/jeandavidt/OneDrive - Université Laval/COVID/Latest Data/Input/CentrEAU-COVID_Static_Data.xlsx"  # noqa
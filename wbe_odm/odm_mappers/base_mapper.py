@@ -1,10 +1,10 @@
 from abc import ABC, abstractmethod
+import numpy as np
 import pandas as pd
 import re
-from wbe_odm import utilities
+from wbe_odm import odm_schema, utilities
 
 
-DATA_TYPES = utilities.get_data_types()
 UNKNOWN_TOKENS = [
     "nan",
     "na",
@@ -61,67 +61,288 @@ CONVERSION_DICT = {
 }
 
 
+def __getattr__(name):
+    # DATA_TYPES used to be read when the module was imported.
+    # It is now looked up in the schema registry on first use.
+    if name == "DATA_TYPES":
+        return utilities.get_data_types()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def replace_unknown_by_default(string, default):
     if re.fullmatch(utilities.UNKNOWN_REGEX, string):
         return default
     return string
 
 
-def parse_types(table_name, series):
-    variable_name = series.name.lower()
-    types = DATA_TYPES
-    lookup_table = types[table_name]
-    lookup_type = lookup_table.get(variable_name, dict())
-    desired_type = lookup_type.get("variableType", "string")
+def map_unique_values(series, func):
+    """Applies a vectorized function to the distinct values of a series
+    and broadcasts the results back to every row.
+
+    ODM columns hold few distinct values compared to their length
+    (types, units, dates, yes/no flags...), so working on the distinct
+    values avoids repeating the same conversion for each row.
+
+    Parameters
+    ----------
+    series : pd.Series
+        The series to convert. It must not contain null values.
+    func : Callable[[pd.Series], pd.Series]
+        Function converting a series of distinct values.
+
+    Returns
+    -------
+    pd.Series
+        The converted series, with the index and name of the original.
+    """
+    codes, uniques = pd.factorize(series)
+    converted = func(pd.Series(uniques, dtype=object))
+    result = converted.take(codes)
+    result.index = series.index
+    result.name = series.name
+    return result
+
+
+def is_unknown(uniques):
+    """Vectorized check of the values that utilities.UNKNOWN_REGEX matches
+    completely. Those values are either empty or start with "n", "u" or
+    "-", so the regex only runs on values that start that way."""
+    first_char = uniques.str[:1].str.lower()
+    candidates = first_char.isin(["", "n", "u", "-"]).to_numpy()
+    unknown = np.zeros(len(uniques), dtype=bool)
+    unknown[candidates] = uniques[candidates].str.fullmatch(
+        utilities.UNKNOWN_REGEX).to_numpy(dtype=bool)
+    return unknown
+
+
+def clean_text(uniques, default="", lower=True):
+    uniques = uniques.str.strip()
+    uniques = uniques.mask(is_unknown(uniques), default)
+    if lower:
+        uniques = uniques.str.lower()
+    return uniques
+
+
+def text_to_bool(uniques, default="true"):
+    uniques = clean_text(uniques, default=default)
+    uniques = uniques.str.replace("oui", "true", regex=False)
+    uniques = uniques.str.replace("yes", "true", regex=False)
+    return uniques.str.startswith("true").astype("bool")
+
+
+def text_to_datetime(uniques):
+    uniques = clean_text(uniques, lower=False)
+    return pd.to_datetime(uniques, errors="coerce")
+
+
+def cast_to_bool(series, default="true"):
+    return map_unique_values(
+        series.astype(str),
+        lambda x: text_to_bool(x, default)).astype("bool")
+
+
+def cast_to_string(series, lower=True):
+    return map_unique_values(
+        series.astype(str),
+        lambda x: clean_text(x, lower=lower))
+
+
+def cast_to_datetime(series):
+    return map_unique_values(series.astype(str), text_to_datetime)
+
+
+def cast_to_numeric(series):
+    return pd.to_numeric(series, errors="coerce")
+
+
+def compile_caster(variable_name, desired_type):
+    """Picks the function used to cast a column to its ODM data type.
+
+    Parameters
+    ----------
+    variable_name : str
+        Lowercase name of the column.
+    desired_type : str
+        pandas data type of the column in the ODM.
+
+    Returns
+    -------
+    Callable[[pd.Series], pd.Series] or None
+        The cast to apply, or None if the column is kept as is.
+    """
     if desired_type == "bool":
-        series = series.astype(str)
-        default_bool = "false" if "qualityFlag" in variable_name else "true"
-        series = series.str.strip().str.lower()
-        series = series.apply(
-            lambda x: replace_unknown_by_default(x, default_bool))
-        series = series.str.replace("oui", "true", case=False)
-        series = series.str.replace("yes", "true", case=False)
-        series = series.str.startswith("true")
-        series = series.astype("bool")
+        # Unknown values are read as true, quality flags included
+        return cast_to_bool
     elif desired_type in ["string", "category"]:
-        series = series.astype(str)
-        series = series.str.strip()
-        series = series.apply(lambda x: replace_unknown_by_default(x, ""))
-        if variable_name != "wkt":
-            series = series.str.lower()
+        lower = variable_name != "wkt"
+        return lambda x: cast_to_string(x, lower)
     elif desired_type == "datetime64[ns]":
-        series = series.astype(str)
-        series = series.apply(lambda x: replace_unknown_by_default(x, ""))
-        series = pd.to_datetime(series, errors="coerce")
+        return cast_to_datetime
     elif desired_type in ["int64", "float64"]:
-        series = pd.to_numeric(series, errors="coerce")
+        return cast_to_numeric
+    return None
+
+
+class CastPlan:
+    """Casts the columns of an ODM table to the data types
+    defined in the ODM schema.
+
+    The cast of every column described by the schema is decided once,
+    when the plan is built. Columns that the schema does not describe
+    are treated as strings.
+
+    Parameters
+    ----------
+    table_name : str
+        Name of the table in the ODM (ex. "WWMeasure")
+    table_types : dict
+        {variable_name: {"variableType": dtype}} for the table, as given by
+        utilities.get_data_types()
+    """
+    def __init__(self, table_name, table_types):
+        self.table_name = table_name
+        self.casters = {
+            name: compile_caster(name, lookup.get("variableType", "string"))
+            for name, lookup in table_types.items()
+        }
+
+    def get_caster(self, column):
+        name = str(column).lower()
+        if name not in self.casters:
+            self.casters[name] = compile_caster(name, "string")
+        return self.casters[name]
+
+    def cast_series(self, series):
+        caster = self.get_caster(series.name)
+        if caster is None:
+            return series
+        return caster(series)
+
+    def cast(self, df):
+        if df.columns.empty:
+            return df.copy()
+        # Every cast column keeps the index of df,
+        # so they are put side by side without aligning them.
+        return pd.concat(
+            [self.cast_series(df[column]) for column in df.columns],
+            axis=1)
+
+
+_CAST_PLANS = {"schema": None, "plans": {}}
+
+
+def get_cast_plan(table_name):
+    """Gets the cast plan of a table, building it on first use.
+    Plans are rebuilt when the schema is replaced."""
+    schema = odm_schema.get_schema()
+    if _CAST_PLANS["schema"] is not schema:
+        _CAST_PLANS["schema"] = schema
+        _CAST_PLANS["plans"] = {}
+    plans = _CAST_PLANS["plans"]
+    if table_name not in plans:
+        table_types = schema.data_types().get(table_name, {})
+        plans[table_name] = CastPlan(table_name, table_types)
+    return plans[table_name]
+
+
+def parse_types(table_name, series):
+    return get_cast_plan(table_name).cast_series(series)
+
+
+def compact_table(table_name, df):
+    """Stores the categorical fields of an ODM table (categories and
+    foreign keys, see odm_schema.OdmSchema.categorical_fields) as
+    pandas categoricals, which take a fraction of the memory of
+    object columns. Fields where most values are distinct are left as is.
+
+    Parameters
+    ----------
+    table_name : str
+        Name of the table in the ODM (ex. "WWMeasure")
+    df : pd.DataFrame
+        The table to compact. It is not modified.
+
+    Returns
+    -------
+    pd.DataFrame
+        The compacted table.
+    """
+    fields = odm_schema.get_schema().categorical_fields(table_name)
+    to_compact = {
+        field: df[field].astype("category")
+        for field in fields
+        if field in df.columns
+        and df[field].dtype.name in ["object", "string"]
+        # categoricals only save memory when values repeat
+        and df[field].nunique() < len(df) / 2
+    }
+    if not to_compact:
+        return df
+    return df.assign(**to_compact)
+
+
+def expand_table(df):
+    """Turns the categorical columns of a table back into object columns,
+    so that new values can be assigned to them.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The table to expand. It is not modified.
+
+    Returns
+    -------
+    pd.DataFrame
+        The table without categorical columns.
+    """
+    to_expand = {
+        col: df[col].astype(object)
+        for col in df.columns
+        if df[col].dtype.name == "category"
+    }
+    if not to_expand:
+        return df
+    return df.assign(**to_expand)
+
+
+class EmptyOdmTable:
+    """Default value of the table attributes of mappers.
+
+    Until a mapper sets one of its tables, reading that attribute
+    gives an empty table with the right columns. The table is only
+    built when it is first accessed, then kept by the mapper like a
+    table it set.
+    """
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
 
-    return series
+    def __get__(self, instance, owner=None):
+        table = odm_schema.empty_table(self.table_name)
+        if instance is not None:
+            instance.__dict__[self.name] = table
+        return table
 
 
 class BaseMapper(ABC):
-    sample = pd.DataFrame(
-        columns=utilities.get_table_fields("Sample"))
-    ww_measure = pd.DataFrame(
-        columns=utilities.get_table_fields("WWMeasure"))
-    site = pd.DataFrame(
-        columns=utilities.get_table_fields("Site"))
-    site_measure = pd.DataFrame(
-        columns=utilities.get_table_fields("SiteMeasure"))
-    reporter = pd.DataFrame(
-        columns=utilities.get_table_fields("Reporter"))
-    lab = pd.DataFrame(
-        columns=utilities.get_table_fields("Lab"))
-    assay_method = pd.DataFrame(
-        columns=utilities.get_table_fields("AssayMethod"))
-    instrument = pd.DataFrame(
-        columns=utilities.get_table_fields("Instrument"))
-    polygon = pd.DataFrame(
-        columns=utilities.get_table_fields("Polygon"))
-    cphd = pd.DataFrame(
-        columns=utilities.get_table_fields("CPHD"))
+    sample = EmptyOdmTable("Sample")
+    ww_measure = EmptyOdmTable("WWMeasure")
+    site = EmptyOdmTable("Site")
+    site_measure = EmptyOdmTable("SiteMeasure")
+    reporter = EmptyOdmTable("Reporter")
+    lab = EmptyOdmTable("Lab")
+    assay_method = EmptyOdmTable("AssayMethod")
+    instrument = EmptyOdmTable("Instrument")
+    polygon = EmptyOdmTable("Polygon")
+    cphd = EmptyOdmTable("CPHD")
     # Attribute name to source name
     conversion_dict = CONVERSION_DICT
+    # Set to True to store the categorical fields of
+    # the tables as pandas categoricals (see compact_table)
+    compact = False
 
     @abstractmethod
     def read():
@@ -145,9 +366,10 @@ class BaseMapper(ABC):
                 keep="first", ignore_index=True)
     
     def type_cast_table(self, odm_name, df):
-        return df.apply(
-                lambda x: parse_types(odm_name, x),
-                axis=0)
+        df = get_cast_plan(odm_name).cast(df)
+        if self.compact:
+            df = compact_table(odm_name, df)
+        return df
     
     def get_attribute_from_odm_name(self, odm_name):
         for attribute, dico in self.conversion_dict.items():
@@ -143,19 +143,9 @@ class CsvMapper(base_mapper.BaseMapper):
         The series, with all items typecast to desired_type.
         """
         if desired_type == "bool":
-            series = series.astype(str)
-            series = series.str.strip().str.lower()
-            series = series.apply(
-                lambda x: base_mapper.replace_unknown_by_default(x, ""))
-            series = series.str.replace("oui", "true", case=False)\
-                .str.replace("yes", "true", case=False)\
-                .str.startswith("true")
+            series = base_mapper.cast_to_bool(series, default="")
         elif desired_type in ["string", "category"]:
-            series = series.astype(str)
-            series = series.str.lower()
-            series = series.str.strip()
-            series = series.apply(
-                lambda x: base_mapper.replace_unknown_by_default(x, ""))
+            series = base_mapper.cast_to_string(series)
         elif desired_type in ["int64", "float64"]:
             series = pd.to_numeric(series, errors="coerce")
         elif desired_type == "datetime64[ns]":
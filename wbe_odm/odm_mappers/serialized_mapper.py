@@ -28,8 +28,10 @@ class SerializedMapper(base_mapper.BaseMapper):
         """
         json.loads(
             json_str, object_hook=self.decode_object)
-        self_attrs = self.__dict__
+        self_attrs = dict(self.__dict__)
         for key, df in self_attrs.items():
+            if key not in self.conversion_dict:
+                continue
             odm_table_name = self.conversion_dict[key]['odm_name']
             df = self.type_cast_table(odm_table_name, df)
             setattr(self, key, df)
@@ -0,0 +1,219 @@
+"""
+Description
+-----------
+Registry of the Ottawa Data Model (ODM) variable dictionary.
+
+The dictionary (Variables.csv) describes every table of the ODM, the fields
+it contains, their data types and which field is the primary key. A
+snapshot of it is bundled with the package so that the lookups below never
+need network access. The snapshot is parsed once per process and the
+lookups are served from indexed dictionaries afterwards.
+"""
+import os
+
+import pandas as pd
+
+VARIABLES_URL = "https://raw.githubusercontent.com/Big-Life-Lab/covid-19-wastewater/main/site/Variables.csv"  # noqa
+BUNDLED_SCHEMA_VERSION = "1.1"
+BUNDLED_VARIABLES = os.path.join(
+    os.path.dirname(__file__),
+    "data",
+    f"Variables_v{BUNDLED_SCHEMA_VERSION}.csv")
+
+# Short names used throughout the code base for some ODM tables.
+TABLE_ALIASES = {
+    "CPHD": "CovidPublicHealthData",
+}
+
+
+def clean_primary_key(key):
+    key = str(key)
+    if key.startswith('u'):
+        key = key[1:]
+    if key[0].isupper():
+        key = key[0].lower() + key[1:]
+    return key.replace('Ww', 'ww')
+
+
+def clean_variable_types(types):
+    """Converts the variable types of the ODM dictionary to the names
+    of the corresponding pandas data types.
+
+    Parameters
+    ----------
+    types : pd.Series
+        The variableType column of the ODM dictionary.
+
+    Returns
+    -------
+    pd.Series
+        The pandas data type names.
+    """
+    return types\
+        .replace(r"date(time)?", "datetime64[ns]", regex=True) \
+        .replace("boolean", "bool") \
+        .replace("float", "float64") \
+        .replace("integer", "int64") \
+        .replace("blob", "object") \
+        .replace("category", "string")
+
+
+class OdmSchema:
+    """Indexed view of the ODM variable dictionary.
+
+    Parameters
+    ----------
+    variables : pd.DataFrame
+        The contents of Variables.csv. It needs the columns
+        "tableName", "variableName", "variableType" and "key".
+    version : str, optional
+        Label describing where the dictionary comes from.
+    """
+    def __init__(self, variables, version=None):
+        self.version = version
+        variables = variables.dropna(subset=["tableName", "variableName"])
+        self._fields = {}
+        self._data_types = {}
+        self._primary_keys = {}
+        self._categorical_fields = {}
+        self._empty_tables = {}
+        types = clean_variable_types(variables["variableType"])
+        for table_name, table in variables.groupby("tableName", sort=False):
+            self._fields[table_name] = tuple(table["variableName"])
+            self._data_types[table_name] = {
+                name.lower(): {"variableType": type_}
+                for name, type_ in zip(
+                    table["variableName"], types.loc[table.index])
+            }
+            keys = table.loc[table["key"] == "Primary Key", "variableName"]
+            if not keys.empty:
+                self._primary_keys[table_name] = clean_primary_key(
+                    keys.iloc[0])
+            # Fields that take their values from a short list
+            # (categories and references to other tables).
+            categorical = (table["variableType"] == "category") \
+                | (table["key"] == "Foreign Key")
+            self._categorical_fields[table_name] = tuple(
+                table.loc[categorical, "variableName"])
+        for alias, table_name in TABLE_ALIASES.items():
+            if table_name in self._data_types:
+                self._data_types.setdefault(
+                    alias, self._data_types[table_name])
+
+    @classmethod
+    def from_csv(cls, path):
+        """Builds the schema from a copy of Variables.csv.
+
+        Parameters
+        ----------
+        path : str
+            Path (or URL) of the csv file.
+
+        Returns
+        -------
+        OdmSchema
+            The parsed schema.
+        """
+        variables = pd.read_csv(path)
+        return cls(variables, version=path)
+
+    def resolve(self, table_name):
+        """Gets the name under which a table is stored in the dictionary."""
+        if table_name in self._fields:
+            return table_name
+        return TABLE_ALIASES.get(table_name, table_name)
+
+    @property
+    def table_names(self):
+        return list(self._fields.keys())
+
+    def table_fields(self, table_name):
+        """Lists the fields of a table, in the order of the dictionary.
+        Unknown tables have no fields."""
+        return list(self._fields.get(self.resolve(table_name), ()))
+
+    def categorical_fields(self, table_name):
+        """Lists the fields of a table that hold a small set of distinct
+        values: category fields and foreign keys."""
+        return list(
+            self._categorical_fields.get(self.resolve(table_name), ()))
+
+    def data_types(self):
+        """Gets the pandas data type of every field of every table.
+
+        Returns
+        -------
+        dict
+            {table_name: {variable_name: {"variableType": dtype}}}, with
+            lowercase variable names. Aliases are included as table names.
+            The dictionary is shared: it must not be modified.
+        """
+        return self._data_types
+
+    def empty_table(self, table_name):
+        """Builds an empty DataFrame with the fields of a table as columns.
+        The template is built on first use and copied afterwards, so the
+        caller is free to modify the table it gets."""
+        table_name = self.resolve(table_name)
+        if table_name not in self._empty_tables:
+            self._empty_tables[table_name] = pd.DataFrame(
+                columns=self.table_fields(table_name))
+        return self._empty_tables[table_name].copy()
+
+    def primary_keys(self):
+        return dict(self._primary_keys)
+
+    def primary_key(self, table_name):
+        return self._primary_keys[self.resolve(table_name)]
+
+
+_SCHEMA = None
+
+
+def get_schema():
+    """Gets the schema of the current process, loading the
+    bundled snapshot of the ODM dictionary the first time."""
+    global _SCHEMA
+    if _SCHEMA is None:
+        _SCHEMA = OdmSchema.from_csv(BUNDLED_VARIABLES)
+        _SCHEMA.version = BUNDLED_SCHEMA_VERSION
+    return _SCHEMA
+
+
+def empty_table(table_name):
+    """Gets an empty version of an ODM table.
+
+    Parameters
+    ----------
+    table_name : str
+        Name of the table in the ODM (ex. "WWMeasure")
+
+    Returns
+    -------
+    pd.DataFrame
+        A DataFrame without rows, whose columns are the fields of the table.
+    """
+    return get_schema().empty_table(table_name)
+
+
+def load_schema(path=None):
+    """Replaces the schema of the current process.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path to a local copy of Variables.csv. It can also be the URL
+        of the dictionary (see VARIABLES_URL) on hosts that have network
+        access. By default None, which reloads the bundled snapshot.
+
+    Returns
+    -------
+    OdmSchema
+        The new schema.
+    """
+    global _SCHEMA
+    _SCHEMA = None
+    if path is None:
+        return get_schema()
+    _SCHEMA = OdmSchema.from_csv(path)
+    return _SCHEMA
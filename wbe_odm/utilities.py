@@ -1,14 +1,22 @@
-import json
-from functools import reduce
+from collections import OrderedDict
+import copy
+import hashlib
+from functools import lru_cache, reduce
+import os
 import re
 import warnings
 
 import numpy as np
 import pandas as pd
 from geojson_rewind import rewind
+import shapely
 import shapely.wkt
+from shapely.geometry import MultiPolygon, Polygon
+from shapely.geometry.polygon import orient
 import geomet.wkt
 
+from wbe_odm import odm_schema
+
 UNKNOWN_REGEX = re.compile(r"$^|n\.?[a|d|/|n]+\.?|^-$|unk.*|none", flags=re.I)
 
 def typecast_wide_table(df):
@@ -23,55 +31,645 @@ def typecast_wide_table(df):
     return df
 
 
-def has_cphd_data(x, uniques):
-    if pd.isna(x):
+def convert_wkt(x):
+    try:
+        return shapely.wkt.loads(x)
+    except Exception:
         return None
-    ls = x.split(";")
-    ls = [i for i in ls if i in uniques]
-    return ";".join(ls) if ls else None
 
 
-def pick_cphd_poly_by_size(x, poly):
-    if pd.isna(x):
-        return None
-    ls = x.split(";")
-    areas = []
-    for id_ in ls:
-        area = poly.loc[poly["Polygon_polygonID"] == id_, "area"]
-        areas.append(area)
-    min_area = min(areas)
-    min_idx = areas.index(min_area)
-    return ls[min_idx]
+def _ring_arrays(polygon, precision=None):
+    # Exterior ring clockwise and holes counterclockwise,
+    # like rewind(rfc7946=False).
+    polygon = orient(polygon, sign=-1.0)
+    rings = []
+    for ring in (polygon.exterior, *polygon.interiors):
+        coords = np.asarray(ring.coords)
+        if precision is not None:
+            coords = coords.round(precision)
+        rings.append(coords)
+    return rings
 
 
-def convert_wkt(x):
-    try:
-        return shapely.wkt.loads(x)
-    except Exception:
+def _polygon_arrays(shape, precision=None):
+    """Gets the GeoJSON type of a shapely Polygon or MultiPolygon, and
+    the coordinates of its rings as arrays (see polygon_to_geojson)."""
+    if isinstance(shape, MultiPolygon):
+        return "MultiPolygon", [
+            _ring_arrays(part, precision) for part in shape.geoms]
+    return "Polygon", _ring_arrays(shape, precision)
+
+
+def _arrays_to_geojson(type_, rings):
+    if type_ == "MultiPolygon":
+        coordinates = [[ring.tolist() for ring in part] for part in rings]
+    else:
+        coordinates = [ring.tolist() for ring in rings]
+    return {"type": type_, "coordinates": coordinates}
+
+
+def polygon_to_geojson(shape, precision=None):
+    """Converts a shapely Polygon or MultiPolygon to a GeoJSON mapping,
+    with the same coordinates and winding as convert_wkt_to_geojson.
+    Coordinates are rounded to `precision` decimals when it is given."""
+    return _arrays_to_geojson(*_polygon_arrays(shape, precision))
+
+
+def zoom_to_tolerance(zoom):
+    """Gets the width of a pixel of a web map (256 pixel tiles) at a
+    zoom level, in degrees of longitude."""
+    return 360 / (256 * 2 ** zoom)
+
+
+def get_simplification(tolerance=None, zoom=None, precision=None):
+    """Resolves how polygons should be simplified for display.
+
+    Parameters
+    ----------
+    tolerance : float, optional
+        Largest distance between a simplified outline and the original,
+        in degrees.
+    zoom : float, optional
+        Web map zoom level to simplify for, instead of a tolerance: the
+        tolerance is the width of a pixel at that zoom.
+    precision : int, optional
+        Number of decimals kept in the coordinates. By default, enough
+        to place points at a tenth of the tolerance.
+
+    Returns
+    -------
+    tuple(float, int) or None
+        The tolerance and the precision, or None to keep the polygons
+        as they are.
+    """
+    if tolerance is not None and zoom is not None:
+        raise ValueError("Give either a tolerance or a zoom level, not both.")
+    if zoom is not None:
+        tolerance = zoom_to_tolerance(zoom)
+    if tolerance is None:
+        if precision is None:
+            return None
+        tolerance = 0.0
+    if tolerance < 0:
+        raise ValueError("The tolerance can't be negative.")
+    if precision is None:
+        precision = max(int(np.ceil(-np.log10(tolerance / 10))), 0) \
+            if tolerance > 0 else 6
+    return float(tolerance), int(precision)
+
+
+class PolygonGeometry:
+    """Shape of a polygon, parsed from its WKT on first use.
+
+    The derived values (area, bounding box, GeoJSON mapping) are also
+    computed once, when they are first needed.
+    """
+    def __init__(self, wkt):
+        self.wkt = wkt
+        self._shape = None
+        self._parsed = False
+        self._prepared = False
+        self._geojson = None
+        self._centroid = None
+        self._simplified = {}
+
+    @property
+    def shape(self):
+        """The shapely geometry, or None if the WKT can't be parsed."""
+        if not self._parsed:
+            self._shape = convert_wkt(self.wkt)
+            self._parsed = True
+        return self._shape
+
+    @property
+    def prepared(self):
+        """The shapely geometry, prepared for repeated predicates."""
+        shape = self.shape
+        if shape is not None and not self._prepared:
+            shapely.prepare(shape)
+            self._prepared = True
+        return shape
+
+    @property
+    def area(self):
+        return getattr(self.shape, "area", np.nan)
+
+    @property
+    def bounds(self):
+        """(minx, miny, maxx, maxy), all NaN without a shape."""
+        return getattr(self.shape, "bounds", (np.nan,) * 4)
+
+    @property
+    def centroid(self):
+        """(x, y) of the centroid, all NaN without a shape."""
+        if self._centroid is None:
+            shape = self.shape
+            self._centroid = (shape.centroid.x, shape.centroid.y) \
+                if shape is not None and not shape.is_empty \
+                else (np.nan, np.nan)
+        return self._centroid
+
+    @property
+    def geojson(self):
+        """The GeoJSON mapping of the shape, wound clockwise
+        (see convert_wkt_to_geojson). Each access gives a new mapping,
+        which the caller may modify."""
+        if self._geojson is None and self.wkt not in ["-", ""]:
+            shape = self.shape
+            if isinstance(shape, (Polygon, MultiPolygon)) \
+                    and not shape.is_empty:
+                self._geojson = _polygon_arrays(shape)
+            else:
+                self._geojson = rewind(
+                    geomet.wkt.loads(self.wkt), rfc7946=False)
+        if isinstance(self._geojson, tuple):
+            return _arrays_to_geojson(*self._geojson)
+        return copy.deepcopy(self._geojson)
+
+    def simplified_geojson(self, tolerance, precision):
+        """Gets the GeoJSON mapping of a simplified version of the shape.
+
+        Outlines are simplified without creating self-intersections,
+        then snapped to a grid of `precision` decimals. Results are kept
+        per (tolerance, precision), and each call gives a new mapping.
+        Shapes that are not polygons are not simplified.
+        """
+        key = (tolerance, precision)
+        if key not in self._simplified:
+            shape = self.shape
+            if not isinstance(shape, (Polygon, MultiPolygon)) \
+                    or shape.is_empty:
+                return self.geojson
+            simple = shapely.simplify(shape, tolerance, preserve_topology=True)
+            snapped = shapely.set_precision(simple, 10.0 ** -precision)
+            # Polygons smaller than the grid would vanish:
+            # they keep their simplified outline instead.
+            if isinstance(snapped, (Polygon, MultiPolygon)) \
+                    and not snapped.is_empty:
+                simple = snapped
+            self._simplified[key] = _polygon_arrays(simple, precision)
+        return _arrays_to_geojson(*self._simplified[key])
+
+
+class GeometryCache:
+    """Parsed polygons, shared by the geometry functions of this module.
+
+    Entries are keyed by polygon ID and hash of the WKT, so that a
+    polygon whose shape changes is parsed again, and a polygon is parsed
+    only once otherwise. The cache holds at most maxsize polygons: the
+    least recently used ones are dropped first. maxsize grows to the
+    size of the largest polygon table used at once (see reserve), so
+    polygons are only parsed again when more polygons than that are used
+    in turn, or when the cache is cleared.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, polygon_id, wkt):
+        """Gets the PolygonGeometry of a polygon."""
+        key = (polygon_id, hash(wkt))
+        entry = self._entries.get(key)
+        # The WKT is compared too, in case two of them have the same hash
+        if entry is not None and (entry.wkt is wkt or (
+                isinstance(wkt, str) and entry.wkt == wkt)):
+            self._entries.move_to_end(key)
+            return entry
+        entry = PolygonGeometry(wkt)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def reserve(self, n_polygons):
+        """Makes room for n_polygons, so that a pass over a table of
+        that many polygons doesn't drop its own polygons."""
+        self.maxsize = max(self.maxsize, n_polygons)
+
+    def geometries(self, polygon_ids, wkts):
+        self.reserve(len(polygon_ids))
+        return [self.get(id_, wkt) for id_, wkt in zip(polygon_ids, wkts)]
+
+    def areas(self, polygon_ids, wkts):
+        """Gets the area of each polygon, NaN if it has no shape."""
+        return np.array(
+            [geom.area for geom in self.geometries(polygon_ids, wkts)],
+            dtype=float)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_GEOMETRY_CACHE = GeometryCache()
+
+
+def get_geometry_cache():
+    return _GEOMETRY_CACHE
+
+
+MAPBOX_ZOOM_FILE = os.path.join(
+    os.path.dirname(__file__), "wbe_tools", "mapbox_zoom.csv")
+DEFAULT_MAP_HEIGHT_PX = 800
+_MAPBOX_ZOOM = None
+
+
+def get_mapbox_zoom_table():
+    """Gets the size of a pixel of Mapbox maps, loading it the first time.
+
+    Returns
+    -------
+    tuple(np.ndarray, np.ndarray, np.ndarray)
+        The zoom levels, the latitudes, and the meters per pixel of each
+        zoom level (rows) at each latitude (columns).
+    """
+    global _MAPBOX_ZOOM
+    if _MAPBOX_ZOOM is None:
+        table = pd.read_csv(MAPBOX_ZOOM_FILE, index_col="Zoom level")
+        latitudes = table.columns.str.replace("Latitude ", "").astype(float)
+        _MAPBOX_ZOOM = (
+            table.index.to_numpy(dtype=float),
+            latitudes.to_numpy(),
+            table.to_numpy(dtype=float))
+    return _MAPBOX_ZOOM
+
+
+def meridian_distance(lat1, lat2):
+    """Gets the distance between two latitudes along a meridian of the
+    WGS84 ellipsoid, in meters."""
+    a = 6378137.0
+    e2 = 6.69437999014e-3
+    e4, e6 = e2 ** 2, e2 ** 3
+
+    def arc(lat):
+        phi = np.radians(lat)
+        return a * (
+            (1 - e2 / 4 - 3 * e4 / 64 - 5 * e6 / 256) * phi
+            - (3 * e2 / 8 + 3 * e4 / 32 + 45 * e6 / 1024) * np.sin(2 * phi)
+            + (15 * e4 / 256 + 45 * e6 / 1024) * np.sin(4 * phi)
+            - (35 * e6 / 3072) * np.sin(6 * phi))
+    return abs(arc(lat2) - arc(lat1))
+
+
+@lru_cache(maxsize=1024)
+def get_zoom_level(bounds, map_height_px=DEFAULT_MAP_HEIGHT_PX):
+    """Finds the Mapbox zoom level at which a bounding box spans
+    half the height of a map.
+
+    Parameters
+    ----------
+    bounds : tuple
+        (minx, miny, maxx, maxy), in degrees.
+    map_height_px : int, optional
+        Height of the map, in pixels.
+
+    Returns
+    -------
+    float
+        The zoom level, interpolated between the levels of the table
+        (see get_mapbox_zoom_table).
+    """
+    _, miny, _, maxy = bounds
+    meters_per_px = meridian_distance(miny, maxy) / map_height_px * 2
+    zooms, latitudes, table = get_mapbox_zoom_table()
+    latitude = abs((miny + maxy) / 2)
+    band = np.clip(
+        np.searchsorted(latitudes, latitude, side="right") - 1,
+        0, len(latitudes) - 2)
+    weight = np.clip(
+        (latitude - latitudes[band])
+        / (latitudes[band + 1] - latitudes[band]), 0, 1)
+    at_latitude = table[:, band] * (1 - weight) \
+        + table[:, band + 1] * weight
+    # Pixels get smaller as the zoom level increases.
+    return float(np.interp(meters_per_px, at_latitude[::-1], zooms[::-1]))
+
+
+def get_map_view(geometries, map_height_px=DEFAULT_MAP_HEIGHT_PX):
+    """Describes how to frame a set of polygons on a map.
+
+    Parameters
+    ----------
+    geometries : list of PolygonGeometry
+        The polygons.
+    map_height_px : int, optional
+        Height of the map, in pixels.
+
+    Returns
+    -------
+    dict or None
+        "bbox" (minx, miny, maxx, maxy), "center" (the mean of the
+        centroids of the polygons, as {"lat", "lon"}), "zoom" and
+        "mapHeight". None if no polygon has a shape.
+    """
+    bounds = np.array([geom.bounds for geom in geometries], dtype=float)
+    centroids = np.array(
+        [geom.centroid for geom in geometries], dtype=float)
+    valid = ~np.isnan(bounds).any(axis=1) if len(bounds) else []
+    if not np.any(valid):
         return None
+    bounds, centroids = bounds[valid], centroids[valid]
+    bbox = (
+        float(bounds[:, 0].min()), float(bounds[:, 1].min()),
+        float(bounds[:, 2].max()), float(bounds[:, 3].max()))
+    lon, lat = centroids.mean(axis=0)
+    return {
+        "bbox": list(bbox),
+        "center": {"lat": float(lat), "lon": float(lon)},
+        "zoom": get_zoom_level(bbox, map_height_px),
+        "mapHeight": map_height_px,
+    }
+
+
+def get_polygon_areas(poly):
+    """Builds a lookup table of the area of each polygon.
+
+    Parameters
+    ----------
+    poly : pd.DataFrame
+        The Polygon table, with prefixed columns ("Polygon_polygonID"
+        and "Polygon_wkt").
+
+    Returns
+    -------
+    pd.Series
+        The areas, indexed by polygon ID. Polygons without a shape
+        have a NaN area.
+    """
+    if poly.empty:
+        return pd.Series(dtype=float)
+    areas = pd.Series(
+        get_geometry_cache().areas(
+            poly["Polygon_polygonID"], poly["Polygon_wkt"]),
+        index=poly["Polygon_polygonID"].to_numpy(),
+        dtype=float)
+    return areas[~areas.index.duplicated()]
+
+
+def pick_smallest_polygons(polygon_lists, areas, candidates):
+    """Picks the smallest polygon of each list among some candidates.
+
+    Each distinct list is only resolved once. Ties, and polygons of
+    unknown area (ranked last), are resolved by the order of the list.
+
+    Parameters
+    ----------
+    polygon_lists : pd.Series
+        Polygon IDs joined with ";", as in Calculated_polygonList.
+    areas : pd.Series
+        The area of each polygon, indexed by polygon ID
+        (see get_polygon_areas).
+    candidates : list-like
+        The polygons that can be picked.
+
+    Returns
+    -------
+    np.ndarray
+        The ID of the picked polygon, or None when the list has no
+        candidate.
+    """
+    codes, uniques = pd.factorize(polygon_lists)
+    result = np.full(len(codes), None, dtype=object)
+    if len(uniques) == 0:
+        return result
+    exploded = pd.Series(uniques).str.split(";").explode()
+    exploded = exploded.loc[exploded.isin(candidates)]
+    picked = np.full(len(uniques), None, dtype=object)
+    if not exploded.empty:
+        choices = pd.DataFrame({
+            "list": exploded.index.to_numpy(),
+            "position": np.arange(len(exploded)),
+            "polygonID": exploded.to_numpy(),
+            "area": exploded.map(areas).to_numpy(dtype=float),
+        }).sort_values(["list", "area", "position"], na_position="last")\
+            .drop_duplicates("list")
+        picked[choices["list"].to_numpy()] = choices["polygonID"].to_numpy()
+    known = codes >= 0
+    result[known] = picked[codes[known]]
+    return result
 
 
 def get_polygon_for_cphd(merged, poly, cphd):
-    poly["shape"] = poly["Polygon_wkt"].apply(lambda x: convert_wkt(x))
-    poly["area"] = poly["shape"].apply(lambda x: x.area)
-    unique_cphd_polys = cphd["CPHD_polygonID"].unique()
-    merged["polys_w_cphd"] = merged["Calculated_polygonList"].apply(
-        lambda x: has_cphd_data(x, unique_cphd_polys))
-    merged["Calculated_polygonIDForCPHD"] = merged["polys_w_cphd"].apply(
-        lambda x: pick_cphd_poly_by_size(x, poly))
-    poly.drop(columns=["shape", "area"], inplace=True)
-    merged.drop(columns=["polys_w_cphd"], inplace=True)
+    """Adds a column called 'Calculated_polygonIDForCPHD' with the
+    smallest polygon of the row's 'Calculated_polygonList' that has
+    public health data, None when there is none."""
+    cphd_polys = cphd["CPHD_polygonID"].dropna().unique() \
+        if "CPHD_polygonID" in cphd.columns else []
+    merged["Calculated_polygonIDForCPHD"] = pick_smallest_polygons(
+        merged["Calculated_polygonList"], get_polygon_areas(poly), cphd_polys)
     return merged
 
 
-def get_encompassing_polygons(row, poly):
-    poly["contains"] = poly["shape"].apply(
-        lambda x: x.contains(row["temp_point"])
-        if x is not None else False)
-    poly_ids = poly[
-        "Polygon_polygonID"].loc[poly["contains"]].to_list()
-    poly.drop(columns=["contains"], inplace=True)
-    return ";".join(poly_ids)
+class PolygonIndex:
+    """Spatial index of polygons, to find the polygons that contain
+    many points at once.
+
+    The polygons are prepared and stored in an STRtree. Points are
+    matched with the bounding boxes of the tree, and only those
+    candidates are tested for containment, in a single vectorized call.
+
+    Parameters
+    ----------
+    shapes : list-like
+        The polygons, as shapely geometries. None values are ignored.
+    polygon_ids : list-like
+        The ID of each polygon.
+    """
+    def __init__(self, shapes, polygon_ids):
+        shapes = np.asarray(shapes, dtype=object)
+        polygon_ids = np.asarray(polygon_ids, dtype=object)
+        valid = np.array([
+            isinstance(shape, shapely.Geometry) and not shape.is_empty
+            for shape in shapes], dtype=bool)
+        self.shapes = shapes[valid]
+        self.polygon_ids = np.array(
+            [str(x) for x in polygon_ids[valid]], dtype=object)
+        shapely.prepare(self.shapes)
+        self.tree = shapely.STRtree(self.shapes)
+
+    def contains(self, x, y):
+        """Finds the polygons containing each point.
+
+        Parameters
+        ----------
+        x, y : array-like
+            The coordinates of the points (longitude and latitude).
+
+        Returns
+        -------
+        tuple(np.ndarray, np.ndarray)
+            Index of the point and index of the polygon of every
+            (point, polygon) pair where the polygon contains the point,
+            sorted by point and then by polygon.
+        """
+        points = shapely.points(
+            np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        point_idx, poly_idx = self.tree.query(points)
+        inside = shapely.contains(self.shapes[poly_idx], points[point_idx])
+        point_idx, poly_idx = point_idx[inside], poly_idx[inside]
+        order = np.lexsort((poly_idx, point_idx))
+        return point_idx[order], poly_idx[order]
+
+    def encompassing_polygons(self, x, y):
+        """Lists the polygons containing each point.
+
+        Returns
+        -------
+        np.ndarray
+            For each point, the IDs of the polygons that contain it joined
+            with ";", in the order the polygons were given.
+        """
+        x = np.asarray(x, dtype=float)
+        result = np.full(len(x), "", dtype=object)
+        point_idx, poly_idx = self.contains(x, y)
+        if len(point_idx) == 0:
+            return result
+        joined = pd.Series(self.polygon_ids[poly_idx])\
+            .groupby(point_idx, sort=False)\
+            .agg(";".join)
+        result[joined.index.to_numpy()] = joined.to_numpy()
+        return result
+
+
+def get_polygon_fingerprint(polygon_ids, wkts):
+    """Hashes the IDs and shapes of a set of polygons, to tell whether
+    results computed with them are still valid."""
+    digest = hashlib.sha1()
+    for polygon_id, wkt in zip(polygon_ids, wkts):
+        digest.update(f"{polygon_id}\t{wkt}\n".encode())
+    return digest.hexdigest()
+
+
+class ContainmentCache:
+    """Polygons containing coordinate pairs, for one set of polygons.
+
+    Results are stored per distinct (geoLong, geoLat) pair, along with
+    the fingerprint of the polygons they were computed with (see
+    get_polygon_fingerprint). They are discarded when the polygons change.
+    """
+    columns = ["geoLong", "geoLat", "polygonList"]
+
+    def __init__(self, fingerprint=None, table=None):
+        self.fingerprint = fingerprint
+        if table is None:
+            table = pd.DataFrame(columns=self.columns)
+        self.table = table
+
+    def lookup(self, fingerprint, coords):
+        """Gets the polygon lists of coordinate pairs.
+
+        Parameters
+        ----------
+        fingerprint : str
+            Fingerprint of the current polygons.
+        coords : pd.DataFrame
+            Distinct pairs, in columns "geoLong" and "geoLat".
+
+        Returns
+        -------
+        np.ndarray
+            The polygon list of each pair, or NaN when it is not cached.
+        """
+        if fingerprint != self.fingerprint or self.table.empty:
+            return np.full(len(coords), np.nan, dtype=object)
+        found = coords.merge(
+            self.table, how="left", on=["geoLong", "geoLat"])
+        return found["polygonList"].to_numpy(dtype=object)
+
+    def update(self, fingerprint, coords, polygon_lists):
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self.table = pd.DataFrame(columns=self.columns)
+        new = coords[["geoLong", "geoLat"]].assign(polygonList=polygon_lists)
+        self.table = pd.concat([self.table, new], ignore_index=True)\
+            .drop_duplicates(subset=["geoLong", "geoLat"], keep="last")
+
+    def to_csv(self, path):
+        self.table.assign(fingerprint=self.fingerprint)\
+            .to_csv(path, sep=",", index=False)
+
+    @classmethod
+    def from_csv(cls, path):
+        table = pd.read_csv(
+            path,
+            dtype={"polygonList": str, "fingerprint": str},
+            keep_default_na=False)
+        fingerprint = table["fingerprint"].iloc[0] if len(table) else None
+        return cls(fingerprint, table[cls.columns])
+
+
+_CONTAINMENT_CACHE = ContainmentCache()
+
+
+def get_containment_cache():
+    return _CONTAINMENT_CACHE
+
+
+def load_containment_cache(path):
+    """Replaces the containment cache of the current process
+    with one saved by ContainmentCache.to_csv."""
+    global _CONTAINMENT_CACHE
+    _CONTAINMENT_CACHE = ContainmentCache.from_csv(path)
+    return _CONTAINMENT_CACHE
+
+
+def get_encompassing_polygon_lists(x, y, polygon_ids, wkts, cache=None):
+    """Lists the polygons containing each point.
+
+    Containment is only computed once per distinct coordinate pair, and
+    only for pairs that are not in the cache. The polygons are not
+    parsed at all when every pair is cached.
+
+    Parameters
+    ----------
+    x, y : array-like
+        The coordinates of the points (longitude and latitude).
+    polygon_ids : array-like
+        The IDs of the polygons.
+    wkts : array-like
+        The shapes of the polygons, as WKT.
+    cache : ContainmentCache, optional
+        By default, the cache of the current process.
+
+    Returns
+    -------
+    np.ndarray
+        For each point, the IDs of the polygons that contain it joined
+        with ";", in the order the polygons were given.
+    """
+    if cache is None:
+        cache = get_containment_cache()
+    coords = pd.DataFrame({
+        "geoLong": np.asarray(x, dtype=float),
+        "geoLat": np.asarray(y, dtype=float),
+    })
+    result = np.full(len(coords), "", dtype=object)
+    located = coords.notna().all(axis=1).to_numpy()
+    coords = coords.loc[located]
+    if coords.empty:
+        return result
+    pair_codes = coords.groupby(
+        ["geoLong", "geoLat"], sort=False).ngroup().to_numpy()
+    pairs = coords.drop_duplicates(ignore_index=True)
+
+    polygon_ids = list(polygon_ids)
+    wkts = list(wkts)
+    fingerprint = get_polygon_fingerprint(polygon_ids, wkts)
+    lists = cache.lookup(fingerprint, pairs)
+    missing = pd.isna(lists)
+    if missing.any():
+        geometries = get_geometry_cache().geometries(polygon_ids, wkts)
+        index = PolygonIndex(
+            [geom.prepared for geom in geometries], polygon_ids)
+        new_pairs = pairs.loc[missing]
+        lists[missing] = index.encompassing_polygons(
+            new_pairs["geoLong"], new_pairs["geoLat"])
+        cache.update(fingerprint, new_pairs, lists[missing])
+    result[located] = lists[pair_codes]
+    return result
 
 
 def get_midpoint_time(date1, date2):
@@ -80,24 +678,82 @@ def get_midpoint_time(date1, date2):
     return date1 + (date2 - date1)/2
 
 
+def get_midpoint_times(start, end):
+    """Vectorized version of get_midpoint_time.
+
+    Parameters
+    ----------
+    start : pd.Series
+        The start times.
+    end : pd.Series
+        The end times, aligned with start.
+
+    Returns
+    -------
+    pd.Series
+        The times halfway between start and end, NaT where
+        either is missing.
+    """
+    return start + (end - start) / 2
+
+
+# Collection codes of composite samples (ex. "cptp24h", "cpfp12h") and
+# passive samplers (ex. "ps48h"), which give their duration in hours
+COMPOSITE_HOURS_REGEX = r"^(?:cp[tf]p|ps)([0-9]+)h$"
+
+
+def get_composite_hours(collection):
+    """Reads the duration of composite samples from their collection code.
+
+    Parameters
+    ----------
+    collection : pd.Series
+        The collection codes of the samples.
+
+    Returns
+    -------
+    pd.Series
+        The duration in hours of each sample (a float),
+        NaN for samples that aren't composite.
+    """
+    uniques = pd.Series(collection.dropna().unique(), dtype=object)
+    hours = pd.to_numeric(
+        uniques.astype(str).str.extract(COMPOSITE_HOURS_REGEX)[0])
+    return collection.map(
+        pd.Series(hours.to_numpy(), index=uniques.to_numpy()))\
+        .astype(float)
+
+
+def is_grab_sample(collection):
+    """Tells which samples are grab samples from their collection code,
+    looking at each distinct code once.
+
+    Parameters
+    ----------
+    collection : pd.Series
+        The collection codes of the samples.
+
+    Returns
+    -------
+    pd.Series
+        True for codes containing "grb", False elsewhere.
+    """
+    uniques = pd.Series(collection.dropna().unique(), dtype=object)
+    grab = uniques[uniques.astype(str).str.contains("grb", regex=False)]
+    return collection.isin(grab)
+
+
 def clean_grab_datetime(df):
     one_day = pd.to_timedelta("24 hours")
-    result_end = ["Calculated_dateTimeEnd"]
-    result_start = ["Calculated_dateTimeStart"]
+    result_end = "Calculated_dateTimeEnd"
+    result_start = "Calculated_dateTimeStart"
     grab_date = "Sample_dateTime"
-    grab_token = "grb"
     collection = "Sample_collection"
-    df[result_start] = pd.to_datetime(None)
-    df[result_end] = pd.to_datetime(None)
-
-    grb_filt = df[collection].str.contains(grab_token)
-    na_filt = ~df[grab_date].isna()
-    filt = na_filt & grb_filt
-    df2 = df.loc[filt, df.columns.to_list()]
-    df2[result_start] = df2[grab_date].dt.normalize()
-    df2[result_end] = df2[result_start] + one_day
 
-    df.loc[filt] = df2
+    filt = is_grab_sample(df[collection])
+    df[result_start] = pd.to_datetime(df[grab_date].where(filt))\
+        .dt.normalize()
+    df[result_end] = df[result_start] + one_day
     return df
 
 
@@ -142,9 +798,20 @@ def clean_composite_data_intervals(df):
     result_start = "Calculated_dateTimeStart"
 
     one_day = pd.to_timedelta("23 hours 59 minutes")
-    df[result_end] = pd.to_datetime(df[end] + one_day).dt.date
-    df[result_start] = df.apply(
-        lambda row: calc_start_date(row[result_end], row[coll]), axis=1)
+    end_day = pd.to_datetime(df[end] + one_day).dt.normalize()
+    df[result_end] = end_day.dt.date
+    # As with calc_start_date on dates, only whole days are
+    # subtracted: a 24h composite starts on the day before its end.
+    days = get_composite_hours(df[coll]) // 24
+    # Unknown collections have no duration: convert only the known ones,
+    # NaN days raise a cast warning.
+    duration = pd.to_timedelta(days.dropna(), unit="D").reindex(days.index)
+    start = end_day - duration
+    if start.notna().any():
+        df[result_start] = start.dt.date
+    else:
+        df[result_start] = pd.Series(
+            pd.NaT, index=df.index, dtype="datetime64[ns]")
     return df
 
 
@@ -188,6 +855,9 @@ def reduce_nums(x, y):
 
 
 def reduce_by_type(series):
+    """Reduces a series to a single value by folding its values pairwise
+    with reduce_dt, reduce_text or reduce_nums. This is the reduction
+    used by reduce_groups when pairwise=True."""
     if series.empty:
         return np.nan
     data_type = str(series.dtype)
@@ -204,98 +874,309 @@ def reduce_by_type(series):
         raise TypeError(f"could not parse series of dtype {name}")
 
 
-def convert_wkt_to_geojson(s):
-    if s in ["-", ""]:
-        return None  # {"type":"Polygon", "coordinates":None}
-    geojson_feature = json.loads(json.dumps(geomet.wkt.loads(s)))
-    geojson_feature = rewind(geojson_feature, rfc7946=False)
-    return geojson_feature
+def _join_text_groups(values, codes, n_groups):
+    """Joins the known text values of each group with ";", without
+    repeating values. Groups without known values give "", and groups
+    without any value give NaN. A group with a single known value gives
+    that value unchanged."""
+    value_codes, uniques = pd.factorize(values)
+    unique_text = np.array([str(x) for x in uniques], dtype=object)
+    unique_unknown = np.array(
+        [bool(UNKNOWN_REGEX.match(x)) for x in unique_text], dtype=bool)
+
+    has_value = value_codes >= 0
+    known = has_value.copy()
+    known[has_value] = ~unique_unknown[value_codes[has_value]]
+
+    result = np.full(n_groups, np.nan, dtype=object)
+    result[np.bincount(codes[has_value], minlength=n_groups) > 0] = ""
+    pairs = pd.DataFrame({
+        "group": codes[known],
+        "value": value_codes[known],
+    }).drop_duplicates()
+    n_known = pairs.groupby("group")["value"].transform("size").to_numpy()
+    single = pairs.loc[n_known == 1]
+    result[single["group"].to_numpy()] = \
+        np.asarray(uniques, dtype=object)[single["value"].to_numpy()]
+    several = pairs.loc[n_known > 1]
+    if not several.empty:
+        # The k-th values of all the groups are appended at once, in the
+        # order the values first appear in each group
+        rank = several.groupby("group").cumcount().to_numpy()
+        order = np.argsort(rank, kind="stable")
+        groups = several["group"].to_numpy()[order]
+        text = unique_text[several["value"].to_numpy()[order]]
+        bounds = np.searchsorted(rank[order], np.arange(rank.max() + 2))
+        result[groups[:bounds[1]]] = text[:bounds[1]]
+        for start, end in zip(bounds[1:-1], bounds[2:]):
+            at = groups[start:end]
+            result[at] = result[at] + ";" + text[start:end]
+    return result
+
+
+def reduce_groups(df, by, pairwise=False):
+    """Reduces the rows of a table that belong to the same group
+    to a single row, column by column, in a single groupby pass:
+    - datetime columns keep their first non-null value;
+    - numeric columns take the mean of their non-null values;
+    - text columns join their distinct values with ";", leaving out
+      unknown values (see UNKNOWN_REGEX);
+    - other columns keep their first non-null value.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The table to reduce.
+    by : str or array-like
+        The column holding the group of each row, or the groups themselves.
+        Rows without a group are left out.
+    pairwise : bool, optional
+        Whether to fold the values of each group pairwise with
+        reduce_by_type instead, as was done before, by default False.
+        The pairwise fold averages numbers two at a time, loses dates
+        followed by nulls and repeats text values.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per group, indexed by sorted group.
+    """
+    if isinstance(by, str):
+        keys = df[by]
+        df = df.drop(columns=[by])
+    else:
+        # .array keeps the time zone of dates and avoids aligning series
+        keys = pd.Series(getattr(by, "array", by), index=df.index,
+                         name=getattr(by, "name", None))
+    if pairwise:
+        return df.groupby(keys).agg(reduce_by_type)
+
+    codes, groups = pd.factorize(keys, sort=True)
+    in_group = codes >= 0
+    if not in_group.all():
+        df = df.loc[in_group]
+        codes = codes[in_group]
+    n_groups = len(groups)
+    index = pd.Index(groups, name=keys.name)
+
+    reduced = {}
+    numeric = [
+        col for col in df.columns
+        if pd.api.types.is_numeric_dtype(df[col])
+        and not pd.api.types.is_bool_dtype(df[col])]
+    text = [
+        col for col in df.columns
+        if df[col].dtype == object
+        or pd.api.types.is_string_dtype(df[col])
+        or df[col].dtype.name == "category"]
+    others = [
+        col for col in df.columns if col not in numeric and col not in text]
+    if numeric:
+        means = df[numeric].groupby(codes).mean().reindex(range(n_groups))
+        reduced.update({col: means[col].to_numpy() for col in numeric})
+    if others:
+        firsts = df[others].groupby(codes).first().reindex(range(n_groups))
+        reduced.update({col: firsts[col].to_numpy() for col in others})
+    for col in text:
+        values = df[col]
+        if values.dtype.name == "category":
+            values = values.astype(object)
+        reduced[col] = _join_text_groups(values, codes, n_groups)
+    return pd.DataFrame(reduced, index=index)[list(df.columns)]
+
+
+def convert_wkt_to_geojson(s, polygon_id=None):
+    """Converts WKT to a GeoJSON geometry, None for missing shapes.
+    The shape is parsed once, in the geometry cache."""
+    return get_geometry_cache().get(polygon_id, s).geojson
 
 
 def rank_polygons_by_desc_area(poly_df):
-    df = poly_df.copy()
-    df['area'] = df['wkt'].apply(lambda x: shapely.wkt.loads(x).area)
-    df['order'] = df['area'].rank(ascending=False)
-    return df['order']
+    areas = get_geometry_cache().areas(poly_df['polygonID'], poly_df['wkt'])
+    return pd.Series(areas, index=poly_df.index, name='order')\
+        .rank(ascending=False)
 
 
 def get_data_types():
-    url = "https://raw.githubusercontent.com/Big-Life-Lab/covid-19-wastewater/main/site/Variables.csv"  # noqa
-    variables = pd.read_csv(url)
-    variables["variableName"] = variables["variableName"].str.lower()
-    variables["variableType"] = variables["variableType"]\
-        .replace(r"date(time)?", "datetime64[ns]", regex=True) \
-        .replace("boolean", "bool") \
-        .replace("float", "float64") \
-        .replace("integer", "int64") \
-        .replace("blob", "object") \
-        .replace("category", "string")
-
-    return variables\
-        .groupby("tableName")[['variableName', 'variableType']] \
-        .apply(lambda x: x.set_index('variableName').to_dict(orient='index')) \
-        .to_dict()
+    return odm_schema.get_schema().data_types()
 
 
 def get_table_fields(table_name):
-    url = "https://raw.githubusercontent.com/Big-Life-Lab/covid-19-wastewater/main/site/Variables.csv"  # noqa
-    variables = pd.read_csv(url)
-    return variables.loc[variables["tableName"] == table_name, "variableName"]
+    return odm_schema.get_schema().table_fields(table_name)
 
 
-def clean_primary_key(key):
-    key = str(key)
-    if key.startswith('u'):
-        key = key[1:]
-    if key[0].isupper():
-        key = key[0].lower() + key[1:]
-    return key.replace('Ww', 'ww')
+clean_primary_key = odm_schema.clean_primary_key
 
 
 def get_primary_key(table_name=None):
-    url = "https://raw.githubusercontent.com/Big-Life-Lab/covid-19-wastewater/main/site/Variables.csv"  # noqa
-    variables = pd.read_csv(url)
-    keys = variables.loc[variables["key"] == "Primary Key", ["tableName", "variableName"]].set_index("tableName")
-    keys = keys.apply(lambda x: clean_primary_key(x["variableName"]), axis=1)
-    keys = keys.to_dict()
+    schema = odm_schema.get_schema()
     if table_name is None:
-        return keys
-    return keys[table_name]
+        return schema.primary_keys()
+    return schema.primary_key(table_name)
 
 
-def build_site_specific_dataset(df, site_id):
+class SiteIndex:
+    """Positions of the rows of each site in a combined dataset, to take
+    out the dataset of many sites (see build_site_specific_dataset)
+    without scanning the whole table for each of them.
+
+    The rows are grouped once by site (Site_siteID and
+    SiteMeasure_siteID) and by public health polygon (CPHD_polygonID).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The combined dataset (see Odm.combine_dataset). It must not be
+        modified while the index is used.
+    """
     idx_col = "Calculated_timestamp"
+
+    def __init__(self, df):
+        self.df = df
+        if df.empty:
+            self._sorted = df
+        else:
+            columns = [col for col in df.columns if col != self.idx_col]
+            self._sorted = df.set_index(self.idx_col)[sorted(columns)]
+        self._sample_rows = self._group_rows("Site_siteID")
+        self._site_measure_rows = self._group_rows("SiteMeasure_siteID")
+        cphd_ids = df["CPHD_polygonID"].fillna("").astype(str).str.lower() \
+            if "CPHD_polygonID" in df.columns else pd.Series(dtype=object)
+        self._cphd_rows = self._group_rows(cphd_ids)
+        self._cphd_matches = {}
+
+    def _group_rows(self, key):
+        if isinstance(key, str):
+            if key not in self.df.columns:
+                return {}
+            key = self.df[key]
+        return pd.Series(np.arange(len(key)))\
+            .groupby(key.to_numpy(), sort=False).indices
+
+    def site_rows(self, site_id):
+        """Gets the positions of the rows of a site, samples and site
+        measures, in the order of the dataset."""
+        empty = np.array([], dtype=int)
+        return np.union1d(
+            self._sample_rows.get(site_id, empty),
+            self._site_measure_rows.get(site_id, empty))
+
+    def cphd_rows(self, site_id):
+        """Gets the positions of the public health rows of the polygon
+        matched to the first sample of a site. As earlier versions did,
+        the lowercase polygon IDs that the ID of that polygon matches
+        as a regular expression are all taken."""
+        samples = self._sample_rows.get(site_id)
+        if samples is None or "Calculated_polygonIDForCPHD" \
+                not in self.df.columns:
+            return None
+        pattern = str(
+            self.df["Calculated_polygonIDForCPHD"].iloc[samples[0]]).lower()
+        if pattern not in self._cphd_matches:
+            # Only the distinct polygon IDs are matched
+            matched = [
+                rows for polygon_id, rows in self._cphd_rows.items()
+                if re.match(pattern, polygon_id)]
+            self._cphd_matches[pattern] = np.sort(np.concatenate(
+                matched)) if matched else np.array([], dtype=int)
+        return self._cphd_matches[pattern]
+
+    def site_dataset(self, site_id):
+        """Gets the dataset of a site: its rows followed by the public
+        health rows of its polygon, indexed by timestamp and with
+        sorted columns."""
+        rows = self.site_rows(site_id)
+        cphd_rows = self.cphd_rows(site_id)
+        if cphd_rows is not None:
+            rows = np.concatenate([rows, cphd_rows])
+        return self._sorted.iloc[rows]
+
+
+def build_site_specific_dataset(df, site_id, site_index=None):
+    """Takes out the rows of a site from the combined dataset, with the
+    public health rows of the polygon matched to it.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The combined dataset (see Odm.combine_dataset).
+    site_id : str
+        The ID of the site.
+    site_index : SiteIndex, optional
+        An index of df, to use when taking out the datasets of many
+        sites. By default None, which indexes df for this call.
+
+    Returns
+    -------
+    pd.DataFrame
+        The rows of the site, indexed by "Calculated_timestamp",
+        with sorted columns.
+    """
     if df.empty:
         return df
-    filt_site1 = df["Site_siteID"] == site_id
-    if "SiteMeasure_siteID" in df.columns:
-        filt_site2 = df["SiteMeasure_siteID"] == site_id
-        filt_site = filt_site1 | filt_site2
-    else:
-        filt_site = filt_site1
-    df1 = df[filt_site]
-    df1.set_index(idx_col, inplace=True)
-
-    filt_cphd_df = df.loc[filt_site1, "Calculated_polygonIDForCPHD"]
-    if not filt_cphd_df.empty:
-        cphd_poly_id = str(
-            filt_cphd_df.iloc[0]).lower()
-        poly_filt = df["CPHD_polygonID"]\
-            .fillna("").str.lower().str.match(cphd_poly_id)
-        df2 = df[poly_filt]
-        df2.set_index(idx_col, inplace=True)
-        dataset = pd.concat([df1, df2], axis=0)
-    else:
-        dataset = df1
+    if site_index is None:
+        site_index = SiteIndex(df)
+    return site_index.site_dataset(site_id)
 
-    dataset.sort_index()
-    return dataset.reindex(sorted(dataset.columns), axis=1)
 
+def resample_per_day(df, pairwise=False, by=None):
+    """Reduces a table indexed by timestamps to one row per day
+    (see reduce_groups). Days without data give empty rows.
 
-def resample_per_day(df):
+    With by, the column holding the site of each row, the days of all
+    the sites are reduced in the same pass. Each site gets the days
+    from its first to its last, and the result is indexed by site and
+    day, sorted."""
     if df.empty:
         return df
-    return df.resample('1D').agg(reduce_by_type)
+    if by is not None:
+        return _resample_sites_per_day(df, by, pairwise)
+    if pairwise:
+        return df.resample('1D').agg(reduce_by_type)
+    days = df.index.floor("D")
+    daily = reduce_groups(df, days)
+    all_days = pd.date_range(
+        daily.index.min(), daily.index.max(), freq="D", name=df.index.name)
+    return daily.reindex(all_days)
+
+
+def _resample_sites_per_day(df, by, pairwise):
+    if pairwise:
+        return df.groupby(by).apply(
+            lambda site: site.drop(columns=[by])
+            .resample('1D').agg(reduce_by_type))
+    codes, sites = pd.factorize(df[by], sort=True)
+    days = df.index.floor("D")
+    df = df.drop(columns=[by])
+    valid = (codes >= 0) & days.notna()
+    if not valid.all():
+        df = df.loc[valid]
+        codes = codes[valid]
+        days = days[valid]
+    index_names = [by, df.index.name]
+    if df.empty:
+        return df.set_index(
+            pd.MultiIndex.from_arrays([sites[:0], days], names=index_names))
+    # The rows are grouped by a single key: site * n_days + day
+    first_day = days.min()
+    offsets = np.asarray((days - first_day) // pd.Timedelta(days=1))
+    n_days = offsets.max() + 1
+    daily = reduce_groups(df, codes * n_days + offsets)
+
+    # Every day from the first to the last of each site
+    offsets = pd.Series(offsets).groupby(codes)
+    first = offsets.min()
+    lengths = (offsets.max() - first + 1).to_numpy()
+    starts = first.index.to_numpy() * n_days + first.to_numpy()
+    steps = np.arange(lengths.sum()) \
+        - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    keys = np.repeat(starts, lengths) + steps
+    daily = daily.reindex(keys)
+    daily.index = pd.MultiIndex.from_arrays([
+        sites.take(keys // n_days),
+        first_day + pd.to_timedelta(keys % n_days, unit="D"),
+    ], names=index_names)
+    return daily
 
 
 def reduce_with_warnings(series):
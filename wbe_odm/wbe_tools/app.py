@@ -21,6 +21,9 @@ Odm = odm.Odm
 pd.options.display.max_columns = None
 pio.templates.default = "plotly_white"
 
+# Zoom level the polygons drawn on the map are simplified for.
+MAP_POLYGON_ZOOM = 10
+
 
 # If I find a way to use the icons provided
 # by the mapbox api, these would be the icons for each site type
@@ -284,7 +287,7 @@ def map_from_samples(odm_data):
         raise PreventUpdate
     odm_instance = load_serialized(odm_data)
     samples = odm_instance.combine_dataset()
-    geo = odm_instance.get_polygon_geoJSON()
+    geo = odm_instance.get_polygon_geoJSON(zoom=MAP_POLYGON_ZOOM)
     return samples.to_json(date_format='iso'), geo
 
 
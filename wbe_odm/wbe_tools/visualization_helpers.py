@@ -1,10 +1,10 @@
-from pyproj import Geod
-import math
 import geojson
 import numpy as np
 import pandas as pd
 import random
-from shapely.geometry import shape, Point, LineString
+from shapely.geometry import shape
+
+from wbe_odm import utilities
 
 
 def find_time_columns_to_merge(df):
@@ -65,6 +65,9 @@ def get_map_center(geo_json):
     y_s = []
     if geo_json is None:
         return default_center
+    if "view" in geo_json:
+        # Computed once by Odm.get_polygon_geoJSON.
+        return dict(geo_json["view"]["center"])
     if len(geo_json["features"]) == 0:
         return default_center
     for feat in geo_json["features"]:
@@ -83,81 +86,30 @@ def get_map_center(geo_json):
     return {"lat": y_m, "lon": x_m}
 
 
-def points_to_meters(point_1, point_2):
-    line_string = LineString([point_1, point_2])
-    geod = Geod(ellps="WGS84")
-    return geod.geometry_length(line_string)
-
-
 def get_bounding_box(geometry):
     coords = np.array(list(geojson.utils.coords(geometry)))
     return coords[:, 0].min(), coords[:, 0].max(),\
         coords[:, 1].min(), coords[:, 1].max()
 
 
-def interpolate_zoom(row, low_lat, high_lat, lat):
-    high_label = "Latitude " + str(high_lat)
-    low_label = "Latitude " + str(low_lat)
-    x1, x2 = low_lat, high_lat
-    y1, y2 = row[low_label], row[high_label]
-    return interpolate(x1, x2, y1, y2, lat)
-
-
-def interpolate(x1, x2, y1, y2, x):
-    return y1 + (x - x1) * (y2 - y1)/(x2 - x1)
-
-
-def find_neighbours(value, df, colname):
-    exactmatch = df[df[colname] == value]
-    if not exactmatch.empty:
-        return exactmatch.index
-    else:
-        lowerneighbour_ind = df[df[colname] < value][colname].idxmax()
-        upperneighbour_ind = df[df[colname] > value][colname].idxmin()
-        return [lowerneighbour_ind, upperneighbour_ind]
-
-
 def get_zoom_level(geo_json, map_height_px):
+    """Gets the zoom level of a map showing all the features.
+
+    The view and bounding box embedded by Odm.get_polygon_geoJSON are
+    used when present. Otherwise, the bounding box is computed from
+    the coordinates of the features. See utilities.get_zoom_level.
+    """
     default_bounding_box = (
         -71.383618, 46.746301, -71.168241, 46.840914
     )
-    # print(geo_json, type)
     if geo_json is None:
-        bounding_box = default_bounding_box
+        return utilities.get_zoom_level(default_bounding_box, map_height_px)
+    view = geo_json.get("view")
+    if view is not None and view.get("mapHeight") == map_height_px:
+        return view["zoom"]
+    if "bbox" in geo_json:
+        bounding_box = tuple(geo_json["bbox"])
     else:
-        bounding_box = get_bounding_box(geo_json)
-
-    center_lon = (bounding_box[0] + bounding_box[1]) / 2
-    center_lat = (bounding_box[2] + bounding_box[3]) / 2
-    point_1 = Point(center_lon, bounding_box[2])
-    point_2 = Point(center_lon, bounding_box[3])
-
-    distance = points_to_meters(point_1, point_2)
-    required_pixel_density = distance/map_height_px * 2
-
-    mapbox_lat_low = math.floor(abs(center_lat)/20) * 20
-    mapbox_lat_high = math.ceil(abs(center_lat)/20) * 20
-    if mapbox_lat_high > 80:
-        mapbox_lat_high = 80
-    mapbox_zoom = pd.read_csv(
-        "./wbe_odm/wbe_tools/mapbox_zoom.csv",
-        index_col="Zoom level"
-    )
-
-    mapbox_zoom["calc"] = mapbox_zoom.apply(
-        lambda row:
-            interpolate_zoom(
-                row, mapbox_lat_low, mapbox_lat_high, center_lat),
-        axis=1)
-
-    [zoom_min, zoom_max] = find_neighbours(
-        required_pixel_density, mapbox_zoom, "calc")
-
-    y1, y2 = zoom_max, zoom_min
-    x1 = mapbox_zoom["calc"].iloc[zoom_max]
-    x2 = mapbox_zoom["calc"].iloc[zoom_min]
-    zoom_level = interpolate(
-        x1, x2, y1, y2,
-        required_pixel_density
-    )
-    return zoom_level
+        min_x, max_x, min_y, max_y = get_bounding_box(geo_json)
+        bounding_box = (min_x, min_y, max_x, max_y)
+    return utilities.get_zoom_level(bounding_box, map_height_px)